@@ -12,12 +12,18 @@
 
 import os
 
+# 評価ではサンプリングせず、全リクエストをドキュメント本文つきでトレースする (approaches/serving/tracing.py)
+os.environ["RACH_TRACING_EVALUATION"] = "1"
+
 # Specify the full path to the chain notebook
 chain_notebook_path = os.path.join(os.getcwd(), "chain_langchain")
 
 # Specify the full path to the config file (.yaml)
 config_file_path = os.path.join(os.getcwd(), "rag_chain_config.yaml")
 
+# chain が import する補助モジュール (approaches/ 以下) もモデルと一緒に保存する
+code_paths = [os.path.join(os.getcwd(), "approaches")]
+
 print(f"Chain notebook path: {chain_notebook_path}")
 print(f"Chain notebook path: {config_file_path}")
 
@@ -49,6 +55,7 @@ with mlflow.start_run(run_name="rach_rag_chatbot"):
     logged_chain_info = mlflow.langchain.log_model(
         lc_model=chain_notebook_path,  # Chain code file e.g., /path/to/the/chain.py
         model_config=config_file_path,  # Chain configuration set in 00_config
+        code_paths=code_paths,  # Modules imported by the chain
         artifact_path="chain",  # Required by MLflow
         input_example=input_example,  # Save the chain's input schema.  MLflow will execute the chain before logging & capture it's output schema.
         example_no_conversion=True,  # Required by MLflow to use the input_example as the chain's schema
@@ -14,6 +14,7 @@
 
 # COMMAND ----------
 
+import os
 import yaml
 import mlflow
 
@@ -21,11 +22,19 @@ rag_chain_config = {
       "vector_search_endpoint_name": VECTOR_SEARCH_ENDPOINT_NAME,
       "vector_search_index_name": f"{catalog}.{dbName}.{embed_table_name}_vs_index",
       "llm_endpoint_name": instruct_endpoint_name,
-      "llm_mini_endpoint_name": instruct_mini_endpoint_name
+      "llm_mini_endpoint_name": instruct_mini_endpoint_name,
+      "embedding_endpoint_name": embedding_endpoint_name,
+      "index_version_path": index_version_path,
+      "local_index_snapshot_path": local_index_snapshot_path,
+      "question_classifier_path": question_classifier_path,
 }
 
 config_file_name = 'rag_chain_config.yaml'
 try:
+    # チューニング用のキー（speculative_execution など）は残したまま、エンドポイント名だけ更新する
+    if os.path.exists(config_file_name):
+        with open(config_file_name) as f:
+            rag_chain_config = {**(yaml.safe_load(f) or {}), **rag_chain_config}
     with open(config_file_name, 'w') as f:
         yaml.dump(rag_chain_config, f)
 except:
@@ -137,17 +146,31 @@ except Exception as e:
     time.sleep(10)
     vs_index.sync()  # なぜかエラー出るが、sync()を2回実行するとエラーが出なくなる
 
+# COMMAND ----------
+
+# 同期が終わったらインデックスのバージョンを更新し、chain 側のキャッシュ (セマンティックキャッシュなど) を無効化する
+from approaches.cache.index_version import wait_for_sync_to_finish, write_index_version
+
+wait_for_sync_to_finish(vs_index)
+print(f"index version: {write_index_version(index_version_path, vs_index_fullname)}")
+
 
 # COMMAND ----------
 
 import os
 
+# 評価ではサンプリングせず、全リクエストをドキュメント本文つきでトレースする (approaches/serving/tracing.py)
+os.environ["RACH_TRACING_EVALUATION"] = "1"
+
 # Specify the full path to the chain notebook
 chain_notebook_path = os.path.join(os.getcwd(), "chain_langchain")
 
 # Specify the full path to the config file (.yaml)
 config_file_path = os.path.join(os.getcwd(), "rag_chain_config.yaml")
 
+# chain が import する補助モジュール (approaches/ 以下) もモデルと一緒に保存する
+code_paths = [os.path.join(os.getcwd(), "approaches")]
+
 print(f"Chain notebook path: {chain_notebook_path}")
 print(f"Chain notebook path: {config_file_path}")
 
@@ -179,6 +202,7 @@ with mlflow.start_run(run_name="rach_rag_chatbot"):
     logged_chain_info = mlflow.langchain.log_model(
         lc_model=chain_notebook_path,  # Chain code file e.g., /path/to/the/chain.py
         model_config=config_file_path,  # Chain configuration set in 00_config
+        code_paths=code_paths,  # Modules imported by the chain
         artifact_path="chain",  # Required by MLflow
         input_example=input_example,  # Save the chain's input schema.  MLflow will execute the chain before logging & capture it's output schema.
         example_no_conversion=True,  # Required by MLflow to use the input_example as the chain's schema
@@ -207,6 +231,14 @@ registered_agent.invoke(input_example)
 
 # COMMAND ----------
 
+### ストリーミングの確認 (デプロイ後のエンドポイントも predict_stream でトークンを逐次返す)
+streaming_agent = mlflow.pyfunc.load_model(f"models:/{model_name}/{uc_model_info.version}")
+
+for chunk in streaming_agent.predict_stream(input_example):
+    print(chunk, end="", flush=True)
+
+# COMMAND ----------
+
 # Deploy
 
 import os
@@ -224,6 +256,9 @@ deployment_info = agents.deploy(
     scale_to_zero=True,
     environment_vars={
        'COHERE_API_KEY': os.environ['COHERE_API_KEY'],
+       # Vector Search を共有セッション経由の REST で呼ぶために使う (config の secrets)
+       'DATABRICKS_HOST': f'{{{{secrets/{databricks_host_secrets_scope}/{databricks_host_secrets_key}}}}}',
+       'DATABRICKS_TOKEN': f'{{{{secrets/{databricks_token_secrets_scope}/{databricks_token_secrets_key}}}}}',
    }
 )
 
@@ -0,0 +1,57 @@
+"""
+ベクトルインデックスのバージョンマーカー
+
+create-vector-db.py などでインデックスを再同期したときに UC Volume にマーカーファイルを書き、
+サービング側のキャッシュはその値が変わったら中身を捨てる。
+"""
+import json
+import os
+import time
+import uuid
+from typing import Optional
+
+
+def write_index_version(path: str, index_name: str) -> str:
+    """インデックスの同期時に新しいバージョンを書き込み、その値を返す"""
+    version = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"index_name": index_name, "version": version, "synced_at": time.time()}, f)
+    return version
+
+
+def read_index_version(path: str) -> Optional[str]:
+    """
+    マーカーファイルからバージョンを読む。ファイルがなければ None を返す。
+    クラスタ上ではローカルの /Volumes パスから、モデルサービング上では Files API から読む。
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f).get("version")
+
+    if not os.environ.get("DATABRICKS_HOST"):
+        return None
+
+    from databricks.sdk import WorkspaceClient
+    from databricks.sdk.errors import NotFound
+
+    try:
+        response = WorkspaceClient().files.download(path)
+    except NotFound:
+        return None
+    return json.loads(response.contents.read()).get("version")
+
+
+def wait_for_sync_to_finish(vs_index, timeout_seconds: float = 1800, poll_seconds: float = 10) -> None:
+    """
+    vs_index.sync() で始まった同期が終わるまで待つ
+    (sync 中も detailed_state に ONLINE が含まれるため、wait_for_index_to_be_ready では待てない)
+    """
+    started_at = time.time()
+    while time.time() - started_at < timeout_seconds:
+        # sync() 直後はまだ状態が切り替わっていないことがあるので、先に待つ
+        time.sleep(poll_seconds)
+        status = vs_index.describe().get("status", {})
+        if status.get("detailed_state", "").upper() == "ONLINE_NO_PENDING_UPDATE":
+            return
+    raise Exception(f"Timeout, index sync did not finish in {timeout_seconds}s: {vs_index.describe()}")
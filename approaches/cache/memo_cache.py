@@ -0,0 +1,123 @@
+"""
+分類・リライト・HyDE など、質問だけで決まる中間 LLM 出力のメモ化
+
+キーは NFKC 正規化した質問文 + プロンプト/モデルのバージョン。
+メモリ上の LRU (上限つき) と、任意で sqlite のディスク層の2段構成。
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from approaches.cache.semantic_cache import normalize_question
+
+
+def prompt_version(prompt, model, extra: str = "") -> str:
+    """プロンプトとモデル設定から短いバージョン文字列を作る。どちらかを変えるとキャッシュは別物になる"""
+    source = "|".join([
+        prompt.pretty_repr(),
+        str(getattr(model, "endpoint", "")),
+        json.dumps(getattr(model, "extra_params", None) or {}, sort_keys=True),
+        extra,
+    ])
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:12]
+
+
+class MemoCache:
+    def __init__(
+        self,
+        name: str,
+        version: str,
+        max_entries: int = 5000,
+        ttl_seconds: float = 7 * 86400,
+        disk_path: Optional[str] = None,
+    ):
+        self.name = name
+        self.version = version
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, tuple[Any, float]]" = OrderedDict()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._disk = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, value TEXT, created_at REAL)"
+            )
+            self._disk.commit()
+
+    def key(self, question: str) -> str:
+        raw = f"{self.name}|{self.version}|{normalize_question(question)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, question: str) -> tuple[Any, Optional[str]]:
+        """(値, ヒットした層) を返す。ヒットしなければ (None, None)"""
+        key = self.key(question)
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None and now - item[1] <= self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return item[0], "memory"
+
+            if self._disk is not None:
+                row = self._disk.execute(
+                    "SELECT value, created_at FROM memo WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    value = json.loads(row[0])
+                    self._put_memory(key, value, row[1])
+                    self._stats["disk_hits"] += 1
+                    return value, "disk"
+
+            self._stats["misses"] += 1
+            return None, None
+
+    def put(self, question: str, value: Any) -> None:
+        key = self.key(question)
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, value, now)
+            if self._disk is not None:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO memo (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), now),
+                )
+                self._disk.commit()
+
+    def get_or_compute(self, question: str, compute: Callable[[], Any]) -> tuple[Any, Optional[str]]:
+        value, tier = self.get(question)
+        if tier is not None:
+            return value, tier
+        value = compute()
+        self.put(question, value)
+        return value, None
+
+    async def aget_or_compute(self, question: str, acompute: Callable[[], Awaitable[Any]]) -> tuple[Any, Optional[str]]:
+        value, tier = self.get(question)
+        if tier is not None:
+            return value, tier
+        value = await acompute()
+        self.put(question, value)
+        return value, None
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self._stats["memory_hits"] + self._stats["disk_hits"]
+            lookups = hits + self._stats["misses"]
+            return {
+                **self._stats,
+                "entries": len(self._memory),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+    def _put_memory(self, key: str, value: Any, created_at: float) -> None:
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
@@ -0,0 +1,179 @@
+"""
+言い換えられた FAQ の質問に対して、過去の回答を返すセマンティックキャッシュ
+
+質問を正規化してembeddingし、キャッシュ済みの質問とのコサイン類似度が閾値以上なら保存済みの回答を返す。
+LRU + TTL で古いエントリを捨て、ベクトルインデックスの再同期 (index_version の変化) で全消去する。
+"""
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# 文末の記号は意味を変えないので落とす (「？」と「?」、「。」の有無など)
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!。．.、,！？]+$")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """NFKC 正規化・小文字化・空白の統一・文末記号の除去をした質問文を返す"""
+    text = unicodedata.normalize("NFKC", question).strip().lower()
+    text = _WHITESPACE.sub(" ", text)
+    return _TRAILING_PUNCTUATION.sub("", text)
+
+
+@dataclass
+class CacheEntry:
+    question: str
+    answer: str
+    embedding: np.ndarray
+    created_at: float
+
+
+@dataclass
+class CacheLookup:
+    answer: Optional[str]
+    similarity: float
+    matched_question: Optional[str]
+    # miss の場合に store() で再利用するための embedding
+    embedding: Optional[np.ndarray]
+
+    @property
+    def hit(self) -> bool:
+        return self.answer is not None
+
+
+class SemanticCache:
+    """
+    embed_fn: 文字列のリストを受け取り embedding のリストを返す関数 (Embeddings.embed_documents など)
+    version_fn: 現在のインデックスのバージョンを返す関数。値が変わったらキャッシュを全消去する
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[list[str]], list[list[float]]],
+        similarity_threshold: float = 0.95,
+        max_entries: int = 1000,
+        ttl_seconds: float = 86400,
+        version_fn: Optional[Callable[[], Optional[str]]] = None,
+        version_check_interval_seconds: float = 60,
+    ):
+        self.embed_fn = embed_fn
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version_fn = version_fn
+        self.version_check_interval_seconds = version_check_interval_seconds
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        # 類似度計算用の行列。エントリが変わったときだけ作り直す
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_keys: list[str] = []
+        self._version: Optional[str] = None
+        self._version_checked_at = 0.0
+        self._stats = {"hits": 0, "exact_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def lookup(self, question: str) -> CacheLookup:
+        self._check_version()
+        key = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            # 正規化後に完全一致するなら embedding を計算しない
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                self._stats["exact_hits"] += 1
+                return CacheLookup(entry.answer, 1.0, entry.question, entry.embedding)
+
+        embedding = self._embed(key)
+        with self._lock:
+            matrix, keys = self._get_matrix()
+            if matrix is None:
+                self._stats["misses"] += 1
+                return CacheLookup(None, 0.0, None, embedding)
+            similarities = matrix @ embedding
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            entry = self._entries.get(keys[best])
+            if entry is None or similarity < self.similarity_threshold:
+                self._stats["misses"] += 1
+                return CacheLookup(None, similarity, None, embedding)
+            self._entries.move_to_end(keys[best])
+            self._stats["hits"] += 1
+            return CacheLookup(entry.answer, similarity, entry.question, embedding)
+
+    def store(self, question: str, answer: str, embedding: Optional[np.ndarray] = None) -> None:
+        key = normalize_question(question)
+        if embedding is None:
+            embedding = self._embed(key)
+        with self._lock:
+            self._entries[key] = CacheEntry(question, answer, embedding, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+            self._matrix = None
+
+    def invalidate(self) -> None:
+        """インデックスが更新されたときに呼ぶ"""
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+                "index_version": self._version,
+            }
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.asarray(self.embed_fn([text])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _get_matrix(self):
+        if self._matrix is None and self._entries:
+            self._matrix_keys = list(self._entries.keys())
+            self._matrix = np.stack([self._entries[k].embedding for k in self._matrix_keys])
+        return self._matrix, self._matrix_keys
+
+    def _purge_expired(self, now: float) -> None:
+        expired = [k for k, e in self._entries.items() if now - e.created_at > self.ttl_seconds]
+        for k in expired:
+            del self._entries[k]
+            self._stats["evictions"] += 1
+        if expired:
+            self._matrix = None
+
+    def _check_version(self) -> None:
+        if self.version_fn is None:
+            return
+        now = time.time()
+        if now - self._version_checked_at < self.version_check_interval_seconds:
+            return
+        self._version_checked_at = now
+        try:
+            version = self.version_fn()
+        except Exception as e:
+            # バージョンが取れなくても回答は返せるので、キャッシュはそのまま使う
+            logger.warning("failed to read index version: %s", e)
+            return
+        if self._version is not None and version != self._version:
+            self.invalidate()
+        self._version = version
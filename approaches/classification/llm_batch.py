@@ -0,0 +1,42 @@
+"""
+複数の質問を1回の LLM 呼び出しで分類するためのプロンプト整形と出力のパース
+
+チャットのエンドポイントは1リクエストに1会話しか受け付けないので、
+マイクロバッチでまとめた質問は番号付きで1つのプロンプトに並べ、「番号: ラベル」の形で1行ずつ答えさせる。
+まとめる質問は別々のユーザーのものなので、1つの質問の文面が他の質問のラベルを操作できないよう、
+質問はそれぞれ <question> タグで区切り、タグと紛れる文字はエスケープする。
+"""
+import html
+import re
+from typing import Optional, Sequence
+
+from approaches.classification.local_classifier import LABELS
+
+_LINE_PATTERN = re.compile(r"^\s*(\d+)\s*[:：.)]\s*([A-Za-z]+)")
+
+
+def format_numbered_questions(questions: Sequence[str]) -> str:
+    # 質問の中の改行で行がずれないように1行にまとめ、< > & をエスケープして質問の中から </question> を閉じられないようにする
+    return "\n".join(
+        f'<question id="{i}">{html.escape(" ".join(question.split()), quote=False)}</question>'
+        for i, question in enumerate(questions, start=1)
+    )
+
+
+def parse_numbered_labels(response: str, n_questions: int) -> Optional[list[str]]:
+    """
+    「番号: ラベル」の行から、質問の順番にラベルを返す。
+    番号が欠けている・範囲外や重複がある・ラベルが general / specific 以外の場合は None (呼び出し側で1件ずつ分類し直す)
+    """
+    labels = {}
+    for line in response.splitlines():
+        match = _LINE_PATTERN.match(line)
+        if match is None:
+            continue
+        i, label = int(match.group(1)), match.group(2).lower()
+        if label not in LABELS or not 1 <= i <= n_questions or i in labels:
+            return None
+        labels[i] = label
+    if len(labels) != n_questions:
+        return None
+    return [labels[i] for i in range(1, n_questions + 1)]
@@ -0,0 +1,148 @@
+"""
+一般質問 (general) / 学校固有の質問 (specific) のローカル分類器
+
+classification_chain (gpt-4o-mini) は1単語を返すためだけに LLM を1往復させている。
+文字 n-gram の有無を特徴量にしたロジスティック回帰なら、1件あたり数十マイクロ秒で判定できる。
+確信度が低い質問だけ LLM にフォールバックさせる前提なので、精度より速度と単純さを優先している。
+"""
+import json
+import math
+import os
+from typing import Awaitable, Callable, Iterable, Optional, Sequence
+
+import numpy as np
+
+from approaches.retrieval.lexical_index import char_ngrams
+
+LABELS = ("specific", "general")
+
+
+class LocalQuestionClassifier:
+    def __init__(
+        self,
+        vocab: dict[str, int],
+        weights: np.ndarray,
+        bias: float,
+        n_values: Iterable[int] = (1, 2, 3),
+    ):
+        self.vocab = vocab
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = float(bias)
+        self.n_values = tuple(n_values)
+
+    def _features(self, question: str) -> list[int]:
+        return sorted({self.vocab[t] for t in char_ngrams(question, self.n_values) if t in self.vocab})
+
+    def predict_proba(self, question: str) -> float:
+        """general である確率"""
+        logit = self.bias + sum(self.weights[i] for i in self._features(question))
+        return 1.0 / (1.0 + math.exp(-logit))
+
+    def predict(self, question: str) -> tuple[str, float]:
+        """(ラベル, 確信度) を返す。確信度は予測したラベルの確率 (0.5〜1.0)"""
+        p_general = self.predict_proba(question)
+        if p_general >= 0.5:
+            return "general", p_general
+        return "specific", 1.0 - p_general
+
+    @classmethod
+    def train(
+        cls,
+        questions: Sequence[str],
+        labels: Sequence[str],
+        n_values: Iterable[int] = (1, 2, 3),
+        min_count: int = 1,
+        l2: float = 1e-2,
+        learning_rate: float = 0.5,
+        epochs: int = 300,
+    ) -> "LocalQuestionClassifier":
+        """labels は "general" / "specific"。全件の勾配降下で L2 正則化つきロジスティック回帰を学習する"""
+        n_values = tuple(n_values)
+        token_sets = [set(char_ngrams(q, n_values)) for q in questions]
+        counts = {}
+        for tokens in token_sets:
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+        vocab = {token: i for i, token in enumerate(sorted(t for t, c in counts.items() if c >= min_count))}
+
+        # 質問は短いので、密な 0/1 行列でも十分小さい
+        x = np.zeros((len(questions), len(vocab)), dtype=np.float64)
+        for row, tokens in enumerate(token_sets):
+            x[row, [vocab[t] for t in tokens if t in vocab]] = 1.0
+        y = np.array([1.0 if label == "general" else 0.0 for label in labels])
+
+        weights = np.zeros(len(vocab))
+        bias = 0.0
+        for _ in range(epochs):
+            p = 1.0 / (1.0 + np.exp(-(x @ weights + bias)))
+            error = p - y
+            weights -= learning_rate * (x.T @ error / len(y) + l2 * weights)
+            bias -= learning_rate * float(error.mean())
+        return cls(vocab, weights, bias, n_values)
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "n_values": list(self.n_values),
+                    "vocab": self.vocab,
+                    "weights": self.weights.tolist(),
+                    "bias": self.bias,
+                },
+                f,
+                ensure_ascii=False,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "LocalQuestionClassifier":
+        """ローカル (クラスタの /Volumes など) になければ Files API から読む (モデルサービング用)"""
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+        else:
+            from databricks.sdk import WorkspaceClient
+
+            data = json.loads(WorkspaceClient().files.download(path).contents.read())
+        return cls(data["vocab"], np.asarray(data["weights"]), data["bias"], data["n_values"])
+
+
+def _confident_local_prediction(
+    classifier: Optional[LocalQuestionClassifier],
+    question: str,
+    min_confidence: float,
+) -> Optional[tuple[str, float, str]]:
+    if classifier is None:
+        return None
+    label, confidence = classifier.predict(question)
+    if confidence < min_confidence:
+        return None
+    return label, confidence, "local"
+
+
+def classify_with_fallback(
+    classifier: Optional[LocalQuestionClassifier],
+    question: str,
+    min_confidence: float,
+    llm_classify: Callable[[str], str],
+) -> tuple[str, float, str]:
+    """
+    ローカル分類器の確信度が min_confidence 以上ならその結果を、そうでなければ llm_classify(question) の結果を返す。
+    戻り値は (ラベル, 確信度, 判定元 "local" / "llm")。LLM の確信度は分からないので None ではなく 1.0 とする。
+    """
+    local = _confident_local_prediction(classifier, question, min_confidence)
+    if local is not None:
+        return local
+    return llm_classify(question), 1.0, "llm"
+
+
+async def aclassify_with_fallback(
+    classifier: Optional[LocalQuestionClassifier],
+    question: str,
+    min_confidence: float,
+    allm_classify: Callable[[str], Awaitable[str]],
+) -> tuple[str, float, str]:
+    """classify_with_fallback の async 版。LLM へのフォールバックは await allm_classify(question)"""
+    local = _confident_local_prediction(classifier, question, min_confidence)
+    if local is not None:
+        return local
+    return await allm_classify(question), 1.0, "llm"
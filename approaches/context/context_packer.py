@@ -0,0 +1,187 @@
+"""
+トークン予算つきのコンテキストパッキング
+
+rerank 後のチャンクをそのまま連結すると、以下の重複がプロンプトに乗る。
+- RecursiveCharacterTextSplitter の chunk_overlap による、同じページの隣り合うチャンクの重なり
+- contextual retrieval でチャンクの先頭に付けた文脈 (LLM が生成した要約) の重複
+
+同じ url のチャンクは重なりを取り除いて1つのパッセージにまとめ、文脈はパッセージごとに1つだけ残す。
+そのうえで relevance_score の高い順に、トークン予算に収まるだけ詰める。
+"""
+import hashlib
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# contextual retrieval のチャンクは「文脈 + "\n\n" + チャンク本文」の形 (process_and_annotate_document)
+CONTEXT_SEPARATOR = "\n\n"
+
+
+def get_token_counter(encoding_name: str = "o200k_base") -> Callable[[str], int]:
+    """
+    tiktoken があればそのトークン数、なければ文字数を返す関数。
+    日本語では文字数がトークン数より多くなり、予算に入るパッセージが減るので、文字数のときは警告を出す
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning("tiktoken is not installed. context packing counts characters instead of %s tokens", encoding_name)
+        return len
+    encoding = tiktoken.get_encoding(encoding_name)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def split_contextual_prefix(content: str, chunk_hash: Optional[str] = None) -> tuple[str, str]:
+    """
+    (文脈, 本文) に分ける。区切りがなければ文脈は空文字。
+    文脈にも本文にも "\n\n" が入りうるので、chunk_hash (文脈付与前の本文の sha256) があれば、
+    残りがそのハッシュに一致する区切りで分ける。一致しない、または chunk_hash がなければ最初の区切りで分ける
+    """
+    if chunk_hash:
+        start = content.find(CONTEXT_SEPARATOR)
+        while start != -1:
+            body = content[start + len(CONTEXT_SEPARATOR):]
+            if hashlib.sha256(body.encode("utf-8")).hexdigest() == chunk_hash:
+                return content[:start].strip(), body
+            start = content.find(CONTEXT_SEPARATOR, start + 1)
+    prefix, separator, body = content.partition(CONTEXT_SEPARATOR)
+    if not separator:
+        return "", content
+    return prefix.strip(), body
+
+
+def merge_overlapping(first: str, second: str, min_overlap_chars: int, max_overlap_chars: int) -> Optional[str]:
+    """
+    first の末尾と second の先頭が min_overlap_chars 文字以上重なっていれば、重なりを1回にして連結する。
+    片方がもう片方に含まれる場合は長い方を返す。重ならなければ None
+    """
+    if second in first:
+        return first
+    if first in second:
+        return second
+    for size in range(min(len(first), len(second), max_overlap_chars), min_overlap_chars - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return None
+
+
+@dataclass
+class Passage:
+    url: Optional[str]
+    prefix: str
+    body: str
+    score: float
+    chunk_ids: list = field(default_factory=list)
+
+
+@dataclass
+class PackingReport:
+    tokens_before: int
+    tokens_after: int
+    n_chunks: int
+    n_passages: int
+    n_merged: int
+    n_duplicates: int
+    n_dropped: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+    def as_dict(self) -> dict:
+        return {**self.__dict__, "tokens_saved": self.tokens_saved}
+
+
+class ContextPacker:
+    def __init__(
+        self,
+        max_tokens: int,
+        count_tokens: Callable[[str], int],
+        passage_template: str = "\nPassage: {chunk_text}\n",
+        min_overlap_chars: int = 20,
+        max_overlap_chars: int = 400,
+    ):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.passage_template = passage_template
+        self.min_overlap_chars = min_overlap_chars
+        self.max_overlap_chars = max_overlap_chars
+
+    def render(self, texts: Sequence[str]) -> str:
+        return "".join(self.passage_template.format(chunk_text=text) for text in texts)
+
+    def collapse(self, docs: Sequence) -> list[Passage]:
+        """同じ url で重なっているチャンクを1つのパッセージにまとめる。スコアはまとめたチャンクの最大値"""
+        passages: list[Passage] = []
+        for doc in docs:
+            prefix, body = split_contextual_prefix(doc.page_content, doc.metadata.get("chunk_hash"))
+            score = doc.metadata.get("relevance_score", doc.metadata.get("score", 0.0))
+            passage = Passage(doc.metadata.get("url"), prefix, body, score, [doc.metadata.get("id")])
+            # まとめたパッセージがさらに別のパッセージと重なることがあるので、まとまらなくなるまで繰り返す
+            merged = True
+            while merged:
+                merged = False
+                for other in passages:
+                    if passage.url is None or other.url != passage.url:
+                        continue
+                    body = merge_overlapping(other.body, passage.body, self.min_overlap_chars, self.max_overlap_chars)
+                    if body is None:
+                        body = merge_overlapping(passage.body, other.body, self.min_overlap_chars, self.max_overlap_chars)
+                    if body is None:
+                        continue
+                    passages.remove(other)
+                    # 文脈はスコアの高い方のものだけ残す
+                    best = other if other.score >= passage.score else passage
+                    passage = Passage(
+                        passage.url, best.prefix, body, max(other.score, passage.score),
+                        other.chunk_ids + passage.chunk_ids,
+                    )
+                    merged = True
+                    break
+            passages.append(passage)
+        return sorted(passages, key=lambda p: p.score, reverse=True)
+
+    def pack(self, docs: Sequence) -> tuple[str, PackingReport]:
+        """(コンテキスト文字列, レポート) を返す。レポートの tokens_before はチャンクをそのまま連結した場合のトークン数"""
+        tokens_before = self.count_tokens(self.render([doc.page_content for doc in docs]))
+        passages = self.collapse(docs)
+
+        texts = []
+        seen_prefixes = set()
+        seen_bodies = set()
+        used_tokens = 0
+        n_duplicates = 0
+        n_dropped = 0
+        for passage in passages:
+            # 別の url に同じ本文が載っていることがある (FAQ の転載など)
+            if passage.body in seen_bodies:
+                n_duplicates += 1
+                continue
+            # 別のパッセージと同じ文脈は繰り返さない
+            if passage.prefix and passage.prefix not in seen_prefixes:
+                text = passage.prefix + CONTEXT_SEPARATOR + passage.body
+            else:
+                text = passage.body
+            tokens = self.count_tokens(self.render([text]))
+            if used_tokens + tokens > self.max_tokens:
+                # 予算を超えるパッセージは飛ばし、後ろの短いパッセージが入るかは試す
+                n_dropped += 1
+                continue
+            seen_prefixes.add(passage.prefix)
+            seen_bodies.add(passage.body)
+            texts.append(text)
+            used_tokens += tokens
+
+        context = self.render(texts)
+        report = PackingReport(
+            tokens_before=tokens_before,
+            tokens_after=self.count_tokens(context),
+            n_chunks=len(docs),
+            n_passages=len(passages),
+            n_merged=len(docs) - len(passages),
+            n_duplicates=n_duplicates,
+            n_dropped=n_dropped,
+        )
+        return context, report
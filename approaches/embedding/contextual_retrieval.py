@@ -82,6 +82,8 @@ def process_and_annotate_document(chunk: str, page_contents: str, model_config_p
         'chunk_content': chunk,
     }
     res = chain.invoke(input_message)
+    # 文脈と本文の区切りは "\n\n" なので、複数段落の文脈は空行を詰めて区切りと紛れないようにする (context_packer.split_contextual_prefix)
+    res = "\n".join(line for line in res.splitlines() if line.strip())
     return res + "\n\n" + chunk
 
 # COMMAND ----------
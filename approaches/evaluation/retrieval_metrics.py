@@ -0,0 +1,49 @@
+"""
+ベンチマーク用の検索指標
+
+eval-dataset.csv には正解チャンクの id がないため、期待回答 (expected_response) の文字 bigram が
+取得チャンクにどれだけ含まれているかで「回答に必要な情報を取れているか」を近似する。
+"""
+from typing import Hashable, Sequence
+
+import numpy as np
+
+from approaches.retrieval.lexical_index import char_ngrams
+
+
+def answer_coverage(contents: Sequence[str], expected_response: str) -> float:
+    """期待回答の文字 bigram のうち、取得チャンクのいずれかに含まれるものの割合"""
+    expected = set(char_ngrams(expected_response, (2,)))
+    if not expected:
+        return 0.0
+    retrieved = set()
+    for content in contents:
+        retrieved.update(char_ngrams(content, (2,)))
+    return len(expected & retrieved) / len(expected)
+
+
+def answer_recall(contents: Sequence[str], expected_response: str, threshold: float = 0.5) -> bool:
+    """answer_coverage が threshold 以上なら、回答に必要なチャンクを取れているとみなす"""
+    return answer_coverage(contents, expected_response) >= threshold
+
+
+def overlap_at_k(reference: Sequence[Hashable], candidate: Sequence[Hashable], k: int) -> float:
+    """reference の上位 k 件のうち、candidate の上位 k 件に含まれるものの割合"""
+    reference_top = set(reference[:k])
+    if not reference_top:
+        return 0.0
+    return len(reference_top & set(candidate[:k])) / len(reference_top)
+
+
+def latency_summary(latencies_s: Sequence[float]) -> dict:
+    """秒単位のレイテンシのリストから、ミリ秒の mean / p50 / p95 / p99 を返す"""
+    if not latencies_s:
+        return {"n": 0, "mean_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0}
+    ms = np.asarray(latencies_s) * 1000
+    return {
+        "n": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
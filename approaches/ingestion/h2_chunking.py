@@ -0,0 +1,90 @@
+"""
+H2 セクションをチャンクにまとめる (faq-chatbot.py の split_html_on_h2)
+
+以前の処理は H2 セクションを1つ足すたびに tokenizer.encode(previous_chunk + content) で
+ここまでのバッファ全体を encode し直していたので、ページの長さに対して2乗の時間がかかっていた。
+さらに、できたチャンクを min_chunk_size で絞り込むときにも、チャンクをもう一度1つずつ encode していた。
+
+H2Chunker は
+- セクションごとのトークン数を、fast tokenizer でまとめて (バッチで) 数える
+- バッファのトークン数はセクションのトークン数の累計で持ち、結合するかどうかの判定に使う
+- max_chunk_size に収まるバッファはそのまま1チャンクになるので、絞り込みにも累計を使う
+  (text_splitter で分けたチャンクだけ、まとめて数え直す)
+ようにして、各セクションを1回だけ encode する。
+セクションは "\\n" で区切ってつなげるので、つなげたテキストのトークン数はセクションのトークン数の和になる
+(openai-gpt のトークナイザーは空白で単語を区切ってから BPE をかけるため、空白をまたぐトークンはない)。
+"""
+from typing import Optional, Sequence
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+
+def token_counts(tokenizer, texts: Sequence[str]) -> list[int]:
+    """texts をまとめて encode したトークン数 (fast tokenizer なら Rust 側でバッチ処理される)"""
+    if not texts:
+        return []
+    return [len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+
+
+class H2Chunker:
+    def __init__(self, tokenizer, min_chunk_size: int = 20, max_chunk_size: int = 512, chunk_overlap: int = 50):
+        self.tokenizer = tokenizer
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            tokenizer, chunk_size=max_chunk_size, chunk_overlap=chunk_overlap
+        )
+
+    def _merge(self, sections: Sequence[Sequence[str]], counts: Sequence[int]) -> list[tuple[str, int]]:
+        """小さな H2 セクションを max_chunk_size/2 トークンまでまとめた (テキスト, トークン数) のリスト"""
+        buffers = []
+        previous_chunk = ""
+        previous_tokens = 0
+        # チャンクを結合し、h2の前にテキストを追加することでチャンクを結合し、小さすぎる文書を回避します
+        for (current_h2, page_content), n_tokens in zip(sections, counts):
+            content = current_h2 + "\n" + page_content
+            if previous_tokens + n_tokens <= self.max_chunk_size / 2:
+                previous_chunk += content + "\n"
+                previous_tokens += n_tokens
+            else:
+                buffers.append((previous_chunk.strip(), previous_tokens))
+                previous_chunk = content + "\n"
+                previous_tokens = n_tokens
+        if previous_chunk:
+            buffers.append((previous_chunk.strip(), previous_tokens))
+        return [(text, n_tokens) for text, n_tokens in buffers if text]
+
+    def chunk_pages(self, pages: Sequence[Sequence[Sequence[str]]]) -> list[list[dict]]:
+        """
+        pages: ページごとの (H2 の見出し, チャンク) のリスト。
+        ページごとに {"content", "page_contents"} のリストを返す。セクションのトークン数は全ページまとめて数える
+        """
+        contents = [current_h2 + "\n" + page_content for sections in pages for current_h2, page_content in sections]
+        counts = iter(token_counts(self.tokenizer, contents))
+        # ページごとの [(チャンク, トークン数 (分けたチャンクは None))]
+        page_chunks = []
+        for sections in pages:
+            chunks = []
+            for text, n_tokens in self._merge(sections, [next(counts) for _ in sections]):
+                if n_tokens <= self.max_chunk_size:
+                    # text_splitter にかけても text のまま1チャンクになる
+                    chunks.append((text, n_tokens))
+                else:
+                    chunks += [(chunk, None) for chunk in self.text_splitter.split_text(text)]
+            page_chunks.append(chunks)
+
+        # text_splitter で分けたチャンクのトークン数だけ、まとめて数える
+        recounted = iter(token_counts(self.tokenizer, [c for chunks in page_chunks for c, n in chunks if n is None]))
+        results = []
+        for sections, chunks in zip(pages, page_chunks):
+            page_contents = "".join(page_content for _, page_content in sections)
+            # 小さすぎるチャンクの破棄
+            results.append([
+                {"content": chunk, "page_contents": page_contents}
+                for chunk, n_tokens in chunks
+                if (n_tokens if n_tokens is not None else next(recounted)) > self.min_chunk_size
+            ])
+        return results
+
+    def chunk(self, sections: Sequence[Sequence[str]]) -> list[dict]:
+        return self.chunk_pages([sections])[0]
@@ -0,0 +1,61 @@
+"""
+コンテンツハッシュによる差分取り込み
+
+以前は html_raw_query / raw_query / rach_documentation を毎回 overwrite し、Delta Sync インデックスも作り直していたので、
+実行のたびに全チャンクの文脈付与 (LLM) と embedding がやり直しになっていた。
+ここではページとチャンクをハッシュし、
+- チャンクの ID を url とチャンク本文 (文脈付与前) のハッシュから決める (同じチャンクは毎回同じ ID になる)
+- テーブルは MERGE で、新しい・変わった行だけ upsert し、なくなった行 (サイトマップから消えたページの行も) は削除する
+ようにする。rach_documentation は Change Data Feed が有効なので、インデックスの sync では差分だけが embedding される。
+"""
+import hashlib
+from typing import Iterable, Optional
+
+# BIGINT (符号付き 64bit) に収まるように、sha256 の先頭 60bit を ID にする
+_CHUNK_ID_HEX_DIGITS = 15
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_id(url: str, chunk_hash: str) -> int:
+    """url とチャンクのハッシュから決まる ID。ページ内の位置によらないので、前後のチャンクが変わっても ID は変わらない"""
+    return int(hashlib.sha256(f"{url}|{chunk_hash}".encode("utf-8")).hexdigest()[:_CHUNK_ID_HEX_DIGITS], 16)
+
+
+def with_chunk_ids(records: Iterable[dict], content_key: str = "content") -> list[dict]:
+    """
+    records (url と文脈付与前の content を持つ dict) に chunk_hash と id を付ける。
+    同じページに同じ本文のチャンクが複数ある場合は、MERGE で重複しないように最初の1つだけ残す。
+    """
+    results = []
+    seen = set()
+    for record in records:
+        digest = content_hash(record[content_key])
+        id_ = chunk_id(record.get("url") or "", digest)
+        if id_ in seen:
+            continue
+        seen.add(id_)
+        results.append({**record, "chunk_hash": digest, "id": id_})
+    return results
+
+
+def merge_sql(target: str, source: str, key: str, compare_column: Optional[str] = None) -> str:
+    """
+    source (テーブルまたは一時ビュー) の内容に target を合わせる MERGE 文。
+    - key が target にない行は INSERT
+    - compare_column が変わった行は UPDATE (compare_column を省略すると、key が同じ行は更新しない)
+    - source にない行は DELETE。取得に失敗したページがあるときは、source を作る前に止めること
+      (source から抜けたページの行は削除される)
+    """
+    clauses = [
+        f"MERGE INTO {target} AS t",
+        f"USING {source} AS s",
+        f"ON t.{key} = s.{key}",
+    ]
+    if compare_column is not None:
+        clauses.append(f"WHEN MATCHED AND t.{compare_column} <> s.{compare_column} THEN UPDATE SET *")
+    clauses.append("WHEN NOT MATCHED THEN INSERT *")
+    clauses.append("WHEN NOT MATCHED BY SOURCE THEN DELETE")
+    return "\n".join(clauses)
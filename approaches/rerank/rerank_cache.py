@@ -0,0 +1,43 @@
+"""
+rerank 結果のキャッシュ
+
+キーは (NFKC 正規化した質問, ソートした候補 id, rerank モデル, top_n)。
+検索結果の並び順が変わっても同じ候補集合ならヒットするよう、結果は index ではなく id で保存し、
+取り出すときに今回の候補の index に戻す。保存先は MemoCache と同じメモリ LRU + sqlite。
+"""
+import hashlib
+import json
+from typing import Hashable, Optional, Sequence
+
+from approaches.cache.memo_cache import MemoCache
+from approaches.cache.semantic_cache import normalize_question
+from approaches.rerank.rerankers import RerankResult
+
+
+class RerankCache(MemoCache):
+    def __init__(self, model: str, **kwargs):
+        super().__init__(name="rerank", version=model, **kwargs)
+
+    def key(self, request: tuple[str, Sequence[Hashable], int]) -> str:
+        query, candidate_ids, top_n = request
+        raw = json.dumps(
+            [self.name, self.version, normalize_question(query), sorted(str(i) for i in candidate_ids), top_n],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def results_to_ids(results: Sequence[RerankResult], candidate_ids: Sequence[Hashable]) -> list[list]:
+    """rerank 結果の index を候補 id に置き換える (キャッシュに保存する形)"""
+    return [[candidate_ids[r.index], r.relevance_score] for r in results]
+
+
+def results_from_ids(value: list[list], candidate_ids: Sequence[Hashable]) -> Optional[list[RerankResult]]:
+    """キャッシュの値を今回の候補の index に戻す。候補に無い id があれば None"""
+    index_by_id = {candidate_id: index for index, candidate_id in enumerate(candidate_ids)}
+    results = []
+    for candidate_id, relevance_score in value:
+        if candidate_id not in index_by_id:
+            return None
+        results.append(RerankResult(index_by_id[candidate_id], relevance_score))
+    return results
@@ -0,0 +1,70 @@
+"""
+rerank のバックエンド
+
+どのバックエンドも rerank(query, documents, top_n) で、Cohere の rerank API と同じ
+(index, relevance_score) の結果を relevance_score の降順で返す。
+chain 側の apply_rerank_results はこの形だけに依存するので、バックエンドを設定で切り替えられる。
+"""
+from typing import NamedTuple
+
+import numpy as np
+
+
+class RerankResult(NamedTuple):
+    index: int
+    relevance_score: float
+
+
+class CohereReranker:
+    def __init__(self, client, async_client=None, model: str = "rerank-v3.5"):
+        self.client = client
+        self.async_client = async_client
+        self.model = model
+
+    @property
+    def name(self) -> str:
+        return f"cohere:{self.model}"
+
+    def rerank(self, query: str, documents: list[str], top_n: int = 5) -> list[RerankResult]:
+        response = self.client.rerank(query=query, documents=documents, top_n=top_n, model=self.model)
+        return [RerankResult(r.index, r.relevance_score) for r in response.results]
+
+    async def arerank(self, query: str, documents: list[str], top_n: int = 5) -> list[RerankResult]:
+        response = await self.async_client.rerank(query=query, documents=documents, top_n=top_n, model=self.model)
+        return [RerankResult(r.index, r.relevance_score) for r in response.results]
+
+
+class CrossEncoderReranker:
+    """
+    sentence-transformers の CrossEncoder を CPU で動かすローカル rerank。
+    Cohere の API キーなしで動くので、オフラインのベンチマークや API 障害時のフォールバックに使う。
+    """
+
+    def __init__(
+        self,
+        model_name: str = "hotchpotch/japanese-reranker-cross-encoder-small-v1",
+        max_length: int = 512,
+        batch_size: int = 32,
+        device: str = "cpu",
+    ):
+        # 任意依存なので、使うときだけ import する
+        from sentence_transformers import CrossEncoder
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = CrossEncoder(model_name, max_length=max_length, device=device)
+
+    @property
+    def name(self) -> str:
+        return f"cross-encoder:{self.model_name}"
+
+    def rerank(self, query: str, documents: list[str], top_n: int = 5) -> list[RerankResult]:
+        if not documents:
+            return []
+        # 出力が1ラベルのモデルは sigmoid 済みの [0, 1] のスコアが返る
+        scores = np.asarray(
+            self.model.predict([(query, document) for document in documents], batch_size=self.batch_size),
+            dtype=np.float32,
+        ).reshape(-1)
+        top = np.argsort(-scores, kind="stable")[:top_n]
+        return [RerankResult(int(i), float(scores[i])) for i in top]
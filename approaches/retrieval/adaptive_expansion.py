@@ -0,0 +1,58 @@
+"""
+適応的なクエリ拡張
+
+元の質問だけで検索した結果 (first pass) のスコアを見て、リライトと HyDE を行うかを決める。
+上位のスコアが十分に高く、かつ上位と下位の差 (margin) がはっきりしていれば first pass の結果だけで回答する。
+"""
+import threading
+from collections import Counter
+from typing import NamedTuple, Optional, Sequence
+
+
+class ExpansionDecision(NamedTuple):
+    escalate: bool
+    # "confident" / "no_docs" / "low_top_score" / "low_margin"
+    reason: str
+    top_score: Optional[float]
+    margin: Optional[float]
+
+
+def decide_expansion(
+    scores: Sequence[float],
+    min_top_score: float,
+    min_margin: float,
+    margin_rank: int = 5,
+) -> ExpansionDecision:
+    """
+    scores: first pass の検索スコア
+    margin は 1位と margin_rank 位のスコアの差 (件数が足りなければ最下位との差)。
+    1件しか取れなかった場合は、他に候補がないので margin は 1位のスコアそのものとする。
+    """
+    if not scores:
+        return ExpansionDecision(True, "no_docs", None, None)
+    ranked = sorted(scores, reverse=True)
+    top_score = ranked[0]
+    margin = top_score - ranked[min(margin_rank, len(ranked)) - 1] if len(ranked) > 1 else top_score
+    if top_score < min_top_score:
+        return ExpansionDecision(True, "low_top_score", top_score, margin)
+    if margin < min_margin:
+        return ExpansionDecision(True, "low_margin", top_score, margin)
+    return ExpansionDecision(False, "confident", top_score, margin)
+
+
+class PathCounter:
+    """リクエストがどの経路 (general / first_pass / expanded) を通ったかをプロセス全体で数える"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def record(self, path: str) -> None:
+        with self._lock:
+            self._counts[path] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        specific = counts.get("first_pass", 0) + counts.get("expanded", 0)
+        return {**counts, "escalation_rate": counts.get("expanded", 0) / specific if specific else 0.0}
@@ -0,0 +1,31 @@
+"""
+複数クエリをまとめて検索する retriever
+
+rewrite_question で作った8クエリを1件ずつ retriever.invoke すると、embedding と検索がクエリ数だけ往復する。
+vectorstore 側の batch_similarity_search_with_relevance_scores でまとめて embedding・検索し、
+結果をクエリごとに分けて返す。
+"""
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStoreRetriever
+
+
+class BatchVectorStoreRetriever(VectorStoreRetriever):
+    def invoke_many(self, queries: list[str]) -> list[list[Document]]:
+        """queries と同じ順番で、クエリごとの検索結果を返す"""
+        if not hasattr(self.vectorstore, "batch_similarity_search_with_relevance_scores"):
+            return [self.invoke(query) for query in queries]
+
+        search_kwargs = dict(self.search_kwargs)
+        k = search_kwargs.pop("k", 4)
+        score_threshold = search_kwargs.pop("score_threshold", None)
+        results = self.vectorstore.batch_similarity_search_with_relevance_scores(queries, k=k, **search_kwargs)
+
+        grouped = []
+        for docs_and_scores in results:
+            if self.search_type == "similarity_score_threshold" and score_threshold is not None:
+                docs_and_scores = [(doc, score) for doc, score in docs_and_scores if score >= score_threshold]
+            for doc, score in docs_and_scores:
+                # 類似度スコアを保存する
+                doc.metadata['score'] = score
+            grouped.append([doc for doc, _ in docs_and_scores])
+        return grouped
@@ -0,0 +1,57 @@
+"""
+複数のランキングを統合するための Reciprocal Rank Fusion (RRF)
+"""
+from collections import defaultdict
+from typing import Callable, Hashable, Optional, Sequence, TypeVar
+
+
+T = TypeVar("T")
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[Hashable]],
+    k: int = 60,
+    weights: Optional[Sequence[float]] = None,
+) -> list[tuple[Hashable, float]]:
+    """
+    rankings: 上位から順に並んだキーのリストのリスト
+    各キーのスコアは sum(weight / (k + rank)) (rank は1始まり)。スコアの降順で返す。
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores = defaultdict(float)
+    for ranking, weight in zip(rankings, weights):
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] += weight / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def fuse_rankings(
+    rankings: Sequence[Sequence[T]],
+    key: Callable[[T], Hashable],
+    k: int = 60,
+    max_candidates: Optional[int] = None,
+    weights: Optional[Sequence[float]] = None,
+) -> list[tuple[T, float]]:
+    """
+    要素のランキングを key で重複除去しながら RRF で統合し、(要素, RRFスコア) を降順で返す。
+    同じキーの要素は最初に現れたものを代表にし、1つのランキング内の重複は上位のものだけ数える。
+    max_candidates を渡すと上位 max_candidates 件に絞る。
+    """
+    representatives = {}
+    key_rankings = []
+    for ranking in rankings:
+        keys = []
+        seen = set()
+        for item in ranking:
+            item_key = key(item)
+            if item_key in seen:
+                continue
+            seen.add(item_key)
+            representatives.setdefault(item_key, item)
+            keys.append(item_key)
+        key_rankings.append(keys)
+
+    fused = reciprocal_rank_fusion(key_rankings, k=k, weights=weights)
+    if max_candidates is not None:
+        fused = fused[:max_candidates]
+    return [(representatives[item_key], score) for item_key, score in fused]
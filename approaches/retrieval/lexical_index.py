@@ -0,0 +1,89 @@
+"""
+日本語向けのローカル BM25 インデックス
+
+形態素解析器を入れずに済むよう、NFKC 正規化した文字列の文字 n-gram (デフォルトは 2-gram と 3-gram) をトークンとする。
+Vector Search の hybrid モードでエンドポイント側に任せているキーワード検索を、プロセス内で行うためのもの。
+"""
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Iterable, Optional
+
+import numpy as np
+
+
+# 記号・空白はトークンにしない (ひらがな・カタカナ・漢字・英数字のみ残す)
+_NON_WORD = re.compile(r"[^0-9a-z぀-ゟ゠-ヿ一-鿿㐀-䶿々ー]+")
+
+
+def char_ngrams(text: str, n_values: Iterable[int] = (2, 3)) -> list[str]:
+    """NFKC 正規化・小文字化した文字列を記号で区切り、区間ごとに文字 n-gram を作る"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for segment in _NON_WORD.split(text):
+        if not segment:
+            continue
+        for n in n_values:
+            if len(segment) < n:
+                # 区間が n より短い場合 (「AO」など) はそのままトークンにする
+                if n == min(n_values):
+                    tokens.append(segment)
+                continue
+            tokens.extend(segment[i:i + n] for i in range(len(segment) - n + 1))
+    return tokens
+
+
+class BM25Index:
+    def __init__(
+        self,
+        contents: list[str],
+        n_values: Iterable[int] = (2, 3),
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.n_values = tuple(n_values)
+        self.k1 = k1
+        self.b = b
+        self.n_docs = len(contents)
+
+        postings = defaultdict(list)
+        doc_lengths = np.zeros(self.n_docs, dtype=np.float32)
+        for row, content in enumerate(contents):
+            counts = Counter(char_ngrams(content, self.n_values))
+            doc_lengths[row] = sum(counts.values())
+            for token, tf in counts.items():
+                postings[token].append((row, tf))
+
+        avg_length = float(doc_lengths.mean()) if self.n_docs else 0.0
+        # 文書長による正規化項はクエリに依らないので、先に計算しておく
+        length_norm = self.k1 * (1 - self.b + self.b * doc_lengths / max(avg_length, 1e-9))
+        self._postings = {}
+        for token, items in postings.items():
+            rows = np.fromiter((row for row, _ in items), dtype=np.int32, count=len(items))
+            tf = np.fromiter((tf for _, tf in items), dtype=np.float32, count=len(items))
+            idf = math.log(1 + (self.n_docs - len(items) + 0.5) / (len(items) + 0.5))
+            # token ごとの BM25 の寄与を前計算しておけば、検索時は足し合わせるだけで済む
+            self._postings[token] = (rows, idf * tf * (self.k1 + 1) / (tf + length_norm[rows]))
+
+    def search(self, query: str, k: int = 20, rows: Optional[np.ndarray] = None) -> list[tuple[int, float]]:
+        """(行番号, BM25スコア) を降順で k 件返す。rows を渡すとその行だけを対象にする"""
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for token, query_tf in Counter(char_ngrams(query, self.n_values)).items():
+            posting = self._postings.get(token)
+            if posting is None:
+                continue
+            posting_rows, contribution = posting
+            np.add.at(scores, posting_rows, contribution * query_tf)
+
+        if rows is not None:
+            mask = np.zeros(self.n_docs, dtype=bool)
+            mask[rows] = True
+            scores[~mask] = 0.0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) == 0:
+            return []
+        k = min(k, len(candidates))
+        top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(int(row), float(scores[row])) for row in top]
@@ -0,0 +1,422 @@
+"""
+プロセス内で完結するベクトルインデックス
+
+rach_documentation (+ add-data.csv) は数千チャンク程度なので、embedding 行列をメモリに載せて
+NumPy の行列積で検索すれば、Vector Search エンドポイントへのネットワーク往復なしで検索できる。
+CustomDatabricksVectorSearch と同じ similarity_search_with_score を実装しているので、
+as_retriever(...) でそのまま chain に差し込める。
+
+スナップショットはインデックス作成時 (create-vector-db.py) に save() で書き出し、chain 側で load() する。
+"""
+import io
+import json
+import os
+from typing import Any, Callable, Iterable, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from approaches.retrieval.fusion import reciprocal_rank_fusion
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def cosine_to_score(cosine: np.ndarray) -> np.ndarray:
+    """
+    コサイン類似度を Databricks Vector Search の ANN スコア (1 / (1 + L2距離^2)) と同じ尺度に変換する。
+    正規化済みベクトルでは L2距離^2 = 2 - 2cos なので、score_threshold をそのまま流用できる。
+    """
+    cosine = np.clip(cosine, -1.0, 1.0)
+    return 1.0 / (1.0 + (2.0 - 2.0 * cosine))
+
+
+def train_ivf(embeddings: np.ndarray, n_lists: int, n_iter: int = 20, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """球面 k-means で IVF のセントロイドを学習し、(centroids, 各ベクトルの所属リスト) を返す"""
+    rng = np.random.default_rng(seed)
+    n_lists = max(1, min(n_lists, len(embeddings)))
+    centroids = embeddings[rng.choice(len(embeddings), n_lists, replace=False)].copy()
+    assignments = np.zeros(len(embeddings), dtype=np.int32)
+    for _ in range(n_iter):
+        assignments = np.argmax(embeddings @ centroids.T, axis=1).astype(np.int32)
+        for list_id in range(n_lists):
+            members = embeddings[assignments == list_id]
+            if len(members):
+                centroids[list_id] = members.mean(axis=0)
+        centroids = _normalize_rows(centroids)
+    return centroids, assignments
+
+
+def _open_snapshot(path: str):
+    """ローカル (クラスタの /Volumes など) になければ Files API から読む (モデルサービング用)"""
+    if os.path.exists(path):
+        return open(path, "rb")
+    from databricks.sdk import WorkspaceClient
+
+    return io.BytesIO(WorkspaceClient().files.download(path).contents.read())
+
+
+class LocalVectorIndex(VectorStore):
+    """
+    search_mode:
+        "exact": 全件との内積 (数千件なら 1ms 未満)
+        "ivf": セントロイドで候補リストを n_probe 個に絞ってから内積を取る近似検索
+
+    attach_lexical_index() で BM25 インデックスを付けると、query_type="hybrid" のときに
+    dense と BM25 の結果を RRF で統合する (Vector Search の hybrid モード相当)。
+    """
+
+    def __init__(
+        self,
+        ids: list,
+        contents: list[str],
+        urls: list[str],
+        embeddings: np.ndarray,
+        embedding: Embeddings,
+        search_mode: str = "exact",
+        n_probe: int = 8,
+        centroids: Optional[np.ndarray] = None,
+        assignments: Optional[np.ndarray] = None,
+        metadata: Optional[dict] = None,
+        chunk_hashes: Optional[list[str]] = None,
+    ):
+        self.ids = list(ids)
+        self.contents = list(contents)
+        self.urls = list(urls)
+        # 文脈付与前の本文のハッシュ。context_packer が文脈と本文を分けるのに使う (古いスナップショットにはない)
+        self.chunk_hashes = list(chunk_hashes) if chunk_hashes is not None else [""] * len(self.ids)
+        self.matrix = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        self.embedding = embedding
+        self.search_mode = search_mode
+        self.n_probe = n_probe
+        self.centroids = centroids
+        self.assignments = assignments
+        self.metadata = metadata or {}
+        self._lists = None
+        if centroids is not None and assignments is not None:
+            self._lists = [np.flatnonzero(assignments == i) for i in range(len(centroids))]
+        self.lexical_index = None
+        self.rrf_k = 60
+        self.hybrid_candidates = 50
+
+    def attach_lexical_index(self, lexical_index=None, rrf_k: int = 60, hybrid_candidates: int = 50) -> None:
+        """hybrid 検索用の BM25 インデックスを付ける。省略すると contents から作る"""
+        if lexical_index is None:
+            from approaches.retrieval.lexical_index import BM25Index
+
+            lexical_index = BM25Index(self.contents)
+        self.lexical_index = lexical_index
+        self.rrf_k = rrf_k
+        self.hybrid_candidates = hybrid_candidates
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    ############
+    # 検索
+    ############
+    def embed_query(self, query: str) -> np.ndarray:
+        return _normalize_rows(np.asarray(self.embedding.embed_query(query), dtype=np.float32))
+
+    def search_by_vector(
+        self, query_vector: np.ndarray, k: int, filter: Optional[dict[str, Any]] = None
+    ) -> list[tuple[int, float]]:
+        """(行番号, スコア) を降順で k 件返す"""
+        candidates = self._candidates(query_vector)
+        cosine = self.matrix[candidates] @ query_vector
+        if filter:
+            mask = np.array([self._match_filter(i, filter) for i in candidates], dtype=bool)
+            candidates, cosine = candidates[mask], cosine[mask]
+        if len(candidates) == 0:
+            return []
+        k = min(k, len(candidates))
+        top = np.argpartition(-cosine, k - 1)[:k]
+        top = top[np.argsort(-cosine[top])]
+        scores = cosine_to_score(cosine[top])
+        return [(int(candidates[i]), float(score)) for i, score in zip(top, scores)]
+
+    def batch_search_by_vectors(
+        self, query_matrix: np.ndarray, k: int, filter: Optional[dict[str, Any]] = None
+    ) -> list[list[tuple[int, float]]]:
+        """複数クエリの exact 検索を1回の行列積で行う。IVF やフィルタがある場合はクエリごとに検索する"""
+        if (self.search_mode == "ivf" and self._lists is not None) or filter:
+            return [self.search_by_vector(query_vector, k, filter) for query_vector in query_matrix]
+        if len(self.ids) == 0:
+            return [[] for _ in query_matrix]
+        cosine = query_matrix @ self.matrix.T
+        k = min(k, len(self.ids))
+        top = np.argpartition(-cosine, k - 1, axis=1)[:, :k]
+        results = []
+        for i in range(len(query_matrix)):
+            order = top[i][np.argsort(-cosine[i, top[i]])]
+            scores = cosine_to_score(cosine[i, order])
+            results.append([(int(row), float(score)) for row, score in zip(order, scores)])
+        return results
+
+    def hybrid_search(
+        self,
+        query: str,
+        k: int,
+        filter: Optional[dict[str, Any]] = None,
+        query_vector: Optional[np.ndarray] = None,
+        dense: Optional[list[tuple[int, float]]] = None,
+    ) -> list[tuple[int, float]]:
+        """
+        dense と BM25 の上位 hybrid_candidates 件ずつを RRF で統合する。
+        並び順は RRF で決め、スコアは dense の類似度 (cosine_to_score) を返す。
+        RRF スコアを正規化してスコアにすると、片方のリストにしかない文書は最大 0.5 になり、
+        score_threshold (0.7) でキーワード検索だけ・dense 検索だけのヒットがすべて落ちてしまうため。
+        dense の候補に入らなかった文書 (キーワード検索だけのヒット) も、クエリとの類似度を計算してスコアにする。
+        dense を渡すと dense 検索は行わずにその結果を使う (バッチ検索用)。
+        """
+        n_candidates = max(k, self.hybrid_candidates)
+        if query_vector is None:
+            query_vector = self.embed_query(query)
+        if dense is None:
+            dense = self.search_by_vector(query_vector, n_candidates, filter)
+        rows = None
+        if filter:
+            rows = np.array([i for i in range(len(self.ids)) if self._match_filter(i, filter)], dtype=np.int64)
+        lexical = self.lexical_index.search(query, n_candidates, rows)
+        fused = reciprocal_rank_fusion([[row for row, _ in dense], [row for row, _ in lexical]], k=self.rrf_k)
+        rows = [row for row, _ in fused[:k]]
+        scores = dict(dense)
+        missing = [row for row in rows if row not in scores]
+        if missing:
+            scores.update(zip(missing, cosine_to_score(self.matrix[missing] @ query_vector)))
+        return [(row, float(scores[row])) for row in rows]
+
+    def _candidates(self, query_vector: np.ndarray) -> np.ndarray:
+        if self.search_mode != "ivf" or self._lists is None:
+            return np.arange(len(self.ids))
+        n_probe = min(self.n_probe, len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ query_vector), n_probe - 1)[:n_probe]
+        return np.concatenate([self._lists[i] for i in probe])
+
+    def _match_filter(self, row: int, filter: dict[str, Any]) -> bool:
+        metadata = self._metadata(row)
+        for key, value in filter.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            if metadata.get(key) not in values:
+                return False
+        return True
+
+    def _metadata(self, row: int) -> dict:
+        metadata = {"id": self.ids[row], "url": self.urls[row]}
+        if self.chunk_hashes[row]:
+            metadata["chunk_hash"] = self.chunk_hashes[row]
+        return metadata
+
+    def _to_document(self, row: int) -> Document:
+        return Document(page_content=self.contents[row], metadata=self._metadata(row))
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[dict[str, Any]] = None,
+        *,
+        query_type: Optional[str] = None,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        """
+        CustomDatabricksVectorSearch.similarity_search_with_score と同じ形で返す。
+        query_type="hybrid" は BM25 インデックスが付いている場合のみ有効で、それ以外は dense 検索になる。
+        """
+        if query_type and query_type.lower() == "hybrid" and self.lexical_index is not None:
+            results = self.hybrid_search(query, k, filter)
+        else:
+            results = self.search_by_vector(self.embed_query(query), k, filter)
+        return [(self._to_document(row), score) for row, score in results]
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        docs_with_score = self.similarity_search_with_score(query, k, filter, **kwargs)
+        for doc, score in docs_with_score:
+            # 類似度スコアを保存する
+            doc.metadata['score'] = score
+        return [doc for doc, _ in docs_with_score]
+
+    def batch_similarity_search_with_score(
+        self,
+        queries: list[str],
+        k: int = 4,
+        filter: Optional[dict[str, Any]] = None,
+        *,
+        query_type: Optional[str] = None,
+        **kwargs: Any,
+    ) -> list[list[tuple[Document, float]]]:
+        """
+        queries をまとめて1回の embedding リクエストで埋め込み、1回の行列積で検索する。
+        結果は queries と同じ順番で、クエリごとのリストで返す。
+        """
+        if not queries:
+            return []
+        query_matrix = _normalize_rows(np.asarray(self.embedding.embed_documents(queries), dtype=np.float32))
+        use_hybrid = bool(query_type) and query_type.lower() == "hybrid" and self.lexical_index is not None
+        n_candidates = max(k, self.hybrid_candidates) if use_hybrid else k
+        dense_results = self.batch_search_by_vectors(query_matrix, n_candidates, filter)
+        if use_hybrid:
+            results = [
+                self.hybrid_search(query, k, filter, query_vector=query_vector, dense=dense)
+                for query, query_vector, dense in zip(queries, query_matrix, dense_results)
+            ]
+        else:
+            results = dense_results
+        return [[(self._to_document(row), score) for row, score in rows] for rows in results]
+
+    def batch_similarity_search_with_relevance_scores(
+        self,
+        queries: list[str],
+        k: int = 4,
+        **kwargs: Any,
+    ) -> list[list[tuple[Document, float]]]:
+        results = self.batch_similarity_search_with_score(queries, k, **kwargs)
+        for docs_and_scores in results:
+            for doc, score in docs_and_scores:
+                # 類似度スコアを保存する
+                doc.metadata['score'] = score
+        return results
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # スコアはすでに [0, 1] に収まっている
+        return lambda score: score
+
+    def _similarity_search_with_relevance_scores(
+        self,
+        query: str,
+        k: int = 4,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        docs_and_scores = self.similarity_search_with_score(query, k, **kwargs)
+        for doc, score in docs_and_scores:
+            # 類似度スコアを保存する
+            doc.metadata['score'] = score
+        return docs_and_scores
+
+    ############
+    # 作成・保存・読み込み
+    ############
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[list[dict]] = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = _normalize_rows(np.asarray(self.embedding.embed_documents(texts), dtype=np.float32))
+        ids = [m.get("id", len(self.ids) + i) for i, m in enumerate(metadatas)]
+        self.ids.extend(ids)
+        self.contents.extend(texts)
+        self.urls.extend(m.get("url", "") for m in metadatas)
+        self.chunk_hashes.extend(m.get("chunk_hash", "") for m in metadatas)
+        self.matrix = np.vstack([self.matrix, vectors]) if len(self.matrix) else vectors
+        # IVF は作り直しが必要なので、追加後は exact 検索に戻す
+        self.centroids, self.assignments, self._lists = None, None, None
+        return [str(i) for i in ids]
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: Optional[list[dict]] = None,
+        **kwargs: Any,
+    ) -> "LocalVectorIndex":
+        metadatas = metadatas or [{} for _ in texts]
+        return cls(
+            ids=[m.get("id", i) for i, m in enumerate(metadatas)],
+            contents=texts,
+            urls=[m.get("url", "") for m in metadatas],
+            chunk_hashes=[m.get("chunk_hash", "") for m in metadatas],
+            embeddings=np.asarray(embedding.embed_documents(texts), dtype=np.float32),
+            embedding=embedding,
+            **kwargs,
+        )
+
+    @classmethod
+    def from_texts_reusing(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: Optional[list[dict]] = None,
+        previous: Optional["LocalVectorIndex"] = None,
+        **kwargs: Any,
+    ) -> "LocalVectorIndex":
+        """from_texts と同じだが、previous に同じ id・同じ本文の行があればその embedding を使い、残りだけを埋め込む"""
+        metadatas = metadatas or [{} for _ in texts]
+        ids = [m.get("id", i) for i, m in enumerate(metadatas)]
+        previous_rows = {}
+        if previous is not None:
+            previous_rows = {(id_, content): row for row, (id_, content) in enumerate(zip(previous.ids, previous.contents))}
+        rows = [previous_rows.get((id_, text)) for id_, text in zip(ids, texts)]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        new_vectors = iter(embedding.embed_documents([texts[i] for i in missing]) if missing else [])
+        vectors = [previous.matrix[row] if row is not None else next(new_vectors) for row in rows]
+        return cls(
+            ids=ids,
+            contents=texts,
+            urls=[m.get("url", "") for m in metadatas],
+            chunk_hashes=[m.get("chunk_hash", "") for m in metadatas],
+            embeddings=np.asarray(vectors, dtype=np.float32),
+            embedding=embedding,
+            **kwargs,
+        )
+
+    def build_ivf(self, n_lists: Optional[int] = None, n_iter: int = 20) -> None:
+        """近似検索用のセントロイドを作る。n_lists を省略すると sqrt(件数) にする"""
+        n_lists = n_lists or max(1, int(np.sqrt(len(self.ids))))
+        self.centroids, self.assignments = train_ivf(self.matrix, n_lists, n_iter)
+        self._lists = [np.flatnonzero(self.assignments == i) for i in range(len(self.centroids))]
+
+    def save(self, path: str) -> None:
+        arrays = {
+            "embeddings": self.matrix,
+            "ids": np.asarray(self.ids),
+            "contents": np.asarray(self.contents, dtype=object),
+            "urls": np.asarray(self.urls, dtype=object),
+            "chunk_hashes": np.asarray(self.chunk_hashes, dtype=object),
+            "metadata": np.asarray(json.dumps(self.metadata, ensure_ascii=False)),
+        }
+        if self.centroids is not None:
+            arrays["centroids"] = self.centroids
+            arrays["assignments"] = self.assignments
+        # np.savez は拡張子 .npz を自動で付けるので、ファイルオブジェクト経由で書く
+        with open(path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        embedding: Embeddings,
+        search_mode: str = "exact",
+        n_probe: int = 8,
+    ) -> "LocalVectorIndex":
+        with _open_snapshot(path) as f:
+            data = np.load(f, allow_pickle=True)
+            return cls(
+                ids=data["ids"].tolist(),
+                contents=data["contents"].tolist(),
+                urls=data["urls"].tolist(),
+                embeddings=data["embeddings"],
+                embedding=embedding,
+                search_mode=search_mode,
+                n_probe=n_probe,
+                centroids=data["centroids"] if "centroids" in data else None,
+                assignments=data["assignments"] if "assignments" in data else None,
+                metadata=json.loads(str(data["metadata"])),
+                chunk_hashes=data["chunk_hashes"].tolist() if "chunk_hashes" in data else None,
+            )
@@ -0,0 +1,161 @@
+"""
+TECH.C. のページ取得用の並列クローラー
+
+faq-chatbot.py の抽出ループは1ページずつ get_soup (毎回 httpx.Client を作り直す) を呼び、
+0.5 秒ずつ sleep していたので、全ページの取得に数分かかっていた。
+AsyncCrawler は1つの httpx.AsyncClient (コネクションプール) を使い回し、
+- 同時リクエスト数を max_concurrency までに抑え
+- 同じホストへのリクエストの開始間隔を per_host_interval_s 以上あけ
+- タイムアウト (ReadTimeout など) はバックオフしながら max_retries 回までやり直す
+取得できたページから順に返すので、呼び出し側は残りのページを待たずに抽出を始められる。
+cache (HttpCache) を渡すと条件付き GET を送り、前回から変わっていないページは changed=False で返す。
+"""
+import asyncio
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterable, Iterator, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from approaches.scraping.http_cache import HttpCache
+
+DEFAULT_TIMEOUT = httpx.Timeout(5.0, read=10.0)
+
+
+@dataclass
+class CrawlResult:
+    url: str
+    status_code: Optional[int]
+    content: bytes
+    attempts: int
+    elapsed_s: float
+    error: Optional[str] = None
+    # 304 が返った・本文のハッシュが前回と同じ場合は False
+    changed: bool = True
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.status_code in (200, 304)
+
+
+class HostRateLimiter:
+    """ホストごとに、リクエストの開始間隔を min_interval_s 以上あける"""
+
+    def __init__(self, min_interval_s: float):
+        self.min_interval_s = min_interval_s
+        self._next_start: dict[str, float] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    async def wait(self, url: str) -> None:
+        if self.min_interval_s <= 0:
+            return
+        host = urlsplit(url).netloc
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start_at + self.min_interval_s
+        if start_at > now:
+            await asyncio.sleep(start_at - now)
+
+
+class AsyncCrawler:
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        per_host_interval_s: float = 0.1,
+        max_retries: int = 3,
+        backoff_s: float = 0.5,
+        timeout: httpx.Timeout = DEFAULT_TIMEOUT,
+        headers: Optional[dict] = None,
+        cache: Optional[HttpCache] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.per_host_interval_s = per_host_interval_s
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self.timeout = timeout
+        self.headers = headers
+        self.cache = cache
+
+    def _create_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        return httpx.AsyncClient(timeout=self.timeout, limits=limits, headers=self.headers, follow_redirects=True)
+
+    async def fetch(self, client: httpx.AsyncClient, url: str, rate_limiter: HostRateLimiter) -> CrawlResult:
+        """url を取得する。タイムアウトはバックオフ (backoff_s * 2^n 秒) してやり直し、それ以外のエラーは結果に入れて返す"""
+        started_at = time.perf_counter()
+        attempts = 0
+        while True:
+            attempts += 1
+            await rate_limiter.wait(url)
+            try:
+                headers = self.cache.conditional_headers(url) if self.cache is not None else None
+                response = await client.get(url, headers=headers)
+            except httpx.TimeoutException as e:
+                if attempts > self.max_retries:
+                    return CrawlResult(url, None, b"", attempts, time.perf_counter() - started_at, error=repr(e))
+                await asyncio.sleep(self.backoff_s * 2 ** (attempts - 1))
+                continue
+            except httpx.HTTPError as e:
+                return CrawlResult(url, None, b"", attempts, time.perf_counter() - started_at, error=repr(e))
+            elapsed_s = time.perf_counter() - started_at
+            if response.status_code not in (200, 304):
+                return CrawlResult(url, response.status_code, b"", attempts, elapsed_s, f"HTTP {response.status_code}")
+            if self.cache is None:
+                return CrawlResult(url, response.status_code, response.content, attempts, elapsed_s)
+            page = self.cache.update(url, response.status_code, response.headers, response.content)
+            return CrawlResult(url, response.status_code, page.content, attempts, elapsed_s, changed=page.changed)
+
+    async def crawl(self, urls: Iterable[str]) -> AsyncIterator[CrawlResult]:
+        """urls を並列に取得し、取得し終わった順に CrawlResult を返す"""
+        rate_limiter = HostRateLimiter(self.per_host_interval_s)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self._create_client() as client:
+            async def bounded_fetch(url: str) -> CrawlResult:
+                async with semaphore:
+                    return await self.fetch(client, url, rate_limiter)
+
+            tasks = [asyncio.ensure_future(bounded_fetch(url)) for url in urls]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    yield await task
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    def iter_crawl(self, urls: Iterable[str]) -> Iterator[CrawlResult]:
+        """
+        crawl の同期版。Databricks のノートブックではイベントループが既に動いていて asyncio.run を使えないので、
+        別スレッドで crawl を回し、取得できた結果から順に返す。
+        """
+        results: "queue.Queue" = queue.Queue()
+        done = object()
+        urls = list(urls)
+
+        async def produce():
+            async for result in self.crawl(urls):
+                results.put(result)
+
+        def run():
+            try:
+                asyncio.run(produce())
+            except BaseException as e:
+                results.put(e)
+            finally:
+                results.put(done)
+
+        thread = threading.Thread(target=run, name="rach-crawler", daemon=True)
+        thread.start()
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+        thread.join()
@@ -0,0 +1,315 @@
+"""
+TECH.C. のページから記事部分を取り出し、H2 ごとのセクションに分ける
+
+以前の処理 (extract_article_bs4 + HTMLHeaderTextSplitter) は
+1. BeautifulSoup (pure Python の html.parser) でページをパースし、CSS セレクタで不要なタグを decompose する
+2. 記事部分を文字列に戻し、HTMLHeaderTextSplitter が lxml + XSLT でもう一度パースして H2 ごとに分ける
+と、1ページを2回パースしていた。
+extract_page は lxml で1回だけパースし、1回の木の走査で不要なタグの除去と H2 セクションの分割を同時に行う。
+セクションの分け方は HTMLHeaderTextSplitter(headers_to_split_on=[("h2", "header2")]) の XSLT と同じ:
+- div / p / blockquote / ol / ul ごとに、(入れ子の div などを除いた) テキストを normalize-space したものをチャンクにする
+- チャンクの見出しは、自分と各祖先の「直前の兄弟にある見出し」をたどって決める
+- 見出しが同じチャンクが続く場合は "  \\n" でつなげる
+"""
+import re
+from dataclasses import dataclass
+from typing import Callable, Optional, Union
+
+from lxml import html as lxml_html
+
+# 記事部分から取り除くタグ
+REMOVE_TAG_SELECTORS = [
+    ".c-lower_links",  # リンク集
+    ".p-course_opencampus",  # OpenCampus情報
+    "#opencampus",  # OpenCampus情報
+    ".p-course_major",  # 専攻一覧
+    ".p-world_links",  # 専攻リンク
+    ".c-cta01_sm",  # 資料請求とopemcampus
+    ".p-work_books_article__body > .p-work_books__opencampus",  # workbook内のopemcampus情報
+    ".c-admission_cta",  # パンフレット
+]
+
+ARTICLE_SELECTOR = "#page > main > article"
+DIFFERENT_URL = "https://www.tech.ac.jp/features/different/"
+STRENGTHS_URL = "https://www.tech.ac.jp/features/strengths/"
+MYSCHOOL_URL = "https://www.tech.ac.jp/myschool/"
+WEBOPENCAMPUS_URL = "https://www.tech.ac.jp/web_opencampus/"
+
+_TAGS_OF_INTEREST = {"div", "p", "blockquote", "ol", "ul"}
+_NON_CONTENT_TAGS = {"script", "style"}
+_HEADING_LEVELS = {f"h{i}": i for i in range(1, 7)}
+# XSLT の normalize-space が空白とみなすのは XML の空白 (全角スペースや &nbsp; は残す)
+_XML_SPACE = re.compile(r"[ \t\r\n]+")
+
+
+@dataclass
+class ExtractedPage:
+    # 記事部分の HTML (不要なタグを除いたもの)
+    html: str
+    # (H2 の見出し, チャンク) のリスト。HTMLHeaderTextSplitter の (metadata.get("header2", ""), page_content) と同じ
+    sections: list[tuple[str, str]]
+
+
+############
+# BeautifulSoup 版 (以前の faq-chatbot.py の処理)
+############
+def extract_page_different(soup):
+    # main tagがない
+    article_html = soup.select("#page > .l-contents > .l-main > article")[0]
+    article_html.select(".p-different_course")[0].decompose()
+    article_html.select(".p-different_opencampus")[0].decompose()
+    return article_html
+
+
+def extract_page_strengths(soup):
+    # main tagがない
+    return soup.select("#page > .l-contents > .l-main > article")[0]
+
+
+def extract_page_myschool(soup) -> str:
+    # article tagがない
+    opencampus_leading = soup.select("#page > main > .p-opencampus_leading")[0]
+    myschool_point = soup.select("#page > main > .p-myschool_point")[0]
+    return str(opencampus_leading) + str(myschool_point)
+
+
+def extract_page_webopencampus(soup) -> str:
+    # article tagがない
+    opencampus_leading = soup.select("#page > main > .p-opencampus_leading")[0]
+    web_opencampus_step = soup.select("#page > main > .c-common_section")[0]
+    return str(opencampus_leading) + str(web_opencampus_step)
+
+
+def extract_article_bs4(url: str, soup) -> Optional[str]:
+    try:
+        article_html = soup.select(ARTICLE_SELECTOR)[0]
+        for tag in article_html.select(", ".join(REMOVE_TAG_SELECTORS)):
+            tag.decompose()
+    except Exception:
+        # 個別処理
+        print("個別処理 url:", url)
+        if url == DIFFERENT_URL:
+            article_html = extract_page_different(soup)
+        elif url == STRENGTHS_URL:
+            article_html = extract_page_strengths(soup)
+        elif url == MYSCHOOL_URL:
+            article_html = extract_page_myschool(soup)
+        elif url == WEBOPENCAMPUS_URL:
+            article_html = extract_page_webopencampus(soup)
+        else:
+            print("error in url:", url)
+            return None
+    return str(article_html)
+
+
+############
+# lxml 版
+############
+def _simple_matcher(selector: str) -> Callable:
+    """"tag" / ".class" / "#id" だけに対応した CSS セレクタ"""
+    if selector.startswith("#"):
+        return lambda el: el.get("id") == selector[1:]
+    if selector.startswith("."):
+        return lambda el: selector[1:] in (el.get("class") or "").split()
+    return lambda el: el.tag == selector
+
+
+def _simple_xpath(selector: str) -> str:
+    if selector.startswith("#"):
+        return f"*[@id='{selector[1:]}']"
+    if selector.startswith("."):
+        return f"*[contains(concat(' ', normalize-space(@class), ' '), ' {selector[1:]} ')]"
+    return selector
+
+
+def compile_selector(selector: str) -> Callable:
+    """".a > .b" のような子結合子つきのセレクタを、要素を受け取って一致するかを返す関数にする"""
+    matchers = [_simple_matcher(part.strip()) for part in selector.split(">")]
+
+    def match(el) -> bool:
+        for matcher in reversed(matchers):
+            if el is None or not matcher(el):
+                return False
+            el = el.getparent()
+        return True
+
+    return match
+
+
+def _select_first(document, selector: str):
+    """compile_selector と同じ記法のセレクタで、文書順で最初に一致する要素 (XPath に変換して探す)"""
+    xpath = "//" + "/".join(_simple_xpath(part.strip()) for part in selector.split(">"))
+    found = document.xpath(xpath)
+    return found[0] if found else None
+
+
+_remove_default = [compile_selector(selector) for selector in REMOVE_TAG_SELECTORS]
+
+
+def _remove_all(selectors: list[Callable]) -> Callable:
+    return lambda el: any(match(el) for match in selectors)
+
+
+def _remove_first_of_each(selectors: list[str]) -> Callable:
+    """セレクタごとに、文書順で最初に一致した要素だけを取り除く"""
+    remaining = {selector: compile_selector(selector) for selector in selectors}
+
+    def remove(el) -> bool:
+        for selector, match in list(remaining.items()):
+            if match(el):
+                del remaining[selector]
+                return True
+        return False
+
+    return remove
+
+
+def _normalize_space(text: str) -> str:
+    return _XML_SPACE.sub(" ", text).strip(" ")
+
+
+# 見出しの要約 (空でない見出しがあるか, 最後の H2 の見出し)。H2 以外の見出しは、空かどうかだけが結果に効く
+_NO_HEADINGS = (False, None)
+
+
+def _combine(first: tuple, second: tuple) -> tuple:
+    return (first[0] or second[0], second[1] if second[1] is not None else first[1])
+
+
+def _heading_summary(el) -> tuple:
+    text = _normalize_space("".join(el.itertext()))
+    return (text != "", text if el.tag == "h2" else None)
+
+
+def _header_summary(el) -> tuple:
+    summary = _NO_HEADINGS
+    for child in el:
+        if isinstance(child.tag, str) and child.tag in _HEADING_LEVELS:
+            summary = _combine(summary, _heading_summary(child))
+    return summary
+
+
+def _advance(state: list, el) -> list:
+    """
+    兄弟要素 el を通り過ぎたあとの state を返す。
+    state[m] は「直前の兄弟からさかのぼって、レベル m 以下の見出しを集めた結果」(XSLT の headingsWithPriorSiblings)
+    """
+    level = _HEADING_LEVELS.get(el.tag)
+    if level is not None:
+        summary = _heading_summary(el)
+        return [_combine(state[level - 1], summary) if level <= m else state[m] for m in range(7)]
+    if el.tag == "header":
+        return [_header_summary(el)] * 7
+    return state
+
+
+class _SectionWalker:
+    def __init__(self, remove: Optional[Callable] = None):
+        self.remove = remove
+        self.removed = []
+        # 文書順の (見出しの要約, テキストの断片) 。div などの要素ごとに1つ
+        self.chunks: list[tuple[tuple, list[str]]] = []
+
+    def walk_siblings(self, elements, headings: tuple, buffer: Optional[list], suppressed: bool, with_tail: bool) -> None:
+        state = [_NO_HEADINGS] * 7
+        for el in elements:
+            if not isinstance(el.tag, str):
+                # コメントなど。後ろのテキストだけ使う
+                pass
+            elif self.remove is not None and self.remove(el):
+                self.removed.append(el)
+            else:
+                self.visit(el, _combine(headings, state[6]), buffer, suppressed)
+                state = _advance(state, el)
+            if with_tail and el.tail and buffer is not None and not suppressed:
+                buffer.append(el.tail)
+
+    def visit(self, el, headings: tuple, buffer: Optional[list], suppressed: bool) -> None:
+        if el.tag in _TAGS_OF_INTEREST:
+            buffer = []
+            suppressed = False
+            self.chunks.append((headings, buffer))
+        elif el.tag in _NON_CONTENT_TAGS:
+            suppressed = True
+        if el.text and buffer is not None and not suppressed:
+            buffer.append(el.text)
+        self.walk_siblings(el, headings, buffer, suppressed, with_tail=True)
+
+    def sections(self) -> list[tuple[str, str]]:
+        aggregated: list[list] = []
+        for (has_headings, header2), buffer in self.chunks:
+            content = _normalize_space("".join(buffer))
+            if not content:
+                continue
+            # 空でない見出しが1つもなければ metadata は {} になる。{} と {"header2": ""} は別の metadata として扱う
+            metadata = (header2,) if has_headings and header2 is not None else ()
+            if aggregated and aggregated[-1][0] == metadata:
+                aggregated[-1][1] += "  \n" + content
+            else:
+                aggregated.append([metadata, content])
+        return [(metadata[0] if metadata else "", content) for metadata, content in aggregated]
+
+
+def _split(roots: list, remove: Optional[Callable]) -> tuple[list[tuple[str, str]], list]:
+    walker = _SectionWalker(remove)
+    # roots は1つの body の直下に並んでいるものとして扱う (HTMLHeaderTextSplitter が文字列をパースし直したときと同じ)
+    walker.walk_siblings(roots, _NO_HEADINGS, None, False, with_tail=False)
+    return walker.sections(), walker.removed
+
+
+def _to_html(roots: list) -> str:
+    return "".join(lxml_html.tostring(root, encoding="unicode", with_tail=False) for root in roots)
+
+
+def parse_document(content: Union[bytes, str], encoding: str = "utf-8"):
+    if isinstance(content, bytes):
+        return lxml_html.document_fromstring(content, parser=lxml_html.HTMLParser(encoding=encoding))
+    return lxml_html.document_fromstring(content)
+
+
+def _article_layout(document, url: str):
+    """(記事部分の要素のリスト, 取り除くタグの判定) 。記事部分が見つからなければ None"""
+    article = _select_first(document, ARTICLE_SELECTOR)
+    if article is not None:
+        return [article], _remove_all(_remove_default)
+
+    # 個別処理
+    print("個別処理 url:", url)
+    if url in (DIFFERENT_URL, STRENGTHS_URL):
+        # main tagがない
+        article = _select_first(document, "#page > .l-contents > .l-main > article")
+        if article is None:
+            return None
+        if url == DIFFERENT_URL:
+            return [article], _remove_first_of_each([".p-different_course", ".p-different_opencampus"])
+        return [article], None
+    if url in (MYSCHOOL_URL, WEBOPENCAMPUS_URL):
+        # article tagがない
+        second_selector = "#page > main > .p-myschool_point" if url == MYSCHOOL_URL else "#page > main > .c-common_section"
+        roots = [_select_first(document, "#page > main > .p-opencampus_leading"), _select_first(document, second_selector)]
+        return (roots, None) if all(root is not None for root in roots) else None
+    return None
+
+
+def extract_page(url: str, content: Union[bytes, str], encoding: str = "utf-8") -> Optional[ExtractedPage]:
+    """
+    ページを1回だけパースし、記事部分の HTML と H2 セクションを返す。記事部分が見つからなければ None。
+    結果は extract_article_bs4 + HTMLHeaderTextSplitter と同じになる (benchmarks/html_extraction.py で確認)
+    """
+    layout = _article_layout(parse_document(content, encoding), url)
+    if layout is None:
+        print("error in url:", url)
+        return None
+    roots, remove = layout
+    sections, removed = _split(roots, remove)
+    for el in removed:
+        el.drop_tree()
+    return ExtractedPage(html=_to_html(roots), sections=sections)
+
+
+def split_h2_sections(html: str) -> list[tuple[str, str]]:
+    """保存済みの記事 HTML を H2 セクションに分ける (HTMLHeaderTextSplitter と同じ結果を、XSLT なしで作る)"""
+    if not html:
+        return []
+    sections, _ = _split([parse_document(html)], None)
+    return sections
@@ -0,0 +1,98 @@
+"""
+再クロール用の HTTP レスポンスキャッシュ (sqlite)
+
+faq-chatbot.py は実行のたびに全ページをダウンロードし直していたが、ほとんどのページは変わらない。
+HttpCache は URL ごとに ETag / Last-Modified と本文、本文のハッシュを保存しておき、
+- 次回は If-None-Match / If-Modified-Since をつけた条件付き GET を送る
+- 304 が返ったら保存しておいた本文を使う
+- 200 でも本文のハッシュが前回と同じなら「変わっていない」とする
+変わっていないページは、チャンク分割・文脈付与などの後段の処理をスキップできる。
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Mapping, Optional
+
+NEW = "new"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+NOT_MODIFIED = "not_modified"
+
+
+@dataclass
+class CachedPage:
+    content: bytes
+    # NEW / CHANGED / UNCHANGED (200 だが本文が同じ) / NOT_MODIFIED (304)
+    status: str
+
+    @property
+    def changed(self) -> bool:
+        return self.status in (NEW, CHANGED)
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class HttpCache:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stats = {NEW: 0, CHANGED: 0, UNCHANGED: 0, NOT_MODIFIED: 0}
+        # 並列クローラーは別スレッドのイベントループから使う
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT, content BLOB, fetched_at REAL)"
+        )
+        self._db.commit()
+
+    def _get(self, url: str) -> Optional[tuple]:
+        with self._lock:
+            return self._db.execute(
+                "SELECT etag, last_modified, content_hash, content FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+
+    def conditional_headers(self, url: str) -> dict:
+        """前回の ETag / Last-Modified から、条件付き GET のヘッダーを作る。キャッシュがなければ空"""
+        row = self._get(url)
+        if row is None:
+            return {}
+        etag, last_modified, _, _ = row
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def update(self, url: str, status_code: int, headers: Mapping[str, str], content: bytes) -> CachedPage:
+        """
+        条件付き GET のレスポンスを反映して、使う本文と前回からの変化を返す。
+        304 なら保存しておいた本文を、200 なら受け取った本文を保存して返す。
+        """
+        row = self._get(url)
+        if status_code == 304 and row is not None:
+            page = CachedPage(row[3], NOT_MODIFIED)
+        else:
+            digest = content_hash(content)
+            if row is None:
+                status = NEW
+            else:
+                status = UNCHANGED if row[2] == digest else CHANGED
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, headers.get("etag"), headers.get("last-modified"), digest, content, time.time()),
+                )
+                self._db.commit()
+            page = CachedPage(content, status)
+        with self._lock:
+            self._stats[page.status] += 1
+        return page
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,135 @@
+"""
+外部依存 (Cohere rerank・mini LLM のエンドポイント) のサーキットブレーカー
+
+依存先が落ちたり遅くなったりすると、リクエストごとにエラーやタイムアウトまで待たされる。
+CircuitBreaker は失敗 (例外・slow_call_s を超えた呼び出し) が failure_threshold 回続いたら open になり、
+reset_timeout_s の間は依存先を呼ばずに CircuitOpenError を送出する (呼び出し側はフォールバックに切り替える)。
+reset_timeout_s が過ぎたら half_open になって1回だけ試し、成功すれば closed に戻る。
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """ブレーカーが open のため、依存先を呼ばなかった"""
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout_s: float = 30.0,
+        slow_call_s: Optional[float] = None,
+        enabled: bool = True,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.slow_call_s = slow_call_s
+        self.enabled = enabled
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._consecutive_failures = 0
+        self._counts = {"calls": 0, "failures": 0, "slow_calls": 0, "short_circuited": 0, "times_opened": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout_s:
+            self._state = HALF_OPEN
+        return self._state
+
+    def _acquire(self) -> bool:
+        """依存先を呼んでよいか。half_open の間は試しの1回だけ通す"""
+        with self._lock:
+            if not self.enabled:
+                self._counts["calls"] += 1
+                return False
+            state = self._current_state()
+            if state == OPEN or (state == HALF_OPEN and self._probe_in_flight):
+                self._counts["short_circuited"] += 1
+                raise CircuitOpenError(f"circuit breaker '{self.name}' is open")
+            self._counts["calls"] += 1
+            if state == HALF_OPEN:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def _record(self, elapsed_s: Optional[float], probe: bool) -> None:
+        """elapsed_s が None なら例外で終わった呼び出し"""
+        slow = elapsed_s is not None and self.slow_call_s is not None and elapsed_s > self.slow_call_s
+        with self._lock:
+            if probe:
+                self._probe_in_flight = False
+            if elapsed_s is None or slow:
+                self._counts["failures"] += 1
+                self._counts["slow_calls"] += slow
+                self._consecutive_failures += 1
+                if self.enabled and (probe or self._consecutive_failures >= self.failure_threshold):
+                    if self._state != OPEN:
+                        self._counts["times_opened"] += 1
+                    self._state = OPEN
+                    self._opened_at = self._clock()
+            else:
+                self._consecutive_failures = 0
+                if probe:
+                    self._state = CLOSED
+
+    def _release(self, probe: bool) -> None:
+        """失敗とも成功とも数えずに終わった呼び出し (キャンセル)"""
+        if probe:
+            with self._lock:
+                self._probe_in_flight = False
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        fn(*args, **kwargs) を呼ぶ。open の間は呼ばずに CircuitOpenError を送出する。
+        fn の例外は失敗として数えてからそのまま送出する。遅かった呼び出しは失敗として数えるが、結果は返す。
+        """
+        probe = self._acquire()
+        started_at = self._clock()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self._record(None, probe)
+            raise
+        self._record(self._clock() - started_at, probe)
+        return result
+
+    async def acall(self, afn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """call の async 版"""
+        probe = self._acquire()
+        started_at = self._clock()
+        try:
+            result = await afn(*args, **kwargs)
+        except asyncio.CancelledError:
+            # 一般質問と判定されて検索をやめた場合など、依存先の失敗ではない
+            self._release(probe)
+            raise
+        except Exception:
+            self._record(None, probe)
+            raise
+        self._record(self._clock() - started_at, probe)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self._current_state() if self.enabled else "disabled",
+                "consecutive_failures": self._consecutive_failures,
+                **self._counts,
+            }
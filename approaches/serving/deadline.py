@@ -0,0 +1,136 @@
+"""
+リクエストの期限 (deadline)・ステージごとのタイムアウト・ヘッジリクエスト
+
+1つの検索が遅いだけでリクエスト全体が待たされないように、
+- リクエストごとに期限を決め (contextvars で shared_executor やタスクにも引き継ぐ)
+- 各ステージは「ステージのタイムアウト」と「期限までの残り時間」の短い方だけ待ち、間に合った結果だけで先に進む
+- 検索が p95 を超えても返ってこない場合は、同じ検索をもう1回投げて先に返った方を使う (ヘッジ)
+"""
+import contextvars
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from contextlib import contextmanager
+from typing import Any, Callable, Optional, Sequence
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+_current_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar(
+    "request_deadline", default=None
+)
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]):
+    """このブロック内の stage_budget が seconds 後の期限を使うようにする。None なら期限なし"""
+    previous = _current_deadline.get()
+    deadline = Deadline(seconds) if seconds is not None else None
+    _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        # generator の中で使われても動くように、reset(token) ではなく元の値を set し直す
+        _current_deadline.set(previous)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+def stage_budget(stage_timeout: Optional[float]) -> Optional[float]:
+    """ステージが待てる秒数。ステージのタイムアウトと期限までの残り時間の短い方で、どちらもなければ None (無制限)"""
+    deadline = _current_deadline.get()
+    budgets = [b for b in (stage_timeout, deadline.remaining() if deadline else None) if b is not None]
+    return min(budgets) if budgets else None
+
+
+class DeadlineMetrics:
+    """タイムアウトで結果を捨てた回数と、ヘッジの回数 (ヘッジ側が先に返った回数) をステージごとに数える"""
+
+    def __init__(self, on_timeout: Optional[Callable[[str], None]] = None):
+        # on_timeout(stage) はタイムアウトで結果を捨てたときに、呼び出し元のスレッドで呼ばれる
+        self.on_timeout = on_timeout
+        self._lock = threading.Lock()
+        self._counts: dict[str, dict[str, int]] = {}
+
+    def add(self, stage: str, **counts: int) -> None:
+        with self._lock:
+            stage_counts = self._counts.setdefault(stage, {"calls": 0, "timed_out": 0, "hedged": 0, "hedge_wins": 0})
+            for key, value in counts.items():
+                stage_counts[key] += value
+        if counts.get("timed_out") and self.on_timeout is not None:
+            self.on_timeout(stage)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {stage: dict(counts) for stage, counts in self._counts.items()}
+
+
+def gather_within(
+    submit: Callable[..., Future],
+    calls: Sequence[tuple],
+    timeout: Optional[float],
+    hedge_after: Optional[float] = None,
+    metrics: Optional[DeadlineMetrics] = None,
+    stage: str = "",
+) -> list[Any]:
+    """
+    calls の各引数で submit(*args) し、calls と同じ順番で結果を返す。
+    timeout 秒までに返らなかったものは None にする (実行中の処理は止められないので結果を捨てる)。
+    hedge_after 秒たっても返らないものは同じ引数でもう1回 submit し、先に返った方を使う。
+    どの試行も例外で終わった場合は、その例外を送出する。
+    """
+    started_at = time.monotonic()
+    attempts: list[list[Future]] = [[submit(*args)] for args in calls]
+    n_hedged = 0
+
+    def settled(futures: list[Future]) -> bool:
+        # 成功した試行があるか、すべての試行が終わっている
+        return any(f.done() and f.exception() is None for f in futures) or all(f.done() for f in futures)
+
+    def remaining() -> Optional[float]:
+        return None if timeout is None else max(timeout - (time.monotonic() - started_at), 0.0)
+
+    if hedge_after is not None and (timeout is None or hedge_after < timeout):
+        wait([futures[0] for futures in attempts], timeout=hedge_after)
+        for args, futures in zip(calls, attempts):
+            if not futures[0].done():
+                futures.append(submit(*args))
+                n_hedged += 1
+
+    while True:
+        unsettled = [f for futures in attempts if not settled(futures) for f in futures if not f.done()]
+        if not unsettled or remaining() == 0.0:
+            break
+        wait(unsettled, timeout=remaining(), return_when=FIRST_COMPLETED)
+
+    results = []
+    n_timed_out = 0
+    n_hedge_wins = 0
+    for futures in attempts:
+        succeeded = [f for f in futures if f.done() and f.exception() is None]
+        if succeeded:
+            results.append(succeeded[0].result())
+            n_hedge_wins += succeeded[0] is not futures[0]
+        elif all(f.done() for f in futures):
+            raise futures[0].exception()
+        else:
+            results.append(None)
+            n_timed_out += 1
+            for future in futures:
+                future.cancel()
+
+    if metrics is not None:
+        metrics.add(stage, calls=len(calls), timed_out=n_timed_out, hedged=n_hedged, hedge_wins=n_hedge_wins)
+    return results
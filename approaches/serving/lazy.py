@@ -0,0 +1,122 @@
+"""
+chain が使うクライアントの遅延初期化と warmup
+
+scale_to_zero のエンドポイントでは、コンテナが起動するたびに chain_langchain.py の import が走る。
+import 時に Vector Search の get_index (API 呼び出し)・LLM クライアント・Cohere クライアント・cross-encoder の
+読み込みを1つずつ行うと、その合計が最初のリクエストのレイテンシに乗る。
+
+ここでは各リソースを最初に使うときに作る Lazy と、それを chain に組み込むための
+LazyRunnable / LazyRetriever、全リソースを並列に初期化する warmup を用意する。
+"""
+import threading
+import time
+from concurrent.futures import Executor, wait
+from typing import Any, AsyncIterator, Callable, Generic, Iterable, Iterator, Optional, TypeVar
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable, RunnableConfig
+
+T = TypeVar("T")
+
+
+class Lazy(Generic[T]):
+    """factory() の結果を最初の get() で作って使い回す。同時に get() されても factory は1回だけ呼ばれる"""
+
+    def __init__(self, factory: Callable[[], T], name: str):
+        self.factory = factory
+        self.name = name
+        self.init_seconds: Optional[float] = None
+        self._value: Optional[T] = None
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    @property
+    def initialized(self) -> bool:
+        return self._initialized
+
+    def get(self) -> T:
+        if self._initialized:
+            return self._value
+        # 初期化中に来た呼び出しは、2回目の初期化をせずに完了を待つ。失敗した場合は次の get() で作り直す
+        with self._lock:
+            if not self._initialized:
+                started_at = time.perf_counter()
+                self._value = self.factory()
+                self.init_seconds = time.perf_counter() - started_at
+                self._initialized = True
+        return self._value
+
+
+class LazyRunnable(Runnable):
+    """
+    resource.get() で作った Runnable (ChatDatabricks など) にそのまま委譲する Runnable。
+    自身はトレースの span を作らないので、トレースの見た目は委譲先を直接つないだ場合と変わらない。
+    attributes には、作る前から参照したい属性 (prompt_version が読む endpoint / extra_params など) を渡す。
+    """
+
+    def __init__(self, resource: Lazy, **attributes: Any):
+        self.resource = resource
+        self.name = resource.name
+        for key, value in attributes.items():
+            setattr(self, key, value)
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return self.resource.get().invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return await self.resource.get().ainvoke(input, config, **kwargs)
+
+    def stream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        yield from self.resource.get().stream(input, config, **kwargs)
+
+    async def astream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[Any]:
+        async for chunk in self.resource.get().astream(input, config, **kwargs):
+            yield chunk
+
+    # RunnableSequence の stream / astream は各ステップの transform / atransform を呼ぶ
+    def transform(self, input: Iterator[Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        yield from self.resource.get().transform(input, config, **kwargs)
+
+    async def atransform(
+        self, input: AsyncIterator[Any], config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[Any]:
+        async for chunk in self.resource.get().atransform(input, config, **kwargs):
+            yield chunk
+
+
+class LazyRetriever(BaseRetriever):
+    """resource.get() で作った retriever に検索を委譲する。RePhraseQueryRetriever などにそのまま渡せる"""
+
+    resource: Any
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        # 委譲先の invoke を呼ぶと RETRIEVER の span が二重になるので、中身の検索だけ呼ぶ
+        return self.resource.get()._get_relevant_documents(query, run_manager=run_manager)
+
+    def invoke_many(self, queries: list[str]) -> list[list[Document]]:
+        return self.resource.get().invoke_many(queries)
+
+
+def warmup(resources: Iterable[Lazy], executor: Executor, timeout: Optional[float] = None) -> dict:
+    """
+    resources を executor で並列に初期化する。
+    戻り値はリソースごとの {"seconds": 初期化時間} または {"error": 例外}、と全体の所要時間 (wall_clock_s)。
+    timeout までに終わらなかったものは {"pending": True} とし、初期化自体はバックグラウンドで続ける。
+    """
+    started_at = time.perf_counter()
+    futures = {resource: executor.submit(resource.get) for resource in resources}
+    done, _ = wait(futures.values(), timeout=timeout)
+
+    report = {}
+    for resource, future in futures.items():
+        if future not in done:
+            report[resource.name] = {"pending": True}
+        elif future.exception() is not None:
+            report[resource.name] = {"error": repr(future.exception())}
+        else:
+            report[resource.name] = {"seconds": resource.init_seconds}
+    return {"resources": report, "wall_clock_s": time.perf_counter() - started_at}
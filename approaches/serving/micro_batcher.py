@@ -0,0 +1,133 @@
+"""
+同時に来たリクエストの LLM / embedding 呼び出しをまとめるマイクロバッチ
+
+同時アクセスが多いと、リクエストごとに分類 (classification_chain) と embedding を1件ずつ呼ぶので、
+エンドポイントへの往復数がリクエスト数に比例して増える。
+MicroBatcher は数ミリ秒の窓の間に submit された入力をまとめて batch_fn に1回で渡し、結果を入力ごとに返す。
+"""
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Sequence
+
+from langchain_core.embeddings import Embeddings
+
+
+class MicroBatcher:
+    """
+    submit された入力を、最初の入力から max_wait_ms 経つか max_batch_size 件たまるまで待ってから batch_fn にまとめて渡す。
+    batch_fn は入力のリストを受け取り、同じ順番・同じ長さの結果のリストを返す関数。
+    結果に例外のインスタンスを入れると、その入力の呼び出し元にだけ例外を返す。
+    バッチの実行は専用のスレッドで行う (呼び出し元が shared_executor のタスクでもデッドロックしない)。
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[list], Sequence],
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+        max_concurrent_batches: int = 4,
+        name: str = "micro-batcher",
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000
+        self.name = name
+        self._queue: "queue.Queue[tuple[Any, Future]]" = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches, thread_name_prefix=name)
+        self._collector = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._max_batch = 0
+
+    def submit(self, item: Any) -> Future:
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item: Any) -> Any:
+        return self.submit(item).result()
+
+    async def asubmit(self, item: Any) -> Any:
+        return await asyncio.wrap_future(self.submit(item))
+
+    def map(self, items: Sequence) -> list:
+        """items をそれぞれ submit し、結果を items の順番で返す (他のリクエストの入力と同じバッチに入りうる)"""
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _ensure_started(self) -> None:
+        if self._collector is not None:
+            return
+        with self._start_lock:
+            if self._collector is None:
+                self._collector = threading.Thread(target=self._collect, name=f"{self.name}-collector", daemon=True)
+                self._collector.start()
+
+    def _collect(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait_s
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # 実行中のバッチを待たずに次の入力を集め始める
+            self._executor.submit(self._execute, batch)
+
+    def _execute(self, batch: list[tuple[Any, Future]]) -> None:
+        # 待っている間にキャンセルされた入力 (asubmit の呼び出し元がタイムアウトした場合など) は除く。
+        # 残りは RUNNING にするので、この後はキャンセルされず、set_result / set_exception が失敗しない
+        batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        with self._stats_lock:
+            self._batches += 1
+            self._items += len(batch)
+            self._max_batch = max(self._max_batch, len(batch))
+        try:
+            results = list(self.batch_fn([item for item, _ in batch]))
+            if len(results) != len(batch):
+                raise ValueError(f"{self.name}: batch_fn returned {len(results)} results for {len(batch)} inputs")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "batches": self._batches,
+                "items": self._items,
+                "mean_batch_size": self._items / self._batches if self._batches else 0.0,
+                "max_batch_size": self._max_batch,
+                "queued": self._queue.qsize(),
+            }
+
+
+class MicroBatchedEmbeddings(Embeddings):
+    """embed_documents / embed_query を MicroBatcher 経由にして、同時に来たリクエストのテキストを1回で埋め込む"""
+
+    def __init__(self, embeddings: Embeddings, batcher_options: dict):
+        self.embeddings = embeddings
+        self.batcher = MicroBatcher(embeddings.embed_documents, name="rach-embedding-batcher", **batcher_options)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.batcher.map(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.batcher(text)
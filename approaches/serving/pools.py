@@ -0,0 +1,180 @@
+"""
+chain のサービング時に共有するワーカープールと HTTP コネクションプール
+
+リクエストごとに ThreadPoolExecutor や HTTP クライアントを作ると、
+同時アクセス時にスレッド生成と TLS ハンドシェイクが毎回発生するため、プロセスで1つだけ作って使い回す。
+"""
+import contextvars
+import json
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    """飽和状況 (実行中 / 待ち行列 / ピーク) を stats() で取得できる ThreadPoolExecutor"""
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = ""):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._stats_lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._cancelled = 0
+        self._active = 0
+        self._peak_active = 0
+        self._peak_queued = 0
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        # 呼び出し元の contextvars (mlflow の span やステージ計測のリクエスト) をワーカースレッドに引き継ぐ
+        context = contextvars.copy_context()
+
+        def run(*args, **kwargs):
+            with self._stats_lock:
+                self._active += 1
+                self._peak_active = max(self._peak_active, self._active)
+            try:
+                return context.run(fn, *args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self._active -= 1
+                    self._completed += 1
+
+        with self._stats_lock:
+            self._submitted += 1
+            self._peak_queued = max(self._peak_queued, self._queued())
+        future = super().submit(run, *args, **kwargs)
+        future.add_done_callback(self._count_cancelled)
+        return future
+
+    def _count_cancelled(self, future: Future) -> None:
+        # キャンセルできるのは実行前のタスクだけで、run を通らないので completed にならない。待ち行列から別に差し引く
+        if future.cancelled():
+            with self._stats_lock:
+                self._cancelled += 1
+
+    def _queued(self) -> int:
+        return self._submitted - self._completed - self._cancelled - self._active
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "max_workers": self._max_workers,
+                "active": self._active,
+                "queued": self._queued(),
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "cancelled": self._cancelled,
+                "peak_active": self._peak_active,
+                "peak_queued": self._peak_queued,
+                "saturation": self._active / self._max_workers,
+            }
+
+
+def create_http_session(max_connections: int, pool_connections: int = 4) -> requests.Session:
+    """keep-alive で接続を使い回す requests.Session を作る"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=max_connections)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def create_httpx_limits(http_pool_config: dict):
+    """rag_chain_config.yaml の http_pool 設定から httpx.Limits を作る"""
+    import httpx
+
+    return httpx.Limits(
+        max_connections=http_pool_config.get("max_connections", 64),
+        max_keepalive_connections=http_pool_config.get("max_keepalive_connections", 32),
+        keepalive_expiry=http_pool_config.get("keepalive_expiry", 30),
+    )
+
+
+class PooledVectorSearchIndex:
+    """
+    VectorSearchIndex の similarity_search を、共有の requests.Session 経由の REST 呼び出しに置き換えるラッパー
+
+    databricks-vectorsearch のクライアントはセッションを外から渡せないため、
+    Vector Search の REST API (/api/2.0/vector-search/indexes/{name}/query) を直接呼ぶ。
+    DATABRICKS_HOST / DATABRICKS_TOKEN が設定されていない場合は元の index にそのまま委譲する。
+    それ以外の属性 (describe など) は元の index に委譲する。
+    """
+
+    def __init__(self, index, session: requests.Session, timeout: float = 30.0):
+        self._index = index
+        self._session = session
+        self._timeout = timeout
+        self._host = os.environ.get("DATABRICKS_HOST", "").rstrip("/")
+        self._token = os.environ.get("DATABRICKS_TOKEN")
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._requests = 0
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._index, name)
+
+    @property
+    def pooled(self) -> bool:
+        return bool(self._host and self._token)
+
+    def similarity_search(
+        self,
+        columns: list[str],
+        query_text: Optional[str] = None,
+        query_vector: Optional[list[float]] = None,
+        filters: Optional[dict] = None,
+        num_results: int = 5,
+        query_type: Optional[str] = None,
+        **kwargs: Any,
+    ) -> dict:
+        if not self.pooled:
+            return self._index.similarity_search(
+                columns=columns,
+                query_text=query_text,
+                query_vector=query_vector,
+                filters=filters,
+                num_results=num_results,
+                query_type=query_type,
+                **kwargs,
+            )
+
+        body = {"columns": columns, "num_results": num_results}
+        if query_text is not None:
+            body["query_text"] = query_text
+        if query_vector is not None:
+            body["query_vector"] = query_vector
+        if filters:
+            body["filters_json"] = json.dumps(filters)
+        if query_type:
+            body["query_type"] = query_type.upper()
+
+        with self._lock:
+            self._in_flight += 1
+            self._requests += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        try:
+            response = self._session.post(
+                f"{self._host}/api/2.0/vector-search/indexes/{self._index.name}/query",
+                headers={"Authorization": f"Bearer {self._token}"},
+                json=body,
+                timeout=self._timeout,
+            )
+            response.raise_for_status()
+            return response.json()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pooled": self.pooled,
+                "in_flight": self._in_flight,
+                "peak_in_flight": self._peak_in_flight,
+                "requests": self._requests,
+            }
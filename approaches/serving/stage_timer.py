@@ -0,0 +1,205 @@
+"""
+chain のステージごとのレイテンシ計測
+
+mlflow のトレースは1リクエストごとに span を全部残すので、本番で常時集計するには重い。
+ここではステージごとに固定バケットのヒストグラム (カウンタを1つ増やすだけ) と、
+直近のリクエストごとの内訳 (ステージ名とミリ秒のリスト) だけを持つ。
+
+リクエストの内訳は contextvars で受け渡すので、shared_executor (submit 時に context を引き継ぐ) や
+asyncio のタスクで実行したステージも、呼び出し元のリクエストに記録される。
+"""
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+
+
+def default_buckets_ms() -> np.ndarray:
+    """0.1ms から約120s までを、隣り合うバケットの比が 1.25 になるように区切る"""
+    return 0.1 * 1.25 ** np.arange(64)
+
+
+class LatencyHistogram:
+    def __init__(self, bounds_ms: np.ndarray):
+        self.bounds_ms = bounds_ms
+        # 最後のバケットは上限を超えたもの
+        self.counts = np.zeros(len(bounds_ms) + 1, dtype=np.int64)
+        self.total_ms = 0.0
+
+    def record(self, ms: float) -> None:
+        self.counts[int(np.searchsorted(self.bounds_ms, ms))] += 1
+        self.total_ms += ms
+
+    def percentile(self, q: float) -> float:
+        """q (0〜100) パーセンタイルが入るバケットの上限値。精度はバケット幅 (25%) まで"""
+        count = int(self.counts.sum())
+        if count == 0:
+            return 0.0
+        index = int(np.searchsorted(np.cumsum(self.counts), q / 100 * count))
+        return float(self.bounds_ms[min(index, len(self.bounds_ms) - 1)])
+
+    def summary(self) -> dict:
+        count = int(self.counts.sum())
+        return {
+            "count": count,
+            "mean_ms": self.total_ms / count if count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+        }
+
+
+class RequestBreakdown:
+    """1リクエスト分のステージごとの計測値"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages: list[dict] = []
+        self.marks: dict[str, float] = {}
+        # タイムアウトやフォールバックで、本来より質の落ちた結果で進んだステージ
+        self.degraded: list[str] = []
+        # LLM の呼び出し回数などのリクエストごとのカウンタ
+        self.counters: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, ms: float, detail: Optional[str] = None) -> None:
+        entry = {"stage": stage, "ms": ms}
+        if detail is not None:
+            entry["detail"] = detail
+        with self._lock:
+            self.stages.append(entry)
+
+    def mark(self, name: str) -> None:
+        """後で「ここからの経過時間」を測るための時刻を残す (プロンプト完成時点など)"""
+        self.marks[name] = time.perf_counter()
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def mark_degraded(self, reason: str) -> None:
+        with self._lock:
+            if reason not in self.degraded:
+                self.degraded.append(reason)
+
+    def since(self, name: str) -> Optional[float]:
+        """mark(name) からの経過ミリ秒。mark されていなければ None"""
+        if name not in self.marks:
+            return None
+        return (time.perf_counter() - self.marks[name]) * 1000
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            stages = list(self.stages)
+            degraded = list(self.degraded)
+            counters = dict(self.counters)
+        totals = {}
+        for entry in stages:
+            totals[entry["stage"]] = totals.get(entry["stage"], 0.0) + entry["ms"]
+        return {
+            "total_ms": (time.perf_counter() - self.started_at) * 1000,
+            "stage_totals_ms": totals,
+            "stages": stages,
+            "degraded": degraded,
+            "counters": counters,
+        }
+
+
+_current_request: contextvars.ContextVar[Optional[RequestBreakdown]] = contextvars.ContextVar(
+    "stage_timer_request", default=None
+)
+
+
+class StageTimer:
+    def __init__(self, recent_requests: int = 200, enabled: bool = True):
+        self.enabled = enabled
+        self._bounds_ms = default_buckets_ms()
+        self._histograms: dict[str, LatencyHistogram] = {}
+        self._recent = deque(maxlen=recent_requests)
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, detail: Optional[str] = None) -> None:
+        if not self.enabled:
+            return
+        ms = seconds * 1000
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = LatencyHistogram(self._bounds_ms)
+            histogram.record(ms)
+        breakdown = _current_request.get()
+        if breakdown is not None:
+            breakdown.add(stage, ms, detail)
+
+    @contextmanager
+    def stage(self, name: str, detail: Optional[str] = None):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started_at, detail)
+
+    def timed(self, stage: str):
+        """関数 (sync / async どちらも可) の実行時間を stage として記録するデコレータ"""
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    started_at = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.record(stage, time.perf_counter() - started_at)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - started_at)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def request(self):
+        """このブロック内で記録したステージを1リクエストの内訳としてまとめる"""
+        breakdown = RequestBreakdown()
+        previous = _current_request.get()
+        _current_request.set(breakdown)
+        try:
+            yield breakdown
+        finally:
+            # generator の中で使うと、再開時の context が set した時と別になることがあるので reset(token) は使わない
+            _current_request.set(previous)
+            self.record("request", time.perf_counter() - breakdown.started_at)
+            if self.enabled:
+                with self._lock:
+                    self._recent.append(breakdown.as_dict())
+
+    def percentile_ms(self, stage: str, q: float, min_count: int = 1) -> Optional[float]:
+        """stage の q パーセンタイル。記録が min_count 件未満なら None"""
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None or int(histogram.counts.sum()) < min_count:
+                return None
+            return histogram.percentile(q)
+
+    def current_request(self) -> Optional[RequestBreakdown]:
+        return _current_request.get()
+
+    def histograms(self) -> dict:
+        with self._lock:
+            return {stage: histogram.summary() for stage, histogram in self._histograms.items()}
+
+    def recent_requests(self, n: Optional[int] = None) -> list[dict]:
+        with self._lock:
+            recent = list(self._recent)
+        return recent if n is None else recent[-n:]
@@ -0,0 +1,65 @@
+"""
+ストリーミング応答のレイテンシ計測
+
+最初のチャンクが返るまでの時間 (time-to-first-token, TTFT) と、最後のチャンクまでの時間 (total) を分けて記録する。
+ストリーミングではユーザーの体感は TTFT で決まるので、total だけ見ていると改善が分からない。
+"""
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from approaches.evaluation.retrieval_metrics import latency_summary
+
+
+class StreamTimer:
+    """1リクエスト分の計測。リクエストの開始時に作り、チャンクを返すたびに mark_chunk を呼ぶ"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.first_chunk_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.n_chunks = 0
+
+    def mark_chunk(self) -> None:
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+        self.n_chunks += 1
+
+    def finish(self) -> None:
+        self.finished_at = time.perf_counter()
+
+    @property
+    def ttft_s(self) -> Optional[float]:
+        return None if self.first_chunk_at is None else self.first_chunk_at - self.started_at
+
+    @property
+    def total_s(self) -> Optional[float]:
+        return None if self.finished_at is None else self.finished_at - self.started_at
+
+    def as_dict(self) -> dict:
+        return {
+            "ttft_ms": None if self.ttft_s is None else self.ttft_s * 1000,
+            "total_ms": None if self.total_s is None else self.total_s * 1000,
+            "n_chunks": self.n_chunks,
+        }
+
+
+class StreamingMetrics:
+    """プロセス全体の TTFT / total の分布 (直近 window 件)"""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._ttft = deque(maxlen=window)
+        self._total = deque(maxlen=window)
+
+    def record(self, timer: StreamTimer) -> None:
+        with self._lock:
+            if timer.ttft_s is not None:
+                self._ttft.append(timer.ttft_s)
+            if timer.total_s is not None:
+                self._total.append(timer.total_s)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {"ttft": latency_summary(list(self._ttft)), "total": latency_summary(list(self._total))}
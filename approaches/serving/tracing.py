@@ -0,0 +1,86 @@
+"""
+MLflow トレースのサンプリング・非同期エクスポート・ドキュメントの記録量の設定
+
+autolog を全リクエストで有効にすると、トレースの組み立てと書き出しがリクエストの処理時間に乗る。
+autolog の RETRIEVER span にはチャンク本文、LLM span にはプロンプト (コンテキスト全体) がそのまま載るので、
+コンテキストが長いほど重くなる。
+本番では一部のリクエストだけをトレースし、書き出しはバックグラウンドのキューに任せる。
+ids モードでは autolog のトレースを止め (autolog の span の中身は削れないため)、
+chain が自前で作る span (ドキュメントは id とスコアだけ) だけを残す。
+
+評価 (mlflow.evaluate の databricks-agent) は全リクエストのトレースと RETRIEVER span の本文を使うので、
+EVALUATION_ENV が設定されているときは設定に関係なく全件・本文ありでトレースする。
+"""
+import os
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+# 評価ノートブックで chain を読み込む前に "1" にする
+EVALUATION_ENV = "RACH_TRACING_EVALUATION"
+
+# ids モードで span に残す metadata のキー
+DOCUMENT_ID_KEYS = ("id", "url", "score", "rrf_score", "relevance_score")
+
+
+@dataclass(frozen=True)
+class TracingSettings:
+    # トレースするリクエストの割合 (0〜1)
+    sample_rate: float = 1.0
+    # "full": autolog の span も含めてチャンク本文・プロンプトも載せる
+    # "ids": autolog のトレースを止め、chain の span には id とスコアだけ載せる
+    doc_payload: str = "full"
+    # トレースの書き出しをリクエストのスレッドから外す
+    async_export: bool = True
+    export_queue_size: int = 1000
+    export_workers: int = 2
+
+    @property
+    def autolog_traces(self) -> bool:
+        """mlflow.langchain.autolog の log_traces に渡す値"""
+        return self.doc_payload != "ids"
+
+    @classmethod
+    def from_config(cls, config: dict, environ: Optional[dict] = None) -> "TracingSettings":
+        environ = os.environ if environ is None else environ
+        evaluation = environ.get(EVALUATION_ENV, "").lower() in ("1", "true", "yes")
+        return cls(
+            sample_rate=1.0 if evaluation else float(config.get("sample_rate", 1.0)),
+            doc_payload="full" if evaluation else config.get("doc_payload", "full"),
+            async_export=config.get("async_export", True),
+            export_queue_size=config.get("export_queue_size", 1000),
+            export_workers=config.get("export_workers", 2),
+        )
+
+
+def configure_tracing(settings: TracingSettings) -> None:
+    """
+    MLflow のトレース設定を環境変数で渡す。
+    トレースの provider は最初の span を作るときに環境変数を読むので、autolog や span を作る前に呼ぶこと。
+    """
+    os.environ["MLFLOW_TRACE_SAMPLING_RATIO"] = str(settings.sample_rate)
+    os.environ["MLFLOW_ENABLE_ASYNC_TRACE_LOGGING"] = "true" if settings.async_export else "false"
+    os.environ["MLFLOW_ASYNC_TRACE_LOGGING_MAX_QUEUE_SIZE"] = str(settings.export_queue_size)
+    os.environ["MLFLOW_ASYNC_TRACE_LOGGING_MAX_WORKERS"] = str(settings.export_workers)
+
+
+def is_recording(span) -> bool:
+    """サンプリングで落とされたトレースの span (NoOpSpan) なら False。属性の組み立て自体を省くために使う"""
+    from mlflow.entities.span import NoOpSpan
+
+    return span is not None and not isinstance(span, NoOpSpan)
+
+
+def document_payload(docs: Sequence, doc_payload: str) -> list:
+    """
+    span に載せるドキュメント。ids モードでは page_content を空にし、metadata も DOCUMENT_ID_KEYS だけにする
+    (RETRIEVER span の形式は保ったまま、大きさをチャンクの長さに依存させない)
+    """
+    if doc_payload != "ids":
+        return list(docs)
+    return [
+        type(doc)(
+            page_content="",
+            metadata={key: doc.metadata[key] for key in DOCUMENT_ID_KEYS if key in doc.metadata},
+        )
+        for doc in docs
+    ]
@@ -0,0 +1,100 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## 適応的なクエリ拡張 (adaptive_expansion) の効果
+# MAGIC
+# MAGIC chain_langchain を adaptive_expansion.enabled の true / false で2回ログし、eval-dataset.csv の質問で
+# MAGIC レイテンシ・分類・リライト・HyDE の LLM 呼び出し数 (リクエストの内訳の llm_calls)・経路 (general / first_pass / expanded) を比べる。
+# MAGIC キャッシュが効くと差が見えなくなるので、セマンティックキャッシュ・メモ化・rerank キャッシュは切っておく。
+
+# COMMAND ----------
+
+# MAGIC %pip install databricks-vectorsearch databricks-sdk langchain==0.2.11 langchain_core==0.2.23 langchain-community==0.2.9 mlflow cohere python-dotenv pyyaml
+# MAGIC %restart_python
+
+# COMMAND ----------
+
+import copy
+import os
+import sys
+import time
+
+import mlflow
+import pandas as pd
+import yaml
+
+# approaches/ を import できるようにする
+sys.path.append(os.path.abspath(".."))
+
+from approaches.evaluation.retrieval_metrics import latency_summary
+
+eval_set_df = pd.read_csv("../eval-dataset.csv")
+chain_notebook_path = os.path.abspath("../chain_langchain")
+with open("../rag_chain_config.yaml") as f:
+    base_config = yaml.safe_load(f)
+
+input_example = {"messages": [{"role": "user", "content": "授業時間は一コマどのくらいですか？"}]}
+
+# COMMAND ----------
+
+def load_variant(adaptive: bool):
+    config = copy.deepcopy(base_config)
+    config["adaptive_expansion"]["enabled"] = adaptive
+    config["semantic_cache"]["enabled"] = False
+    config["memo_cache"]["enabled"] = False
+    config["rerank"]["cache"]["enabled"] = False
+    # stream_metrics の span に残るリクエストの内訳から LLM の呼び出し数を読むので、全リクエストをトレースする
+    config["tracing"]["sample_rate"] = 1.0
+    with mlflow.start_run(run_name=f"benchmark_adaptive_expansion_{adaptive}"):
+        logged_chain_info = mlflow.langchain.log_model(
+            lc_model=chain_notebook_path,
+            model_config=config,
+            code_paths=[os.path.abspath("../approaches")],
+            artifact_path="chain",
+            input_example=input_example,
+            example_no_conversion=True,
+        )
+    return mlflow.langchain.load_model(logged_chain_info.model_uri)
+
+def run(chain) -> pd.DataFrame:
+    rows = []
+    for question in eval_set_df["request"]:
+        started_at = time.perf_counter()
+        chain.invoke({"messages": [{"role": "user", "content": question}]})
+        latency = time.perf_counter() - started_at
+
+        trace = mlflow.get_last_active_trace()
+        spans = trace.data.spans if trace else []
+        adaptive_span = next((span for span in spans if span.name == "adaptive_expansion"), None)
+        metrics_span = next((span for span in spans if span.name == "stream_metrics"), None)
+        breakdown = metrics_span.attributes.get("stage_breakdown", {}) if metrics_span else {}
+        rows.append({
+            "question": question,
+            "latency_s": latency,
+            # 分類・リライト・HyDE で実際に呼んだ LLM の回数 (回答の生成は含まない)
+            "llm_calls": breakdown.get("counters", {}).get("llm_calls", 0),
+            "path": adaptive_span.attributes.get("path") if adaptive_span else "baseline",
+            "reason": adaptive_span.attributes.get("reason") if adaptive_span else None,
+        })
+    return pd.DataFrame(rows)
+
+# COMMAND ----------
+
+results = {
+    "baseline": run(load_variant(adaptive=False)),
+    "adaptive": run(load_variant(adaptive=True)),
+}
+
+# COMMAND ----------
+
+summary = pd.DataFrame([
+    {
+        "mode": name,
+        **latency_summary(df["latency_s"].tolist()),
+        "llm_calls_per_request": df["llm_calls"].mean(),
+    }
+    for name, df in results.items()
+])
+display(summary)
+
+# 経路ごとの件数と、拡張した理由の内訳
+display(results["adaptive"].groupby(["path", "reason"], dropna=False).size().rename("n").reset_index())
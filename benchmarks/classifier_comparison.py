@@ -0,0 +1,110 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## 質問分類: LLM (gpt-4o-mini) / ローカル分類器 / ローカル + LLM フォールバック の比較
+# MAGIC
+# MAGIC classifier-examples.csv と eval-dataset.csv (すべて specific) を 8:2 に分け、学習用でローカル分類器を学習して、
+# MAGIC テスト用で精度とレイテンシを比べる。フォールバックありの場合は、LLM を呼んだ割合も出す。
+
+# COMMAND ----------
+
+# MAGIC %pip install langchain==0.2.11 langchain_core==0.2.23 langchain-community==0.2.9 mlflow numpy pandas
+# MAGIC %restart_python
+
+# COMMAND ----------
+
+# MAGIC %run ../config
+
+# COMMAND ----------
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from langchain_community.chat_models import ChatDatabricks
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+# approaches/ を import できるようにする
+sys.path.append(os.path.abspath(".."))
+
+from approaches.classification.local_classifier import LocalQuestionClassifier, classify_with_fallback
+from approaches.evaluation.retrieval_metrics import latency_summary
+
+min_confidences = [0.7, 0.8, 0.9, 0.95]
+
+examples_df = pd.read_csv("../classifier-examples.csv")
+eval_df = pd.read_csv("../eval-dataset.csv")
+dataset_df = pd.concat(
+    [examples_df, pd.DataFrame({"question": eval_df["request"], "label": "specific"})], ignore_index=True
+).drop_duplicates(subset="question")
+
+rng = np.random.default_rng(42)
+test_mask = rng.random(len(dataset_df)) < 0.2
+train_df, test_df = dataset_df[~test_mask], dataset_df[test_mask]
+
+# COMMAND ----------
+
+# chain_langchain.py の classification_prompt と同じ内容
+classification_chain = (
+    ChatPromptTemplate.from_messages([
+        ("system", """You are an AI assistant tasked with classifying questions into two categories: 'general' or 'specific'.
+
+1. General: The question asks for common knowledge, general definitions, or broad explanations.
+Examples
+    - What is artificial intelligence?
+    - How does a neural network work?
+
+2. Specific: The question requires information from a specific domain, dataset, or context.
+    - Questions that require specific data or examples.
+    - Questions related to schools, education, or academic topics.
+Examples
+    - How many students are enrolled?
+    - How many years does the school have?
+
+Classify the following question:
+**Answer only with 'general' or 'specific'.**"""),
+        ("user", "Question: {question}"),
+    ])
+    | ChatDatabricks(endpoint=instruct_mini_endpoint_name, extra_params={"temperature": 0, "max_tokens": 5})
+    | StrOutputParser()
+)
+
+def llm_classify(question: str) -> str:
+    return classification_chain.invoke({"question": question}).strip().lower()
+
+classifier = LocalQuestionClassifier.train(train_df["question"].tolist(), train_df["label"].tolist())
+
+# COMMAND ----------
+
+def evaluate(name: str, classify) -> dict:
+    latencies, correct, llm_calls = [], 0, 0
+    for question, label in zip(test_df["question"], test_df["label"]):
+        started_at = time.perf_counter()
+        predicted, source = classify(question)
+        latencies.append(time.perf_counter() - started_at)
+        correct += predicted == label
+        llm_calls += source == "llm"
+    return {
+        "classifier": name,
+        "accuracy": correct / len(test_df),
+        "llm_call_rate": llm_calls / len(test_df),
+        **latency_summary(latencies),
+    }
+
+rows = [
+    evaluate("llm", lambda q: (llm_classify(q), "llm")),
+    evaluate("local", lambda q: (classifier.predict(q)[0], "local")),
+]
+
+def with_fallback(min_confidence: float):
+    def classify(question: str):
+        label, _, source = classify_with_fallback(classifier, question, min_confidence, llm_classify)
+        return label, source
+    return classify
+
+for min_confidence in min_confidences:
+    rows.append(evaluate(f"local + llm fallback (min_confidence={min_confidence})", with_fallback(min_confidence)))
+
+display(pd.DataFrame(rows))
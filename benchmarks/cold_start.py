@@ -0,0 +1,130 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## コールドスタート: import 時間と最初のリクエストのレイテンシ
+# MAGIC
+# MAGIC chain_langchain を cold_start の設定を変えてログし、毎回新しい Python プロセスで
+# MAGIC モデルの読み込み (chain_langchain.py の import)・最初のリクエスト・2回目のリクエストの時間を測る。
+# MAGIC scale_to_zero のエンドポイントでは、読み込み + 最初のリクエストがユーザーの待ち時間になる。
+# MAGIC
+# MAGIC - eager: import 時にすべてのクライアントを順番に作る (遅延初期化を入れる前と同じ)
+# MAGIC - lazy: 最初に使うときに作る (warmup なし)
+# MAGIC - lazy + background warmup: import はすぐに返し、裏で並列に初期化する
+# MAGIC - lazy + blocking warmup: import の中で並列に初期化し終えてから返す
+# MAGIC
+# MAGIC キャッシュが効くと最初のリクエストが速くなりすぎるので、セマンティックキャッシュ・メモ化・rerank キャッシュは切っておく。
+
+# COMMAND ----------
+
+# MAGIC %pip install databricks-vectorsearch databricks-sdk langchain==0.2.11 langchain_core==0.2.23 langchain-community==0.2.9 mlflow cohere python-dotenv pyyaml
+# MAGIC %restart_python
+
+# COMMAND ----------
+
+import copy
+import json
+import os
+import subprocess
+import sys
+
+import mlflow
+import pandas as pd
+import yaml
+
+chain_notebook_path = os.path.abspath("../chain_langchain")
+with open("../rag_chain_config.yaml") as f:
+    base_config = yaml.safe_load(f)
+
+input_example = {"messages": [{"role": "user", "content": "授業時間は一コマどのくらいですか？"}]}
+
+# 子プロセスからも Databricks の API を呼べるようにする
+os.environ["DATABRICKS_HOST"] = dbutils.notebook.entry_point.getDbutils().notebook().getContext().apiUrl().get()
+os.environ["DATABRICKS_TOKEN"] = dbutils.notebook.entry_point.getDbutils().notebook().getContext().apiToken().get()
+
+# 1 variant あたりのプロセス数
+n_trials = 5
+
+variants = {
+    "eager": {"lazy_init": False},
+    "lazy": {"lazy_init": True, "warmup": "none"},
+    "lazy + background warmup": {"lazy_init": True, "warmup": "background"},
+    "lazy + blocking warmup": {"lazy_init": True, "warmup": "blocking"},
+}
+
+# COMMAND ----------
+
+def log_variant(name: str, cold_start: dict) -> str:
+    config = copy.deepcopy(base_config)
+    config["cold_start"] = {**config.get("cold_start", {}), **cold_start}
+    config["semantic_cache"]["enabled"] = False
+    config["memo_cache"]["enabled"] = False
+    config["rerank"]["cache"]["enabled"] = False
+    with mlflow.start_run(run_name=f"benchmark_cold_start_{name}"):
+        logged_chain_info = mlflow.langchain.log_model(
+            lc_model=chain_notebook_path,
+            model_config=config,
+            code_paths=[os.path.abspath("../approaches")],
+            artifact_path="chain",
+            input_example=input_example,
+            example_no_conversion=True,
+        )
+    return logged_chain_info.model_uri
+
+model_uris = {name: log_variant(name, cold_start) for name, cold_start in variants.items()}
+
+# COMMAND ----------
+
+# 新しいプロセスで実行する計測用のスクリプト。結果は最後の行に JSON で出力する
+probe_script = """
+import json
+import sys
+import time
+
+started_at = time.perf_counter()
+import mlflow
+mlflow_import_s = time.perf_counter() - started_at
+
+model_uri, input_example = sys.argv[1], json.loads(sys.argv[2])
+
+started_at = time.perf_counter()
+model = mlflow.pyfunc.load_model(model_uri)
+load_s = time.perf_counter() - started_at
+
+started_at = time.perf_counter()
+model.predict(input_example)
+first_request_s = time.perf_counter() - started_at
+
+started_at = time.perf_counter()
+model.predict(input_example)
+second_request_s = time.perf_counter() - started_at
+
+print(json.dumps({
+    "mlflow_import_s": mlflow_import_s,
+    "load_s": load_s,
+    "first_request_s": first_request_s,
+    "second_request_s": second_request_s,
+}))
+"""
+
+def probe(model_uri: str) -> dict:
+    completed = subprocess.run(
+        [sys.executable, "-c", probe_script, model_uri, json.dumps(input_example, ensure_ascii=False)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+rows = []
+for name, model_uri in model_uris.items():
+    for trial in range(n_trials):
+        rows.append({"variant": name, "trial": trial, **probe(model_uri)})
+results_df = pd.DataFrame(rows)
+results_df["load_plus_first_request_s"] = results_df["load_s"] + results_df["first_request_s"]
+
+# COMMAND ----------
+
+display(
+    results_df.groupby("variant")[["load_s", "first_request_s", "second_request_s", "load_plus_first_request_s"]]
+    .agg(["median", "max"])
+    .reindex(list(variants))
+)
@@ -0,0 +1,187 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## クローラー: ページ取得の所要時間
+# MAGIC
+# MAGIC faq-chatbot.py のページ取得を、ローカルに立てた HTTP サーバー (fixture) に対して比べる。
+# MAGIC 本番のサイトに負荷をかけないように、応答時間はサーバー側の sleep で再現する。
+# MAGIC
+# MAGIC - sequential (before): URL ごとに httpx.Client を作り、1ページずつ取得して 0.5s sleep する (以前の faq-chatbot.py)
+# MAGIC - sequential (pooled): 1つの httpx.Client を使い回し、sleep なしで1ページずつ取得する
+# MAGIC - AsyncCrawler: 1つの httpx.AsyncClient で並列に取得する (同時実行数・ホストごとの間隔を変える)
+# MAGIC
+# MAGIC 一部のページは最初の1回だけ read timeout より遅く返すので、AsyncCrawler のリトライも計測に含まれる。
+# MAGIC
+# MAGIC 最後に、HttpCache (条件付き GET) を使った再クロールも測る。fixture は ETag を返し、If-None-Match が一致すれば 304 を返す。
+
+# COMMAND ----------
+
+# MAGIC %pip install httpx beautifulsoup4
+# MAGIC %restart_python
+
+# COMMAND ----------
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pandas as pd
+from bs4 import BeautifulSoup
+
+# approaches/ を import できるようにする
+sys.path.append(os.path.abspath(".."))
+
+from approaches.scraping.async_crawler import AsyncCrawler
+from approaches.scraping.http_cache import HttpCache
+
+n_pages = 60
+# 1ページあたりのサーバーの応答時間
+response_latency_s = 0.08
+# この間隔ごとのページは、最初の1回だけ read timeout より遅く返す
+slow_page_every = 20
+read_timeout_s = 1.0
+
+# COMMAND ----------
+
+page_template = """<html><body><div id="page"><main><article>
+<h2>ページ {i}</h2>
+{paragraphs}
+<div class="c-lower_links"><a href="/">リンク集</a></div>
+</article></main></div></body></html>"""
+
+def render_page(i: int) -> bytes:
+    paragraphs = "\n".join(f"<p>授業・学生生活についての説明 {i}-{j}。</p>" for j in range(50))
+    return page_template.format(i=i, paragraphs=paragraphs).encode()
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    hits: dict = {}
+    hits_lock = threading.Lock()
+
+    def do_GET(self):
+        i = int(self.path.strip("/").split("/")[-1])
+        with self.hits_lock:
+            self.hits[self.path] = self.hits.get(self.path, 0) + 1
+            first_hit = self.hits[self.path] == 1
+        time.sleep(response_latency_s)
+        etag = f'"page-{i}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        if first_hit and i % slow_page_every == 0:
+            time.sleep(read_timeout_s * 1.5)
+        body = render_page(i)
+        try:
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # タイムアウトしたクライアントが先に切断した
+            pass
+
+    def log_message(self, *args):
+        pass
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+server = FixtureServer(("127.0.0.1", 0), FixtureHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = f"http://127.0.0.1:{server.server_port}"
+urls = [f"{base_url}/pages/{i}" for i in range(n_pages)]
+
+# COMMAND ----------
+
+def run_sequential_before(urls: list[str]) -> list[bytes]:
+    pages = []
+    for url in urls:
+        with httpx.Client() as client:
+            try:
+                response = client.get(url, timeout=httpx.Timeout(5.0, read=read_timeout_s))
+            except httpx.ReadTimeout:
+                # 以前のコードにはリトライがないので、取得できなかったページになる
+                continue
+        pages.append(response.content)
+        time.sleep(0.5)
+    return pages
+
+def run_sequential_pooled(urls: list[str]) -> list[bytes]:
+    pages = []
+    with httpx.Client(timeout=httpx.Timeout(5.0, read=read_timeout_s)) as client:
+        for url in urls:
+            try:
+                pages.append(client.get(url).content)
+            except httpx.ReadTimeout:
+                continue
+    return pages
+
+def run_crawler(crawler: AsyncCrawler):
+    def run(urls: list[str]) -> list[bytes]:
+        return [result.content for result in crawler.iter_crawl(urls) if result.ok]
+    return run
+
+def measure(name: str, run) -> dict:
+    # サーバー側の「最初の1回だけ遅い」を毎回再現する
+    FixtureHandler.hits.clear()
+    started_at = time.perf_counter()
+    pages = run(urls)
+    # faq-chatbot.py と同じく、取得したページは BeautifulSoup でパースする
+    for page in pages:
+        BeautifulSoup(page, "html.parser")
+    wall_clock_s = time.perf_counter() - started_at
+    return {
+        "mode": name,
+        "pages": len(pages),
+        "wall_clock_s": wall_clock_s,
+        "pages_per_s": len(pages) / wall_clock_s,
+    }
+
+# COMMAND ----------
+
+timeout = httpx.Timeout(5.0, read=read_timeout_s)
+variants = {
+    "sequential (before)": run_sequential_before,
+    "sequential (pooled)": run_sequential_pooled,
+}
+for max_concurrency in [1, 4, 8, 16]:
+    for per_host_interval_s in [0.0, 0.1]:
+        crawler = AsyncCrawler(
+            max_concurrency=max_concurrency,
+            per_host_interval_s=per_host_interval_s,
+            max_retries=3,
+            backoff_s=0.1,
+            timeout=timeout,
+        )
+        variants[f"AsyncCrawler (concurrency={max_concurrency}, interval={per_host_interval_s}s)"] = run_crawler(crawler)
+
+rows = [measure(name, run) for name, run in variants.items()]
+
+# 再クロール: 1回目でキャッシュを作ってから、2回目 (全ページ 304) を測る
+cached_crawler = AsyncCrawler(
+    max_concurrency=8,
+    per_host_interval_s=0.1,
+    max_retries=3,
+    backoff_s=0.1,
+    timeout=timeout,
+    cache=HttpCache(os.path.join(tempfile.mkdtemp(), "http_cache.sqlite")),
+)
+list(cached_crawler.iter_crawl(urls))
+
+def run_recrawl(urls: list[str]) -> list[bytes]:
+    # 変わっていないページは後段の処理 (パース) に渡さない
+    return [result.content for result in cached_crawler.iter_crawl(urls) if result.ok and result.changed]
+
+rows.append(measure("AsyncCrawler + HttpCache (recrawl, concurrency=8, interval=0.1s)", run_recrawl))
+display(pd.DataFrame(rows))
+display(pd.DataFrame([cached_crawler.cache.stats()]))
+
+# COMMAND ----------
+
+server.shutdown()
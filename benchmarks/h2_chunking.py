@@ -0,0 +1,128 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## H2 チャンク分割: トークン数の数え方
+# MAGIC
+# MAGIC faq-chatbot.py の split_html_on_h2 (H2 セクションを max_chunk_size/2 トークンまでまとめる処理) を、長いページで比べる。
+# MAGIC
+# MAGIC - before (OpenAIGPTTokenizer): セクションを足すたびにバッファ全体を encode し直し、できたチャンクも1つずつ encode する (以前の faq-chatbot.py)
+# MAGIC - before (OpenAIGPTTokenizerFast): 同じ処理で、トークナイザーだけ fast tokenizer にしたもの
+# MAGIC - H2Chunker: セクションごとのトークン数を fast tokenizer でまとめて数え、累計を結合の判定と破棄に使い回す
+# MAGIC
+# MAGIC ページは fixtures/html/ の学科ページなどの H2 セクションを繰り返して長くしたもの。
+# MAGIC H2Chunker のチャンクが before (OpenAIGPTTokenizerFast) と完全に一致することも確認する。
+# MAGIC before (OpenAIGPTTokenizer) とは、トークナイザーの前処理の違いでトークン数がずれることがあるので、一致したページの割合を出す。
+
+# COMMAND ----------
+
+# MAGIC %pip install lxml transformers==4.30.2 langchain==0.2.11
+# MAGIC %restart_python
+
+# COMMAND ----------
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+import pandas as pd
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from transformers import OpenAIGPTTokenizer, OpenAIGPTTokenizerFast
+
+# approaches/ を import できるようにする
+sys.path.append(os.path.abspath(".."))
+
+from approaches.ingestion.h2_chunking import H2Chunker
+from approaches.scraping.html_extraction import extract_page
+
+fixtures_dir = os.path.abspath("fixtures/html")
+min_chunk_size = 20
+max_chunk_size = 512
+# セクションを何回繰り返したページにするか (1 は fixture のまま)
+page_lengths = [1, 5, 20, 50]
+
+# COMMAND ----------
+
+base_pages = []
+with contextlib.redirect_stdout(io.StringIO()):
+    for file in sorted(os.listdir(fixtures_dir)):
+        if not file.endswith(".html"):
+            continue
+        with open(os.path.join(fixtures_dir, file), "rb") as f:
+            page = extract_page(f"https://www.tech.ac.jp/fixtures/{file}", f.read())
+        if page is not None:
+            base_pages.append(page.sections)
+
+pages_by_length = {k: [sections * k for sections in base_pages] for k in page_lengths}
+{k: sum(len(sections) for sections in pages) for k, pages in pages_by_length.items()}
+
+# COMMAND ----------
+
+def split_before(tokenizer):
+    text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(tokenizer, chunk_size=max_chunk_size, chunk_overlap=50)
+
+    def split(sections) -> list[dict]:
+        page_contents = "".join([content for _, content in sections])
+        previous_chunk = ""
+        results = []
+        for current_h2, page_content in sections:
+            content = current_h2 + "\n" + page_content
+            if len(tokenizer.encode(previous_chunk + content)) <= max_chunk_size/2:
+                previous_chunk += content + "\n"
+            else:
+                for chunk in text_splitter.split_text(previous_chunk.strip()):
+                    results.append({"content": chunk, "page_contents": page_contents})
+                previous_chunk = content + "\n"
+        if previous_chunk:
+            for chunk in text_splitter.split_text(previous_chunk.strip()):
+                results.append({"content": chunk, "page_contents": page_contents})
+        return [r for r in results if len(tokenizer.encode(r["content"])) > min_chunk_size]
+
+    return lambda pages: [split(sections) for sections in pages]
+
+slow_tokenizer = OpenAIGPTTokenizer.from_pretrained("openai-gpt")
+fast_tokenizer = OpenAIGPTTokenizerFast.from_pretrained("openai-gpt")
+h2_chunker = H2Chunker(fast_tokenizer, min_chunk_size=min_chunk_size, max_chunk_size=max_chunk_size, chunk_overlap=50)
+
+variants = {
+    "before (OpenAIGPTTokenizer)": split_before(slow_tokenizer),
+    "before (OpenAIGPTTokenizerFast)": split_before(fast_tokenizer),
+    "H2Chunker": h2_chunker.chunk_pages,
+}
+
+# COMMAND ----------
+
+rows = []
+outputs = {}
+for k, pages in pages_by_length.items():
+    n_sections = sum(len(sections) for sections in pages)
+    for name, run in variants.items():
+        started_at = time.perf_counter()
+        outputs[(k, name)] = run(pages)
+        wall_clock_s = time.perf_counter() - started_at
+        rows.append({
+            "page_length": k,
+            "mode": name,
+            "sections": n_sections,
+            "chunks": sum(len(chunks) for chunks in outputs[(k, name)]),
+            "wall_clock_s": wall_clock_s,
+            "sections_per_s": n_sections / wall_clock_s,
+        })
+display(pd.DataFrame(rows))
+
+# COMMAND ----------
+
+# 出力が一致するか
+equality_rows = []
+for k in page_lengths:
+    chunker_output = outputs[(k, "H2Chunker")]
+    equality_rows.append({
+        "page_length": k,
+        "identical to before (fast)": chunker_output == outputs[(k, "before (OpenAIGPTTokenizerFast)")],
+        "pages identical to before (slow)": sum(
+            a == b for a, b in zip(chunker_output, outputs[(k, "before (OpenAIGPTTokenizer)")])
+        ) / len(chunker_output),
+    })
+equality_df = pd.DataFrame(equality_rows)
+display(equality_df)
+assert equality_df["identical to before (fast)"].all()
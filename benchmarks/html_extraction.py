@@ -0,0 +1,161 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## HTML 抽出: 記事部分の取り出しと H2 分割のスループット
+# MAGIC
+# MAGIC 保存済みの HTML (fixtures/html/) に対して、faq-chatbot.py の抽出・分割処理を比べる。
+# MAGIC
+# MAGIC - bs4 + HTMLHeaderTextSplitter (before): BeautifulSoup でパースして不要なタグを decompose し、記事部分の HTML を HTMLHeaderTextSplitter で H2 ごとに分ける (1ページを2回パースする)
+# MAGIC - lxml (extract_page): lxml で1回だけパースし、1回の走査で不要なタグの除去と H2 分割を行う
+# MAGIC - lxml (split_h2_sections): 保存済みの記事 HTML の H2 分割だけ (HTMLHeaderTextSplitter の置き換え)
+# MAGIC
+# MAGIC どのページでも、H2 セクション (見出し, チャンク) が before と完全に一致することも確認する。
+# MAGIC fixture は TECH.C. のページの構造 (学科ページ・ワークブック・個別処理が必要な4ページ・記事がないページ) をまねて作ったもの。
+# MAGIC `refresh_fixtures = True` にすると、本番のページを取得して fixtures/html/live/ に保存し、それも比べる。
+
+# COMMAND ----------
+
+# MAGIC %pip install lxml beautifulsoup4 langchain httpx
+# MAGIC %restart_python
+
+# COMMAND ----------
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+import pandas as pd
+from bs4 import BeautifulSoup
+from langchain.text_splitter import HTMLHeaderTextSplitter
+
+# approaches/ を import できるようにする
+sys.path.append(os.path.abspath(".."))
+
+from approaches.scraping.html_extraction import (
+    DIFFERENT_URL,
+    MYSCHOOL_URL,
+    STRENGTHS_URL,
+    WEBOPENCAMPUS_URL,
+    extract_article_bs4,
+    extract_page,
+    split_h2_sections,
+)
+
+fixtures_dir = os.path.abspath("fixtures/html")
+# 個別処理は URL で決まるので、fixture のファイル名と URL を対応させる
+fixture_urls = {
+    "features_different.html": DIFFERENT_URL,
+    "features_strengths.html": STRENGTHS_URL,
+    "myschool.html": MYSCHOOL_URL,
+    "web_opencampus.html": WEBOPENCAMPUS_URL,
+}
+n_repeats = 20
+refresh_fixtures = False
+
+# COMMAND ----------
+
+if refresh_fixtures:
+    import httpx
+
+    live_dir = os.path.join(fixtures_dir, "live")
+    os.makedirs(live_dir, exist_ok=True)
+    live_urls = [
+        "https://www.tech.ac.jp/course/",
+        "https://www.tech.ac.jp/admission/",
+        DIFFERENT_URL,
+        STRENGTHS_URL,
+        MYSCHOOL_URL,
+        WEBOPENCAMPUS_URL,
+    ]
+    with httpx.Client(timeout=10.0) as client:
+        for url in live_urls:
+            name = url.rstrip("/").split("/")[-1] + ".html"
+            with open(os.path.join(live_dir, name), "wb") as f:
+                f.write(client.get(url).content)
+            fixture_urls[f"live/{name}"] = url
+            time.sleep(0.5)
+
+def load_fixtures() -> list[tuple[str, str, bytes]]:
+    fixtures = []
+    for root, _, files in os.walk(fixtures_dir):
+        for file in sorted(files):
+            if not file.endswith(".html"):
+                continue
+            name = os.path.relpath(os.path.join(root, file), fixtures_dir)
+            url = fixture_urls.get(name, f"https://www.tech.ac.jp/fixtures/{name}")
+            with open(os.path.join(root, file), "rb") as f:
+                fixtures.append((name, url, f.read()))
+    return fixtures
+
+fixtures = load_fixtures()
+len(fixtures)
+
+# COMMAND ----------
+
+html_splitter = HTMLHeaderTextSplitter(headers_to_split_on=[("h2", "header2")])
+
+def split_bs4(html: str):
+    return [(c.metadata.get("header2", ""), c.page_content) for c in html_splitter.split_text(html)]
+
+def sections_bs4(url: str, content: bytes):
+    html = extract_article_bs4(url, BeautifulSoup(content, "html.parser"))
+    return None if html is None else split_bs4(html)
+
+def sections_lxml(url: str, content: bytes):
+    page = extract_page(url, content)
+    return None if page is None else page.sections
+
+# COMMAND ----------
+
+# 出力が一致するか
+rows = []
+for name, url, content in fixtures:
+    with contextlib.redirect_stdout(io.StringIO()):
+        stored_html = extract_article_bs4(url, BeautifulSoup(content, "html.parser"))
+        page = extract_page(url, content)
+    expected = None if stored_html is None else split_bs4(stored_html)
+    rows.append({
+        "fixture": name,
+        "sections": None if expected is None else len(expected),
+        "extract_page": (None if page is None else page.sections) == expected,
+        # html テーブルには extract_page の HTML を保存するので、それを分割し直しても同じになること
+        "extract_page (html)": page is None or split_bs4(page.html) == expected,
+        "split_h2_sections": stored_html is None or split_h2_sections(stored_html) == expected,
+    })
+equality_df = pd.DataFrame(rows)
+display(equality_df)
+assert equality_df[["extract_page", "extract_page (html)", "split_h2_sections"]].all().all()
+
+# COMMAND ----------
+
+def measure(name: str, run) -> dict:
+    # 個別処理のログは計測に含めない
+    with contextlib.redirect_stdout(io.StringIO()):
+        started_at = time.perf_counter()
+        for _ in range(n_repeats):
+            for _, url, content in fixtures:
+                run(url, content)
+        wall_clock_s = time.perf_counter() - started_at
+    n_pages = n_repeats * len(fixtures)
+    return {
+        "mode": name,
+        "pages": n_pages,
+        "wall_clock_s": wall_clock_s,
+        "pages_per_s": n_pages / wall_clock_s,
+        "mb_per_s": n_repeats * sum(len(content) for _, _, content in fixtures) / wall_clock_s / 1e6,
+    }
+
+stored_htmls = {}
+with contextlib.redirect_stdout(io.StringIO()):
+    for _, url, content in fixtures:
+        stored_htmls[url] = extract_article_bs4(url, BeautifulSoup(content, "html.parser"))
+
+variants = {
+    "bs4 + HTMLHeaderTextSplitter (before)": sections_bs4,
+    "lxml (extract_page)": sections_lxml,
+    # ここからは保存済みの記事 HTML の分割だけ
+    "HTMLHeaderTextSplitter (split only)": lambda url, _: stored_htmls[url] and split_bs4(stored_htmls[url]),
+    "lxml (split_h2_sections, split only)": lambda url, _: split_h2_sections(stored_htmls[url]),
+}
+display(pd.DataFrame([measure(name, run) for name, run in variants.items()]))
@@ -0,0 +1,101 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## ローカル hybrid 検索 (dense + BM25 + RRF) と Vector Search の hybrid モードの比較
+# MAGIC
+# MAGIC eval-dataset.csv の質問で、レイテンシと recall (期待回答の被覆率) を比べる。
+# MAGIC 事前に create-vector-db.py を実行して、ローカルインデックスのスナップショットを作っておくこと。
+
+# COMMAND ----------
+
+# MAGIC %pip install databricks-vectorsearch databricks-sdk langchain==0.2.11 langchain_core==0.2.23 langchain-community==0.2.9 mlflow
+# MAGIC %restart_python
+
+# COMMAND ----------
+
+# MAGIC %run ../config
+
+# COMMAND ----------
+
+import os
+import sys
+import time
+
+import pandas as pd
+
+# approaches/ を import できるようにする
+sys.path.append(os.path.abspath(".."))
+
+from databricks.vector_search.client import VectorSearchClient
+from langchain_community.embeddings import DatabricksEmbeddings
+
+from approaches.evaluation.retrieval_metrics import answer_recall, latency_summary, overlap_at_k
+from approaches.retrieval.local_vector_index import LocalVectorIndex
+
+k = 20
+eval_set_df = pd.read_csv("../eval-dataset.csv")
+
+# COMMAND ----------
+
+vs_index = VectorSearchClient(disable_notice=True).get_index(
+    VECTOR_SEARCH_ENDPOINT_NAME, f"{catalog}.{dbName}.{embed_table_name}_vs_index"
+)
+
+local_index = LocalVectorIndex.load(local_index_snapshot_path, DatabricksEmbeddings(endpoint=embedding_endpoint_name))
+started_at = time.perf_counter()
+local_index.attach_lexical_index()
+print(f"BM25 index build: {(time.perf_counter() - started_at) * 1000:.1f} ms for {len(local_index.ids)} chunks")
+
+# COMMAND ----------
+
+def remote_hybrid(question: str) -> list[dict]:
+    response = vs_index.similarity_search(
+        query_text=question, columns=["id", "content"], num_results=k, query_type="HYBRID"
+    )
+    columns = [c["name"] for c in response["manifest"]["columns"]]
+    return [dict(zip(columns, row)) for row in response.get("result", {}).get("data_array", [])]
+
+def local_hybrid(question: str, query_vector=None) -> list[dict]:
+    # query_vector を渡すと embedding の時間を除いた、純粋な検索時間を測れる
+    rows = local_index.hybrid_search(question, k, query_vector=query_vector)
+    return [{"id": local_index.ids[row], "content": local_index.contents[row]} for row, _ in rows]
+
+def local_dense(question: str) -> list[dict]:
+    rows = local_index.search_by_vector(local_index.embed_query(question), k)
+    return [{"id": local_index.ids[row], "content": local_index.contents[row]} for row, _ in rows]
+
+# COMMAND ----------
+
+results = {"remote_hybrid": [], "local_hybrid": [], "local_dense": []}
+latencies = {"remote_hybrid": [], "local_hybrid": [], "local_dense": [], "local_hybrid_search_only": []}
+overlaps = []
+
+for _, row in eval_set_df.iterrows():
+    question, expected = row["request"], row["expected_response"]
+    retrieved = {}
+    for name, search in [("remote_hybrid", remote_hybrid), ("local_hybrid", local_hybrid), ("local_dense", local_dense)]:
+        started_at = time.perf_counter()
+        retrieved[name] = search(question)
+        latencies[name].append(time.perf_counter() - started_at)
+        results[name].append(answer_recall([d["content"] for d in retrieved[name]], expected))
+
+    query_vector = local_index.embed_query(question)
+    started_at = time.perf_counter()
+    local_hybrid(question, query_vector)
+    latencies["local_hybrid_search_only"].append(time.perf_counter() - started_at)
+
+    overlaps.append(overlap_at_k(
+        [d["id"] for d in retrieved["remote_hybrid"]], [d["id"] for d in retrieved["local_hybrid"]], k
+    ))
+
+# COMMAND ----------
+
+summary = pd.DataFrame([
+    {
+        "mode": name,
+        **latency_summary(latencies[name]),
+        "answer_recall": sum(results[name]) / len(results[name]) if name in results else None,
+    }
+    for name in latencies
+])
+print(f"overlap@{k} (local hybrid vs remote hybrid): {sum(overlaps) / len(overlaps):.3f}")
+display(summary)
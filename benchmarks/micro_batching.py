@@ -0,0 +1,129 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## マイクロバッチ: 同時リクエスト時のスループット
+# MAGIC
+# MAGIC 1. embedding 単体: 同時に embed_query を呼んだときの requests/sec を、そのまま呼ぶ場合と MicroBatchedEmbeddings 経由で比べる
+# MAGIC 2. chain 全体: micro_batching.enabled の true / false で chain_langchain をログし、同時実行数ごとに requests/sec とレイテンシを比べる
+# MAGIC
+# MAGIC キャッシュが効くと差が見えなくなるので、セマンティックキャッシュ・メモ化・rerank キャッシュは切っておく。
+
+# COMMAND ----------
+
+# MAGIC %pip install databricks-vectorsearch databricks-sdk langchain==0.2.11 langchain_core==0.2.23 langchain-community==0.2.9 mlflow cohere python-dotenv pyyaml
+# MAGIC %restart_python
+
+# COMMAND ----------
+
+# MAGIC %run ../config
+
+# COMMAND ----------
+
+import copy
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mlflow
+import pandas as pd
+import yaml
+from langchain_community.embeddings import DatabricksEmbeddings
+
+# approaches/ を import できるようにする
+sys.path.append(os.path.abspath(".."))
+
+from approaches.evaluation.retrieval_metrics import latency_summary
+from approaches.serving.micro_batcher import MicroBatchedEmbeddings
+
+eval_set_df = pd.read_csv("../eval-dataset.csv")
+questions = eval_set_df["request"].tolist()
+chain_notebook_path = os.path.abspath("../chain_langchain")
+with open("../rag_chain_config.yaml") as f:
+    base_config = yaml.safe_load(f)
+
+input_example = {"messages": [{"role": "user", "content": "授業時間は一コマどのくらいですか？"}]}
+
+concurrencies = [1, 4, 16, 32]
+batcher_options = {"max_batch_size": 16, "max_wait_ms": 5, "max_concurrent_batches": 4}
+
+def run_concurrently(func, items: list, concurrency: int) -> dict:
+    """items を concurrency 並列で func に渡し、requests/sec とレイテンシを返す"""
+    latencies = []
+
+    def timed(item):
+        started_at = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, items))
+    wall_clock = time.perf_counter() - started_at
+    return {"requests_per_s": len(items) / wall_clock, **latency_summary(latencies)}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### 1. embedding 単体
+
+# COMMAND ----------
+
+embeddings = DatabricksEmbeddings(endpoint=embedding_endpoint_name)
+batched_embeddings = MicroBatchedEmbeddings(embeddings, batcher_options)
+
+# 1回目の接続確立を計測に含めないようにする
+embeddings.embed_query(questions[0])
+
+embedding_rows = []
+for concurrency in concurrencies:
+    for name, model in [("direct", embeddings), ("micro_batched", batched_embeddings)]:
+        embedding_rows.append({
+            "mode": name,
+            "concurrency": concurrency,
+            **run_concurrently(model.embed_query, questions * 4, concurrency),
+        })
+display(pd.DataFrame(embedding_rows))
+display(pd.DataFrame([batched_embeddings.batcher.stats()]))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### 2. chain 全体
+
+# COMMAND ----------
+
+def load_variant(micro_batching: bool):
+    config = copy.deepcopy(base_config)
+    config["micro_batching"]["enabled"] = micro_batching
+    config["semantic_cache"]["enabled"] = False
+    config["memo_cache"]["enabled"] = False
+    config["rerank"]["cache"]["enabled"] = False
+    with mlflow.start_run(run_name=f"benchmark_micro_batching_{micro_batching}"):
+        logged_chain_info = mlflow.langchain.log_model(
+            lc_model=chain_notebook_path,
+            model_config=config,
+            code_paths=[os.path.abspath("../approaches")],
+            artifact_path="chain",
+            input_example=input_example,
+            example_no_conversion=True,
+        )
+    return mlflow.langchain.load_model(logged_chain_info.model_uri)
+
+chains = {
+    "baseline": load_variant(micro_batching=False),
+    "micro_batched": load_variant(micro_batching=True),
+}
+
+chain_rows = []
+for concurrency in concurrencies:
+    for name, chain in chains.items():
+        chain_rows.append({
+            "mode": name,
+            "concurrency": concurrency,
+            **run_concurrently(
+                lambda question: chain.invoke({"messages": [{"role": "user", "content": question}]}),
+                questions,
+                concurrency,
+            ),
+        })
+display(pd.DataFrame(chain_rows))
@@ -0,0 +1,84 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## rerank バックエンドの比較 (Cohere rerank-v3.5 / ローカル cross-encoder)
+# MAGIC
+# MAGIC ローカルインデックスのスナップショットの BM25 で候補を作り、各バックエンドで rerank したときの
+# MAGIC レイテンシと上位5件の answer_recall を比べる。BM25 は embedding エンドポイントを使わないので、
+# MAGIC COHERE_API_KEY がなければ cross-encoder だけをオフラインで測る。
+# MAGIC rerank キャッシュの効果として、同じ質問を2回目に投げたときのレイテンシも測る。
+
+# COMMAND ----------
+
+# MAGIC %pip install numpy pandas cohere python-dotenv sentence-transformers langchain_core==0.2.23 mlflow
+# MAGIC %restart_python
+
+# COMMAND ----------
+
+# MAGIC %run ../config
+
+# COMMAND ----------
+
+import os
+import sys
+import time
+
+import pandas as pd
+from dotenv import load_dotenv
+
+# approaches/ を import できるようにする
+sys.path.append(os.path.abspath(".."))
+
+from approaches.evaluation.retrieval_metrics import answer_recall, latency_summary
+from approaches.rerank.rerank_cache import RerankCache, results_from_ids, results_to_ids
+from approaches.rerank.rerankers import CohereReranker, CrossEncoderReranker
+from approaches.retrieval.local_vector_index import LocalVectorIndex
+
+load_dotenv()
+
+n_candidates = 30
+top_n = 5
+eval_set_df = pd.read_csv("../eval-dataset.csv")
+
+# BM25 だけを使うので embedding モデルは不要
+local_index = LocalVectorIndex.load(local_index_snapshot_path, embedding=None)
+local_index.attach_lexical_index()
+
+# COMMAND ----------
+
+rerankers = {"cross_encoder": CrossEncoderReranker()}
+if "COHERE_API_KEY" in os.environ:
+    import cohere
+
+    rerankers["cohere"] = CohereReranker(cohere.ClientV2(os.environ["COHERE_API_KEY"]))
+
+# 最初の1回はモデルのロードなどで遅いので測定から外す
+for reranker in rerankers.values():
+    reranker.rerank("ウォームアップ", ["ウォームアップ"], top_n=1)
+
+# COMMAND ----------
+
+rows = []
+for name, reranker in rerankers.items():
+    cache = RerankCache(model=reranker.name)
+    latencies, cached_latencies, recalls = [], [], []
+    for question, expected in zip(eval_set_df["request"], eval_set_df["expected_response"]):
+        candidate_rows = [row for row, _ in local_index.lexical_index.search(question, n_candidates)]
+        candidate_ids = [local_index.ids[row] for row in candidate_rows]
+        documents = [local_index.contents[row] for row in candidate_rows]
+
+        started_at = time.perf_counter()
+        results = reranker.rerank(question, documents, top_n)
+        latencies.append(time.perf_counter() - started_at)
+        cache.put((question, candidate_ids, top_n), results_to_ids(results, candidate_ids))
+        recalls.append(answer_recall([documents[r.index] for r in results], expected))
+
+        # 同じ質問の2回目 (キャッシュヒット)
+        started_at = time.perf_counter()
+        value, _ = cache.get((question, candidate_ids, top_n))
+        results_from_ids(value, candidate_ids)
+        cached_latencies.append(time.perf_counter() - started_at)
+
+    rows.append({"backend": name, **latency_summary(latencies), "answer_recall@5": sum(recalls) / len(recalls)})
+    rows.append({"backend": f"{name} (cache hit)", **latency_summary(cached_latencies)})
+
+display(pd.DataFrame(rows))
@@ -0,0 +1,121 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## rerank に渡す候補数とレイテンシ・recall のトレードオフ
+# MAGIC
+# MAGIC chain と同じく「元の質問 + リライト」の各クエリで Vector Search (hybrid, k=20) を引き、
+# MAGIC クエリごとのランキングを RRF で統合して上位 N 件だけを Cohere rerank に渡す。
+# MAGIC N を変えたときの rerank のレイテンシと、rerank 後の上位5件の answer_recall を比べる。
+# MAGIC `dedupe_only` は以前の merge_and_sort_docs (本文で重複除去するだけで並び替え・上限なし) 相当。
+
+# COMMAND ----------
+
+# MAGIC %pip install databricks-vectorsearch databricks-sdk langchain==0.2.11 langchain_core==0.2.23 langchain-community==0.2.9 mlflow cohere python-dotenv
+# MAGIC %restart_python
+
+# COMMAND ----------
+
+# MAGIC %run ../config
+
+# COMMAND ----------
+
+import os
+import sys
+import time
+
+import cohere
+import pandas as pd
+from databricks.vector_search.client import VectorSearchClient
+from dotenv import load_dotenv
+from langchain_community.chat_models import ChatDatabricks
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+# approaches/ を import できるようにする
+sys.path.append(os.path.abspath(".."))
+
+from approaches.evaluation.retrieval_metrics import answer_recall, latency_summary
+from approaches.retrieval.fusion import fuse_rankings
+
+if "COHERE_API_KEY" not in os.environ:
+    load_dotenv()
+
+k = 20
+top_n = 5
+candidate_counts = [10, 20, 30, 50, None]  # None は RRF で並び替えるだけで上限なし
+eval_set_df = pd.read_csv("../eval-dataset.csv")
+
+# COMMAND ----------
+
+vs_index = VectorSearchClient(disable_notice=True).get_index(
+    VECTOR_SEARCH_ENDPOINT_NAME, f"{catalog}.{dbName}.{embed_table_name}_vs_index"
+)
+rerank_model = cohere.ClientV2(os.environ["COHERE_API_KEY"])
+
+# chain_langchain.py の rewrite_prompt と同じ内容
+rewrite_chain = (
+    ChatPromptTemplate.from_template("""
+あなたは、検索エンジンの精度を向上させるAIアシスタントです。
+ユーザーが入力したクエリをもとに、より効果的な検索を行うためのバリエーションを作成してください。
+質問には答えず、バリエーションを作ることに専念してください。
+
+質問: {original_query}
+
+- 言い換え（3つ）
+- シンプルな要約表現
+- より一般的な表現（1つ）
+- より専門的な表現（1つ）
+- 詳細化したバージョン（1つ）
+
+出力は必ず**カンマ(',')区切り**で記述してください。
+例: 要約, 言い換え1, 言い換え2, 言い換え3, 一般向け, 専門的, 詳細版
+""")
+    | ChatDatabricks(endpoint=instruct_mini_endpoint_name, temperature=0)
+    | StrOutputParser()
+)
+
+def search(query: str) -> list[dict]:
+    response = vs_index.similarity_search(
+        query_text=query, columns=["id", "content"], num_results=k, query_type="HYBRID"
+    )
+    columns = [c["name"] for c in response["manifest"]["columns"]]
+    return [dict(zip(columns, row)) for row in response.get("result", {}).get("data_array", [])]
+
+def rerank(question: str, candidates: list[dict]) -> list[dict]:
+    response = rerank_model.rerank(
+        query=question, documents=[d["content"] for d in candidates], top_n=top_n, model="rerank-v3.5"
+    )
+    return [candidates[r.index] for r in response.results]
+
+# COMMAND ----------
+
+# 検索結果は候補数によらず同じなので、先にクエリごとのランキングを作っておく
+rankings_per_question = []
+for question in eval_set_df["request"]:
+    queries = [question] + [q for q in rewrite_chain.invoke({"original_query": question}).split(",") if q.strip()]
+    rankings_per_question.append([search(q) for q in queries])
+
+# COMMAND ----------
+
+rows = []
+for name in ["dedupe_only", *candidate_counts]:
+    latencies, recalls, n_candidates = [], [], []
+    for question, expected, rankings in zip(
+        eval_set_df["request"], eval_set_df["expected_response"], rankings_per_question
+    ):
+        if name == "dedupe_only":
+            candidates = list({d["content"]: d for ranking in rankings for d in ranking}.values())
+        else:
+            candidates = [d for d, _ in fuse_rankings(rankings, key=lambda d: d["id"], max_candidates=name)]
+        started_at = time.perf_counter()
+        reranked = rerank(question, candidates)
+        latencies.append(time.perf_counter() - started_at)
+        recalls.append(answer_recall([d["content"] for d in reranked], expected))
+        n_candidates.append(len(candidates))
+    rows.append({
+        "max_candidates": name if name is not None else "rrf_all",
+        "mean_candidates": sum(n_candidates) / len(n_candidates),
+        **latency_summary(latencies),
+        "answer_recall@5": sum(recalls) / len(recalls),
+    })
+
+display(pd.DataFrame(rows))
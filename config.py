@@ -11,6 +11,17 @@ embedding_endpoint_name = "multilingual-e5-large-embedding"
 instruct_endpoint_name = "aoai-gpt-4o"
 instruct_mini_endpoint_name = "aoai-gpt-4o-mini"
 
+# インデックスを再同期するたびに更新するバージョンマーカー (chain のキャッシュ無効化に使う)
+index_version_path = f"/Volumes/{catalog}/{dbName}/{volume}/{embed_table_name}_vs_index.version"
+# chain をプロセス内で検索させるためのローカルインデックスのスナップショット
+local_index_snapshot_path = f"/Volumes/{catalog}/{dbName}/{volume}/{embed_table_name}_local_index.npz"
+# 一般質問/固有の質問のローカル分類器 (question-classifier.py で学習する)
+question_classifier_path = f"/Volumes/{catalog}/{dbName}/{volume}/{embed_table_name}_question_classifier.json"
+# スクレイピングの HTTP レスポンスキャッシュ (再クロール時に条件付き GET を送る)
+http_cache_path = f"/Volumes/{catalog}/{dbName}/{volume}/scraping_http_cache.sqlite"
+# True にすると差分取り込みをせず、テーブルとベクトルインデックスを作り直す
+full_rebuild = False
+
 databricks_token_secrets_scope = "rach"
 databricks_token_secrets_key = "databricks_token"
 databricks_host_secrets_scope = "rach"
@@ -26,3 +37,8 @@ print('registered_model_name =',registered_model_name)
 print('embed_table_name =',embed_table_name)
 print('embedding_endpoint_name =',embedding_endpoint_name)
 print('instruct_endpoint_name =',instruct_endpoint_name)
+print('index_version_path =',index_version_path)
+print('local_index_snapshot_path =',local_index_snapshot_path)
+print('question_classifier_path =',question_classifier_path)
+print('http_cache_path =',http_cache_path)
+print('full_rebuild =',full_rebuild)
@@ -40,6 +40,16 @@ def index_exists(vsc, endpoint_name, index_full_name):
             print(f'Unexpected error describing the index. This could be a permission issue.')
             raise e
     return False
+
+def index_defined(vsc, endpoint_name, index_full_name):
+    # index_exists と違い、準備中のインデックスもあるものとする
+    try:
+        vsc.get_index(endpoint_name, index_full_name).describe()
+        return True
+    except Exception as e:
+        if 'RESOURCE_DOES_NOT_EXIST' not in str(e):
+            raise e
+    return False
   
 
 def wait_for_vs_endpoint_to_be_ready(vsc, vs_endpoint_name):
@@ -100,32 +110,19 @@ source_table_fullname = f"{catalog}.{db}.{embed_table_name}"
 #インデックスを格納する場所
 vs_index_fullname = f"{catalog}.{db}.{embed_table_name}_vs_index"
 
-#すでに同名のインデックスが存在すれば削除
-if index_exists(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname):
+#差分取り込みでは既存のインデックスをそのまま使い、sync で変わった行だけを embedding し直す
+#full_rebuild のとき (rach_documentation を作り直したときなど) だけ、インデックスを削除して作り直す
+if full_rebuild and index_defined(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname):
   print(f"Deleting index {vs_index_fullname} on endpoint {VECTOR_SEARCH_ENDPOINT_NAME}...")
   vsc.delete_index(VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname)
   while True:
-    if index_exists(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname):
+    if index_defined(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname):
       time.sleep(1)
       print(".")
     else:      
       break
 
-#インデックスを新規作成
-print(f"Creating index {vs_index_fullname} on endpoint {VECTOR_SEARCH_ENDPOINT_NAME}...")
-try:
-  vsc.create_delta_sync_index(
-    endpoint_name=VECTOR_SEARCH_ENDPOINT_NAME,
-    index_name=vs_index_fullname,
-    pipeline_type="TRIGGERED",
-    source_table_name=source_table_fullname,
-    primary_key="id",
-    embedding_source_column="content",
-    embedding_model_endpoint_name=embedding_endpoint_name
-  )
-except:
-  # なぜかエラー出るが、10秒待って2回実行するとエラーが出なくなる
-  time.sleep(10)
+def create_index():
   vsc.create_delta_sync_index(
     endpoint_name=VECTOR_SEARCH_ENDPOINT_NAME,
     index_name=vs_index_fullname,
@@ -136,6 +133,16 @@ except:
     embedding_model_endpoint_name=embedding_endpoint_name
   )
 
+#インデックスがなければ新規作成
+if not index_defined(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname):
+  print(f"Creating index {vs_index_fullname} on endpoint {VECTOR_SEARCH_ENDPOINT_NAME}...")
+  try:
+    create_index()
+  except:
+    # なぜかエラー出るが、10秒待って2回実行するとエラーが出なくなる
+    time.sleep(10)
+    create_index()
+
 
 #インデックスの準備ができ、すべてエンベッディングが作成され、インデックスが作成されるのを待ちましょう。
 wait_for_index_to_be_ready(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname)
@@ -155,3 +162,36 @@ except Exception as e:
     time.sleep(10)
     vs_index.sync()  # なぜかエラー出るが、sync()を2回実行するとエラーが出なくなる
 
+# COMMAND ----------
+
+# chain を Vector Search エンドポイントなしで動かすためのローカルインデックスのスナップショットを書き出す
+from langchain_community.embeddings import DatabricksEmbeddings
+from approaches.retrieval.local_vector_index import LocalVectorIndex
+
+# 前回のスナップショットと同じ id・同じ本文のチャンクは、その embedding を使い回して差分だけを埋め込む
+embeddings = DatabricksEmbeddings(endpoint=embedding_endpoint_name)
+previous_local_index = None
+if not full_rebuild and os.path.exists(local_index_snapshot_path):
+    previous_local_index = LocalVectorIndex.load(local_index_snapshot_path, embeddings)
+
+docs_df = spark.table(embed_table_name).select("id", "chunk_hash", "url", "content").toPandas()
+local_index = LocalVectorIndex.from_texts_reusing(
+    docs_df["content"].tolist(),
+    embeddings,
+    metadatas=docs_df[["id", "chunk_hash", "url"]].to_dict(orient="records"),
+    previous=previous_local_index,
+    metadata={"index_name": vs_index_fullname, "embedding_endpoint_name": embedding_endpoint_name},
+)
+# 近似検索 (search_mode: ivf) 用のセントロイドも一緒に保存しておく
+local_index.build_ivf()
+local_index.save(local_index_snapshot_path)
+print(f"saved {len(local_index.ids)} chunks to {local_index_snapshot_path}")
+
+# COMMAND ----------
+
+# 同期が終わったらインデックスのバージョンを更新し、chain 側のキャッシュ (セマンティックキャッシュなど) を無効化する
+from approaches.cache.index_version import wait_for_sync_to_finish, write_index_version
+
+wait_for_sync_to_finish(vs_index)
+print(f"index version: {write_index_version(index_version_path, vs_index_fullname)}")
+
@@ -65,15 +65,28 @@ import re
 from httpx import Timeout
 import time
 
+from approaches.scraping.http_cache import HttpCache
+
+# URLごとにクライアントを作るとコネクションを毎回張り直すので、1つを使い回す
+# ReadTimeoutが起きることがあるので、情報取得のタイムアウトを10sにする
+http_client = httpx.Client(timeout=Timeout(5.0, read=10.0))
+# 前回の ETag / Last-Modified で条件付き GET を送り、304 なら保存しておいた本文を使う
+# Volume 上の sqlite は直接書き換えられないので、ローカルにコピーして使い、クロールが終わったら書き戻す
+import shutil
+local_http_cache_path = "/tmp/scraping_http_cache.sqlite"
+if os.path.exists(http_cache_path):
+  shutil.copy(http_cache_path, local_http_cache_path)
+elif os.path.exists(local_http_cache_path):
+  os.remove(local_http_cache_path)
+http_cache = HttpCache(local_http_cache_path)
+
 def get_soup(url):
-    with httpx.Client() as client:
-        # ReadTimeoutが起きることがあるので、情報取得のタイムアウトを10sにする
-        timeout = Timeout(5.0, read=10.0)
-        html = client.get(url, timeout=timeout)
-    if html.status_code != 200:
+    html = http_client.get(url, headers=http_cache.conditional_headers(url))
+    if html.status_code not in (200, 304):
         print(f"Failed to get {url}")
         html.raise_for_status()
-    return BeautifulSoup(html.content, "html.parser")
+    page = http_cache.update(url, html.status_code, html.headers, html.content)
+    return BeautifulSoup(page.content, "html.parser")
 
 # COMMAND ----------
 
@@ -161,87 +174,70 @@ len(urls_ls)
 # COMMAND ----------
 
 from typing import Optional
+from approaches.scraping.html_extraction import extract_article_bs4, extract_page
 
-def extract_page_different(soup) -> Tag:
-  # main tagがない
-  article_html = soup.select("#page > .l-contents > .l-main > article")[0]
-  course_info = article_html.select(".p-different_course")
-  opencampus_info = article_html.select(".p-different_opencampus")
-  article_html.select(".p-different_course")[0].decompose()
-  article_html.select(".p-different_opencampus")[0].decompose()
-  return article_html
-
-def extract_page_strengths(soup) -> Tag:
-  # main tagがない
-  return soup.select("#page > .l-contents > .l-main > article")[0]
-
-def extract_page_myschool(soup) -> str:
-  # article tagがない
-  opencampus_leading = soup.select("#page > main > .p-opencampus_leading")[0]
-  myschool_point = soup.select("#page > main > .p-myschool_point")[0]
-  return str(opencampus_leading) + str(myschool_point)
-
-def extract_page_webopencampus(soup) -> str:  
-  # article tagがない
-  opencampus_leading = soup.select("#page > main > .p-opencampus_leading")[0]
-  unique_info = soup.select("#page > main > .c-common_section")[0]
-  web_opencampus_step = soup.select("#page > main > .c-common_section")[0]
-  return str(opencampus_leading) + str(web_opencampus_step)
-
-def extract_article_html(url) -> Optional[str]:
-  soup = get_soup(url)
-  
-  try:
-    article_html = soup.select("#page > main > article")[0]
-    remove_tag_selectors = [
-      ".c-lower_links",# リンク集
-      ".p-course_opencampus",# OpenCampus情報
-      "#opencampus",# OpenCampus情報
-      ".p-course_major",# 専攻一覧
-      ".p-world_links",# 専攻リンク
-      ".c-cta01_sm",# 資料請求とopemcampus
-      ".p-work_books_article__body > .p-work_books__opencampus",# workbook内のopemcampus情報
-      ".c-admission_cta" # パンフレット
-    ]
-    combined_selector = ", ".join(remove_tag_selectors)
-    for tag in article_html.select(combined_selector):
-      tag.decompose()
-
-  except:
-    # 個別処理
-    print('個別処理 url:', url)
-    if url == 'https://www.tech.ac.jp/features/different/':
-      article_html = extract_page_different(soup)
-    elif url == url == 'https://www.tech.ac.jp/features/strengths/':
-      article_html = extract_page_strengths(soup)
-    elif url == 'https://www.tech.ac.jp/myschool/':
-      article_html = extract_page_myschool(soup)
-    elif url == 'https://www.tech.ac.jp/web_opencampus/':
-      article_html = extract_page_webopencampus(soup)
-    else:
-      print('error in url:', url)
-      return None
+# 記事部分の抽出と H2 分割のエンジン
+# - "lxml": lxml で1回だけパースし、不要なタグの除去と H2 分割を1回の走査で行う (extract_page)
+# - "bs4": 以前の処理。BeautifulSoup で抽出し、後で HTMLHeaderTextSplitter の結果と同じになるように分割し直す
+# どちらも同じチャンクになる (benchmarks/html_extraction.py で確認)
+extraction_engine = "lxml"
 
-  return str(article_html)
+def extract_article_html(url, soup=None) -> Optional[str]:
+  # soup を渡さない場合はここで取得する (クローラーで取得済みのページはそのまま渡す)
+  if soup is None:
+    soup = get_soup(url)
+  return extract_article_bs4(url, soup)
 
 # COMMAND ----------
 
 url_html_pairs = []
+# 取得できなかった URL (リトライしても失敗したもの)
+failed_urls = []
 
-import time
 from tqdm import tqdm
+from approaches.scraping.async_crawler import AsyncCrawler
+
+# 1つのコネクションプールで並列に取得し、取得できたページから順に抽出する
+# 同じホストへのリクエストは 0.1s 以上あける (以前は1ページずつ 0.5s sleep していた)
+crawler = AsyncCrawler(max_concurrency=8, per_host_interval_s=0.1, max_retries=3, cache=http_cache)
+
 print('Processing...')
-for url in tqdm(urls_ls, desc='Extracting HTML'):
-  article_html = extract_article_html(url)
+for result in tqdm(crawler.iter_crawl(urls_ls), total=len(urls_ls), desc='Extracting HTML'):
+  if not result.ok:
+    print(f"Failed to get {result.url}: {result.error}")
+    failed_urls.append(result.url)
+    continue
+  if extraction_engine == "lxml":
+    page = extract_page(result.url, result.content)
+    article_html, sections = (page.html, page.sections) if page is not None else (None, None)
+  else:
+    article_html, sections = extract_article_html(result.url, BeautifulSoup(result.content, "html.parser")), None
   if article_html is not None:
     url_html_pairs.append({
-      'url': url,
+      'url': result.url,
       'text': article_html,
+      # 抽出と同時に作った H2 セクション。後で HTML をパースし直さずに使う
+      'sections': sections,
     })
   else:
-    print('error in url:', url)
-  time.sleep(0.5)
+    print('error in url:', result.url)
+
+# 取得が終わった順になっているので、元の URL の順番に戻す
+url_order = {url: i for i, url in enumerate(urls_ls)}
+url_html_pairs.sort(key=lambda pair: url_order[pair['url']])
 print('All done!')
+print('http cache:', http_cache.stats())
+
+try:
+  shutil.copy(local_http_cache_path, http_cache_path)
+except Exception as e:
+  # Volume がまだない初回の実行など。次回は全ページを取得し直す
+  print('failed to save http cache:', e)
+
+# 取得できなかったページを抜いたまま進めると、後段の MERGE でそのページのチャンクが削除されてしまうので、ここで止める
+# (以前は取得に失敗した時点で止まっていた)
+if failed_urls:
+  raise RuntimeError(f'failed to get {len(failed_urls)} pages: {failed_urls}')
 
 # COMMAND ----------
 
@@ -255,49 +251,22 @@ url_html_pairs[0]
 
 # 参考
 # https://qiita.com/taka_yayoi/items/f174599e4721e51e9e1d
-from langchain.text_splitter import HTMLHeaderTextSplitter, RecursiveCharacterTextSplitter
-from transformers import AutoTokenizer, OpenAIGPTTokenizer
+from transformers import AutoTokenizer, OpenAIGPTTokenizerFast
+from approaches.ingestion.h2_chunking import H2Chunker
+from approaches.scraping.html_extraction import split_h2_sections
 
 max_chunk_size = 512
 
-tokenizer = OpenAIGPTTokenizer.from_pretrained("openai-gpt")
-text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(tokenizer, chunk_size=max_chunk_size, chunk_overlap=50)
-html_splitter = HTMLHeaderTextSplitter(headers_to_split_on=[("h2", "header2")])
+# セクションのトークン数は fast tokenizer (Rust) でまとめて数え、累計を結合の判定と小さいチャンクの破棄に使い回す
+tokenizer = OpenAIGPTTokenizerFast.from_pretrained("openai-gpt")
+h2_chunker = H2Chunker(tokenizer, min_chunk_size=20, max_chunk_size=max_chunk_size, chunk_overlap=50)
 
 # Split on H2で分割しますが、あまり小さすぎないように小さなh2チャンクはマージします
-def split_html_on_h2(html, min_chunk_size = 20, max_chunk_size=512):
+# H2 での分割は HTMLHeaderTextSplitter(headers_to_split_on=[("h2", "header2")]) と同じ結果になる split_h2_sections で行う
+def split_html_on_h2(html):
     if not html:
         return []
-    h2_chunks = html_splitter.split_text(html)
-    page_contents = "".join([c.page_content for c in h2_chunks])
-    chunks = []
-    previous_chunk = ""
-    results = []
-    # チャンクを結合し、h2の前にテキストを追加することでチャンクを結合し、小さすぎる文書を回避します
-    for c in h2_chunks:
-        # h2の結合 (注意: 重複したh2を回避するために以前のチャンクを削除することもできます)
-        current_h2 = c.metadata.get('header2', "")  # 現在のH2
-        content = current_h2 + "\n" + c.page_content
-        if len(tokenizer.encode(previous_chunk + content)) <= max_chunk_size/2:
-            previous_chunk += content + "\n"
-        else:
-            split_chunks = text_splitter.split_text(previous_chunk.strip())
-            for chunk in split_chunks:
-                results.append({
-                    "content": chunk,
-                    "page_contents": page_contents
-                })
-            previous_chunk = content + "\n"
-    if previous_chunk:
-        split_chunks = text_splitter.split_text(previous_chunk.strip())
-        for chunk in split_chunks:
-            results.append({
-                "content": chunk,
-                "page_contents": page_contents
-            })
-    # 小さすぎるチャンクの破棄
-    return [r for r in results if len(tokenizer.encode(r["content"])) > min_chunk_size]
- 
+    return h2_chunker.chunk(split_h2_sections(html))
 
 # COMMAND ----------
 
@@ -320,6 +289,7 @@ split_html
 # COMMAND ----------
 
 from pyspark.sql.functions import pandas_udf
+import json
 import pandas as pd
 import pyspark.sql.functions as F
 from pyspark.sql.functions import col, udf, length, pandas_udf
@@ -330,9 +300,14 @@ from mlflow import MlflowClient
 # COMMAND ----------
 
 # sparkですべてのドキュメントのチャンクを作成するためのユーザー定義関数(UDF)を作成
+# extract_page で作った H2 セクション (JSON) があればそれを使い、HTML をパースし直さない
 @pandas_udf("array<struct<content:string, page_contents:string>>")
-def parse_and_split(docs: pd.Series) -> pd.Series:
-    return docs.apply(split_html_on_h2)
+def split_sections(docs: pd.Series, sections: pd.Series) -> pd.Series:
+    # バッチ内の全ページのセクションのトークン数を、まとめて数える
+    return pd.Series(h2_chunker.chunk_pages([
+        json.loads(s) if s is not None else split_h2_sections(doc)
+        for doc, s in zip(docs, sections)
+    ]))
     
 
 # COMMAND ----------
@@ -371,26 +346,68 @@ use_catalog_and_create_schema()
 
 # COMMAND ----------
 
-# すでに同名のテーブルが存在する場合は削除
 html_raw_data_table_name = f'html_{raw_data_table_name}'
 
 # COMMAND ----------
 
-sql(f"drop table if exists {html_raw_data_table_name}")
+# 差分取り込み: html_raw_query と rach_documentation は overwrite せず、MERGE で差分だけ反映する
+# 差分取り込みに必要な列がない (以前の形式の) テーブルは作り直す
+from approaches.ingestion.incremental import content_hash, merge_sql, with_chunk_ids
 
-
-spark.createDataFrame(url_html_pairs).write.mode('overwrite').saveAsTable(html_raw_data_table_name)
-
-display(spark.table(html_raw_data_table_name))
+def drop_if_missing_columns(table_name, columns) -> bool:
+  if not spark.catalog.tableExists(table_name):
+    return False
+  missing_columns = set(columns) - set(spark.table(table_name).columns)
+  if missing_columns:
+    print(f'drop {table_name} (missing columns: {missing_columns})')
+    sql(f"drop table {table_name}")
+  return bool(missing_columns)
+
+if full_rebuild:
+  sql(f"drop table if exists {html_raw_data_table_name}")
+  sql(f"drop table if exists {embed_table_name}")
+drop_if_missing_columns(html_raw_data_table_name, ['url', 'text', 'page_hash'])
+# rach_documentation を作り直した場合は、ベクトルインデックスも作り直す
+full_rebuild = drop_if_missing_columns(embed_table_name, ['id', 'chunk_hash', 'url', 'content', 'page_contents']) or full_rebuild
+
+# COMMAND ----------
+
+# 記事部分のハッシュが前回と同じページは、前回のチャンク (文脈付与済み) を使い回す
+# (304 が返ったページは保存しておいた本文を使うので、ここでハッシュが同じになる)
+# 前回のチャンクがないページ (前回の実行が途中で止まった場合など) は、変わっていなくても処理し直す
+html_pages_df = pd.DataFrame(url_html_pairs)
+html_pages_df['page_hash'] = html_pages_df['text'].map(content_hash)
+spark.createDataFrame(html_pages_df[['url', 'text', 'page_hash']]).createOrReplaceTempView('html_pages_updates')
+
+previous_page_hashes = {}
+if spark.catalog.tableExists(html_raw_data_table_name):
+  previous_page_hashes = dict(spark.table(html_raw_data_table_name).select('url', 'page_hash').toPandas().values)
+
+chunk_columns = ['id', 'chunk_hash', 'content', 'page_contents', 'url']
+if spark.catalog.tableExists(embed_table_name):
+  previous_chunks_df = spark.table(embed_table_name).select(*chunk_columns).toPandas()
+else:
+  previous_chunks_df = pd.DataFrame(columns=chunk_columns)
+
+unchanged_urls = {
+  url for url, page_hash in zip(html_pages_df['url'], html_pages_df['page_hash'])
+  if previous_page_hashes.get(url) == page_hash
+}
+skipped_urls = unchanged_urls & set(previous_chunks_df['url'])
+print(f'pages to process: {len(html_pages_df) - len(skipped_urls)}, skipped (unchanged): {len(skipped_urls)}')
 
 # COMMAND ----------
 
 sql(f"drop table if exists {raw_data_table_name}")
 
-# すべてのドキュメントチャンクを保存する
-(spark.table(html_raw_data_table_name)
+# 新しいページ・変わったページのチャンクだけを作る (raw_query はこの実行で処理するチャンクの作業用テーブル)
+# extract_page で作った H2 セクションは JSON にして渡す (extraction_engine = "bs4" のときは None で、UDF の中で HTML から分割する)
+pages_to_split_df = html_pages_df[~html_pages_df['url'].isin(skipped_urls)][['url', 'text', 'sections']].copy()
+pages_to_split_df['sections'] = pages_to_split_df['sections'].map(
+  lambda sections: None if sections is None else json.dumps(sections, ensure_ascii=False))
+(spark.createDataFrame(pages_to_split_df, schema='url string, text string, sections string')
       .filter('text is not null')
-      .withColumn('split_content', F.explode(parse_and_split('text')))
+      .withColumn('split_content', F.explode(split_sections('text', 'sections')))
       .selectExpr("split_content.content as content", "split_content.page_contents as page_contents", 'url')
       .write.saveAsTable(raw_data_table_name))
 
@@ -425,22 +442,31 @@ from tqdm import tqdm
 processes_list = []
 failed_list = []
 
+# 文脈付与前の本文のハッシュからチャンクの ID を決める。変わったページの中でも、前回と同じチャンクは文脈付与の結果を使い回す
+raw_data_dict = with_chunk_ids(raw_data_dict)
+annotated_contents = dict(zip(previous_chunks_df['id'], previous_chunks_df['content']))
+
 for doc in tqdm(raw_data_dict):
-    try:
-        # たまにmlflowでkeyerror:'content'という謎のエラーが出るので、ここでtry-catchしておく
-        processed_content = process_and_annotate_document(doc['content'], doc['page_contents'])
-    except Exception as e:
-        failed_list.append(doc)
-        time.sleep(5)
-        processed_content = process_and_annotate_document(doc['content'], doc['page_contents'])
+    if doc['id'] in annotated_contents:
+        processed_content = annotated_contents[doc['id']]
+    else:
+        try:
+            # たまにmlflowでkeyerror:'content'という謎のエラーが出るので、ここでtry-catchしておく
+            processed_content = process_and_annotate_document(doc['content'], doc['page_contents'])
+        except Exception as e:
+            failed_list.append(doc)
+            time.sleep(5)
+            processed_content = process_and_annotate_document(doc['content'], doc['page_contents'])
+        time.sleep(0.5)
 
     processed_raw_data_dict = {
+        'id': doc['id'],
+        'chunk_hash': doc['chunk_hash'],
         'content': processed_content,
         'page_contents': doc['page_contents'],
         'url': doc['url'],
     }
     processes_list.append(processed_raw_data_dict)
-    time.sleep(0.5)
 
 # COMMAND ----------
 
@@ -452,7 +478,9 @@ len(processes_list)
 
 # COMMAND ----------
 
-spark.createDataFrame(processes_list).write.mode('overwrite').saveAsTable(raw_data_table_name)
+# 変わっていないページの前回のチャンクと合わせて、今回の全チャンクにする
+skipped_chunks = previous_chunks_df[previous_chunks_df['url'].isin(skipped_urls)].to_dict(orient='records')
+spark.createDataFrame(processes_list + skipped_chunks).write.mode('overwrite').saveAsTable(raw_data_table_name)
 display(spark.table(raw_data_table_name))
 
 # COMMAND ----------
@@ -472,6 +500,8 @@ raw_data_table_df = spark.table(raw_data_table_name).toPandas()
 add_data_df = pd.read_csv(f'./add-data.csv')
 # urlとpage_contentsを""にする
 add_data_df = add_data_df.fillna("")
+# 追加データにもクロールしたチャンクと同じ規則で ID を付ける
+add_data_df = pd.DataFrame(with_chunk_ids(add_data_df.to_dict(orient='records')))
 
 raw_data_table_merged_df = pd.concat([raw_data_table_df, add_data_df], ignore_index=True)
 raw_data_dict = raw_data_table_merged_df.to_dict(orient='records')
@@ -490,24 +520,44 @@ use_catalog_and_create_schema()
 
 # COMMAND ----------
 
-sql(f"DROP TABLE IF EXISTS {embed_table_name};")
-
 sql(f"""
 --インデックスを作成するには、テーブルのChange Data Feedを有効にします
+--id は url と文脈付与前の本文のハッシュから決める (approaches/ingestion/incremental.py)
 CREATE TABLE IF NOT EXISTS {embed_table_name} (
-  id BIGINT GENERATED BY DEFAULT AS IDENTITY,
+  id BIGINT,
+  chunk_hash STRING,
   url STRING,
   content STRING,
   page_contents STRING
 ) TBLPROPERTIES (delta.enableChangeDataFeed = true); 
 """)
 
-spark.table(raw_data_table_name).write.mode('overwrite').saveAsTable(embed_table_name)
+# 新しい・変わったチャンクだけを upsert し、なくなったチャンク (サイトマップから消えたページのものも) は削除する
+# インデックスの sync では、Change Data Feed の差分だけが embedding される
+# 取得できなかったページがある場合はクロールの直後で止めているので、ここでそのページのチャンクが消えることはない
+(spark.table(raw_data_table_name)
+      .select('id', 'chunk_hash', 'url', 'content', 'page_contents')
+      .dropDuplicates(['id'])
+      .createOrReplaceTempView('chunk_updates'))
+display(sql(merge_sql(embed_table_name, 'chunk_updates', key='id', compare_column='content')))
 
 display(spark.table(embed_table_name))
 
 # COMMAND ----------
 
+# ページの表も差分だけ反映する
+# チャンクの反映が終わってから更新するので、途中で止まった場合は次回そのページを処理し直す
+sql(f"""
+CREATE TABLE IF NOT EXISTS {html_raw_data_table_name} (
+  url STRING,
+  text STRING,
+  page_hash STRING
+)
+""")
+display(sql(merge_sql(html_raw_data_table_name, 'html_pages_updates', key='url', compare_column='page_hash')))
+
+# COMMAND ----------
+
 import time
 
 def index_exists(vsc, endpoint_name, index_full_name):
@@ -519,6 +569,16 @@ def index_exists(vsc, endpoint_name, index_full_name):
             print(f'Unexpected error describing the index. This could be a permission issue.')
             raise e
     return False
+
+def index_defined(vsc, endpoint_name, index_full_name):
+    # index_exists と違い、準備中のインデックスもあるものとする
+    try:
+        vsc.get_index(endpoint_name, index_full_name).describe()
+        return True
+    except Exception as e:
+        if 'RESOURCE_DOES_NOT_EXIST' not in str(e):
+            raise e
+    return False
   
 
 def wait_for_vs_endpoint_to_be_ready(vsc, vs_endpoint_name):
@@ -583,28 +643,30 @@ source_table_fullname = f"{catalog}.{db}.{embed_table_name}"
 #インデックスを格納する場所
 vs_index_fullname = f"{catalog}.{db}.{embed_table_name}_vs_index"
 
-#すでに同名のインデックスが存在すれば削除
-if index_exists(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname):
+#差分取り込みでは既存のインデックスをそのまま使い、sync で変わった行だけを embedding し直す
+#full_rebuild のとき (rach_documentation を作り直したときなど) だけ、インデックスを削除して作り直す
+if full_rebuild and index_defined(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname):
   print(f"Deleting index {vs_index_fullname} on endpoint {VECTOR_SEARCH_ENDPOINT_NAME}...")
   vsc.delete_index(VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname)
   while True:
-    if index_exists(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname):
+    if index_defined(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname):
       time.sleep(1)
       print(".")
     else:      
       break
 
-#インデックスを新規作成
-print(f"Creating index {vs_index_fullname} on endpoint {VECTOR_SEARCH_ENDPOINT_NAME}...")
-vsc.create_delta_sync_index(
-  endpoint_name=VECTOR_SEARCH_ENDPOINT_NAME,
-  index_name=vs_index_fullname,
-  pipeline_type="TRIGGERED",
-  source_table_name=source_table_fullname,
-  primary_key="id",
-  embedding_source_column="content",
-  embedding_model_endpoint_name=embedding_endpoint_name
-)
+#インデックスがなければ新規作成
+if not index_defined(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname):
+  print(f"Creating index {vs_index_fullname} on endpoint {VECTOR_SEARCH_ENDPOINT_NAME}...")
+  vsc.create_delta_sync_index(
+    endpoint_name=VECTOR_SEARCH_ENDPOINT_NAME,
+    index_name=vs_index_fullname,
+    pipeline_type="TRIGGERED",
+    source_table_name=source_table_fullname,
+    primary_key="id",
+    embedding_source_column="content",
+    embedding_model_endpoint_name=embedding_endpoint_name
+  )
 
 #インデックスの準備ができ、すべてエンベッディングが作成され、インデックスが作成されるのを待ちましょう。
 wait_for_index_to_be_ready(vsc, VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname)
@@ -624,6 +686,39 @@ except Exception as e:
     time.sleep(10)
     vs_index.sync()  # なぜかエラー出るが、sync()を2回実行するとエラーが出なくなる
 
+# COMMAND ----------
+
+# chain を Vector Search エンドポイントなしで動かすためのローカルインデックスのスナップショットを書き出す
+from langchain_community.embeddings import DatabricksEmbeddings
+from approaches.retrieval.local_vector_index import LocalVectorIndex
+
+# 前回のスナップショットと同じ id・同じ本文のチャンクは、その embedding を使い回して差分だけを埋め込む
+embeddings = DatabricksEmbeddings(endpoint=embedding_endpoint_name)
+previous_local_index = None
+if not full_rebuild and os.path.exists(local_index_snapshot_path):
+    previous_local_index = LocalVectorIndex.load(local_index_snapshot_path, embeddings)
+
+docs_df = spark.table(embed_table_name).select("id", "chunk_hash", "url", "content").toPandas()
+local_index = LocalVectorIndex.from_texts_reusing(
+    docs_df["content"].tolist(),
+    embeddings,
+    metadatas=docs_df[["id", "chunk_hash", "url"]].to_dict(orient="records"),
+    previous=previous_local_index,
+    metadata={"index_name": vs_index_fullname, "embedding_endpoint_name": embedding_endpoint_name},
+)
+# 近似検索 (search_mode: ivf) 用のセントロイドも一緒に保存しておく
+local_index.build_ivf()
+local_index.save(local_index_snapshot_path)
+print(f"saved {len(local_index.ids)} chunks to {local_index_snapshot_path}")
+
+# COMMAND ----------
+
+# 同期が終わったらインデックスのバージョンを更新し、chain 側のキャッシュ (セマンティックキャッシュなど) を無効化する
+from approaches.cache.index_version import wait_for_sync_to_finish, write_index_version
+
+wait_for_sync_to_finish(vs_index)
+print(f"index version: {write_index_version(index_version_path, vs_index_fullname)}")
+
 
 # COMMAND ----------
 
@@ -646,6 +741,7 @@ docs
 
 # RAGチェーンとして呼び方を統一する！
 
+import os
 import yaml
 import mlflow
 
@@ -653,10 +749,18 @@ rag_chain_config = {
       "vector_search_endpoint_name": VECTOR_SEARCH_ENDPOINT_NAME,
       "vector_search_index_name": f"{catalog}.{dbName}.{embed_table_name}_vs_index",
       "llm_endpoint_name": instruct_endpoint_name,
-      "llm_mini_endpoint_name": instruct_mini_endpoint_name
+      "llm_mini_endpoint_name": instruct_mini_endpoint_name,
+      "embedding_endpoint_name": embedding_endpoint_name,
+      "index_version_path": index_version_path,
+      "local_index_snapshot_path": local_index_snapshot_path,
+      "question_classifier_path": question_classifier_path,
 }
 config_file_name = 'rag_chain_config.yaml'
 try:
+    # チューニング用のキー（speculative_execution など）は残したまま、エンドポイント名だけ更新する
+    if os.path.exists(config_file_name):
+        with open(config_file_name) as f:
+            rag_chain_config = {**(yaml.safe_load(f) or {}), **rag_chain_config}
     with open(config_file_name, 'w') as f:
         yaml.dump(rag_chain_config, f)
 except:
@@ -0,0 +1,93 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## 一般質問 / 固有の質問のローカル分類器を学習する
+# MAGIC
+# MAGIC 学習データは以下の3つ。
+# MAGIC - classifier-examples.csv: 手でラベルを付けた質問
+# MAGIC - eval-dataset.csv: すべて学校固有の質問 (specific)
+# MAGIC - chain のトレース: LLM (classification_chain) が判定した質問 (question_classifier span の source が llm のもの)
+# MAGIC
+# MAGIC 学習したモデルは question_classifier_path に保存し、rag_chain_config.yaml の classifier.backend を local にすると chain で使われる。
+
+# COMMAND ----------
+
+# MAGIC %pip install mlflow numpy pandas
+# MAGIC %restart_python
+
+# COMMAND ----------
+
+# MAGIC %run ./config
+
+# COMMAND ----------
+
+import os
+import sys
+
+import mlflow
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath("."))
+
+from approaches.classification.local_classifier import LocalQuestionClassifier
+
+# トレースを読み込む実験 (デプロイした agent のトレースが記録される実験のパス)。空なら使わない
+dbutils.widgets.text("trace_experiment", "", "Trace experiment path")
+trace_experiment = dbutils.widgets.get("trace_experiment")
+
+# COMMAND ----------
+
+examples_df = pd.read_csv("classifier-examples.csv")
+eval_df = pd.read_csv("eval-dataset.csv")
+
+frames = [
+    examples_df.assign(source="manual"),
+    pd.DataFrame({"question": eval_df["request"], "label": "specific", "source": "eval"}),
+]
+
+if trace_experiment:
+    experiment = mlflow.get_experiment_by_name(trace_experiment)
+    traces = mlflow.search_traces(experiment_ids=[experiment.experiment_id], max_results=5000)
+    logged = []
+    for trace in traces["trace"]:
+        for span in trace.data.spans:
+            outputs = span.outputs or {}
+            if span.name == "question_classifier" and outputs.get("source") == "llm":
+                logged.append({"question": span.inputs["question"], "label": outputs["label"], "source": "trace"})
+    frames.append(pd.DataFrame(logged, columns=["question", "label", "source"]))
+
+dataset_df = (
+    pd.concat(frames, ignore_index=True)
+    .query("label in ['general', 'specific']")
+    # 同じ質問は手動ラベルを優先する
+    .drop_duplicates(subset="question", keep="first")
+    .reset_index(drop=True)
+)
+display(dataset_df.groupby(["source", "label"]).size().rename("n").reset_index())
+
+# COMMAND ----------
+
+# 2割をテスト用に分けて精度を確認してから、全件で学習し直して保存する
+rng = np.random.default_rng(42)
+test_mask = rng.random(len(dataset_df)) < 0.2
+train_df, test_df = dataset_df[~test_mask], dataset_df[test_mask]
+
+classifier = LocalQuestionClassifier.train(train_df["question"].tolist(), train_df["label"].tolist())
+predictions = [classifier.predict(q) for q in test_df["question"]]
+test_df = test_df.assign(
+    predicted=[label for label, _ in predictions],
+    confidence=[confidence for _, confidence in predictions],
+)
+print(f"accuracy: {(test_df['predicted'] == test_df['label']).mean():.3f} (n={len(test_df)})")
+
+# 確信度のしきい値ごとの、ローカルで判定できる割合と、その中での精度
+for min_confidence in [0.6, 0.7, 0.8, 0.9, 0.95]:
+    confident = test_df[test_df["confidence"] >= min_confidence]
+    accuracy = (confident["predicted"] == confident["label"]).mean() if len(confident) else float("nan")
+    print(f"min_confidence={min_confidence}: coverage={len(confident) / len(test_df):.2f}, accuracy={accuracy:.3f}")
+
+# COMMAND ----------
+
+classifier = LocalQuestionClassifier.train(dataset_df["question"].tolist(), dataset_df["label"].tolist())
+classifier.save(question_classifier_path)
+print(f"saved classifier ({len(classifier.vocab)} features) to {question_classifier_path}")